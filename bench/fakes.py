@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Stand-ins for the external pieces the orchestration code talks to:
+# the EC2 API (boto) and the ssh/rsync/ping/sudo binaries. These let
+# the benchmarks drive the real handlers without any AWS account or
+# remote machines.
+
+import calendar, os, stat, sys, time, types, threading
+
+class FakeInstance(object):
+    def __init__(self, idx):
+        self.id = 'i-%08x' % (0xbe000000 + idx)
+        self.ip_address = '127.0.0.1'
+        self.dns_name = 'ec2-bench-%d.compute.example.com' % (idx)
+        self.private_ip_address = '10.0.0.%d' % (idx + 1)
+        self.private_dns_name = 'ip-10-0-0-%d.ec2.internal' % (idx + 1)
+        self.state = 'running'
+
+class FakeReservation(object):
+    def __init__(self, rid, instances):
+        self.id = rid
+        self.instances = instances
+
+class FakeZone(object):
+    def __init__(self, name):
+        self.name = name
+        self.state = 'available'
+
+class FakeSpotPrice(object):
+    def __init__(self, zone, instance_type, timestamp, price):
+        self.availability_zone = zone
+        self.instance_type = instance_type
+        self.product_description = 'Linux/UNIX'
+        self.timestamp = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+        self.price = price
+
+class FakeResultSet(list):
+    next_token = None
+
+class FakePlacementGroup(object):
+    def __init__(self, name, strategy):
+        self.name = name
+        self.strategy = strategy
+        self.state = 'available'
+
+def synthetic_spot_prices(hours=48):
+    '''Hourly price histories, as { zone : [(hours ago, price), ...] },
+    with one zone that's cheapest now but spiked for a third of the
+    last day, one steady zone and one expensive zone. Zone selection by
+    price should pick us-east-1a, by fulfillment us-east-1b.'''
+    prices = {}
+    for hour in range(hours, -1, -1):
+        prices.setdefault('us-east-1a', []).append((hour, 0.50 if 4 <= hour < 12 else 0.020))
+        prices.setdefault('us-east-1b', []).append((hour, 0.030))
+        prices.setdefault('us-east-1c', []).append((hour, 0.045))
+    return prices
+
+class FakeEC2ResponseError(Exception):
+    def __init__(self, error_code):
+        Exception.__init__(self, error_code)
+        self.status = 503
+        self.error_code = error_code
+
+class FakeEC2(object):
+    '''Shared state for all FakeEC2Connections, mirroring the fact that
+    every handler opens its own connection to the same account.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.instances = {}
+        self.reservations = []
+        self.tags = {}
+        self.placement_groups = {}
+        self.spot_prices = synthetic_spot_prices()
+        self.api_calls = 0
+        # Throttle every Nth request, if set
+        self.throttle_every = None
+        self.throttled = 0
+
+    def count(self):
+        with self.lock:
+            self.api_calls += 1
+            if self.throttle_every and self.api_calls % self.throttle_every == 0:
+                self.throttled += 1
+                raise FakeEC2ResponseError('RequestLimitExceeded')
+
+account = FakeEC2()
+
+class FakeEC2Connection(object):
+    '''Implements the subset of boto's EC2Connection used by cluster.ec2,
+    counting every API call made against the shared fake account.'''
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_all_zones(self):
+        account.count()
+        return [FakeZone(z) for z in ['us-east-1a', 'us-east-1b', 'us-east-1c']]
+
+    def get_spot_price_history(self, start_time=None, end_time=None, instance_type=None,
+                               product_description=None, availability_zone=None, next_token=None):
+        # Like EC2, include the price in effect at start_time
+        account.count()
+        now = time.time()
+        def parse(ts):
+            return calendar.timegm(time.strptime(ts[:19], '%Y-%m-%dT%H:%M:%S'))
+        start = parse(start_time) if start_time else 0
+        end = parse(end_time) if end_time else now
+        history = FakeResultSet()
+        for zone, points in sorted(account.spot_prices.items()):
+            if availability_zone is not None and zone != availability_zone: continue
+            stamped = [(now - hours_ago * 3600, price) for hours_ago, price in points]
+            before = [p for p in stamped if p[0] <= start]
+            during = [p for p in stamped if start < p[0] <= end]
+            for t, price in before[-1:] + during:
+                history.append(FakeSpotPrice(zone, instance_type, t, price))
+        return history
+
+    def get_all_placement_groups(self, groupnames=None):
+        account.count()
+        return [g for g in account.placement_groups.values() if groupnames is None or g.name in groupnames]
+
+    def create_placement_group(self, name, strategy='cluster'):
+        account.count()
+        account.placement_groups[name] = FakePlacementGroup(name, strategy)
+        return True
+
+    def delete_placement_group(self, name):
+        account.count()
+        del account.placement_groups[name]
+        return True
+
+    def get_all_security_groups(self):
+        account.count()
+        return []
+
+    def run_instances(self, ami, min_count=1, max_count=1, **kwargs):
+        account.count()
+        base = len(account.instances)
+        insts = [FakeInstance(base + idx) for idx in range(max_count)]
+        for inst in insts:
+            inst.placement = kwargs.get('placement')
+            inst.placement_group = kwargs.get('placement_group')
+            account.instances[inst.id] = inst
+        res = FakeReservation('r-%08x' % (len(account.reservations)), insts)
+        account.reservations.append(res)
+        return res
+
+    def request_spot_instances(self, price, ami, count=1, **kwargs):
+        account.count()
+        return self.run_instances(ami, min_count=count, max_count=count, **kwargs).instances
+
+    def get_all_instances(self, instance_ids=None):
+        account.count()
+        if instance_ids is None:
+            return list(account.reservations)
+        return [FakeReservation('r-query', [account.instances[iid] for iid in instance_ids if iid in account.instances])]
+
+    def create_tags(self, resource_ids, tags):
+        account.count()
+        for rid in resource_ids:
+            account.tags.setdefault(rid, {}).update(tags)
+        return True
+
+    def terminate_instances(self, instance_ids):
+        account.count()
+        terminated = []
+        for iid in instance_ids:
+            if iid in account.instances:
+                del account.instances[iid]
+                terminated.append(iid)
+        return terminated
+
+
+def install_boto():
+    '''Make boto.ec2.connection.EC2Connection resolve to the fake. If
+    boto is installed we leave the module alone and patch the
+    reference held by cluster.ec2.nodes instead (see patch_cluster).'''
+    try:
+        import boto.ec2.connection
+        return
+    except ImportError:
+        pass
+    boto = types.ModuleType('boto')
+    boto_ec2 = types.ModuleType('boto.ec2')
+    boto_ec2_connection = types.ModuleType('boto.ec2.connection')
+    boto_ec2_connection.EC2Connection = FakeEC2Connection
+    boto.ec2 = boto_ec2
+    boto_ec2.connection = boto_ec2_connection
+    sys.modules['boto'] = boto
+    sys.modules['boto.ec2'] = boto_ec2
+    sys.modules['boto.ec2.connection'] = boto_ec2_connection
+
+def patch_cluster():
+    '''Point every module that captured EC2Connection at the fake.'''
+    import cluster.util.config as config
+    import cluster.ec2.nodes
+    cluster.ec2.nodes.EC2Connection = FakeEC2Connection
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        if not hasattr(config, name): setattr(config, name, 'bench')
+
+
+
+# Shell shims placed at the front of PATH. BENCH_REMOTE=local runs the
+# "remote" side on this machine (adhoc localhost nodes), BENCH_REMOTE=noop
+# just succeeds (fake EC2 nodes whose paths don't exist here).
+# BENCH_LATENCY adds a fixed delay per invocation to model a network
+# round trip.
+_shims = {
+    'ssh' : '''#!/bin/bash
+[ -n "$BENCH_LATENCY" ] && sleep $BENCH_LATENCY
+forward=
+noexec=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -L) forward="$2"; shift 2 ;;
+        -N) noexec=1; shift ;;
+        -o|-i|-p|-l|-R|-S) shift 2 ;;
+        -*) shift ;;
+        *) break ;;
+    esac
+done
+shift # user@host
+if [ -n "$noexec" ]; then
+    # Forward a unix socket (local:remote) by linking to it
+    [ "$BENCH_REMOTE" = "noop" ] && exit 255
+    [ -n "$forward" ] && ln -s "${forward#*:}" "${forward%%:*}"
+    exec sleep 1000000
+fi
+[ "$BENCH_REMOTE" = "noop" ] && exit 0
+[ $# -eq 0 ] && exit 0
+exec /bin/bash -c "$*"
+''',
+
+    'rsync' : '''#!/bin/bash
+[ -n "$BENCH_LATENCY" ] && sleep $BENCH_LATENCY
+args=()
+stats=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -e|--bwlimit) shift 2 ;;
+        --stats) stats=1; shift ;;
+        -*) shift ;;
+        *) args+=("${1#*:}"); shift ;;
+    esac
+done
+[ "$BENCH_REMOTE" = "noop" ] && exit 0
+n=${#args[@]}
+dest=${args[$((n-1))]}
+unset args[$((n-1))]
+cp -r "${args[@]}" "$dest" || exit $?
+[ -n "$stats" ] && echo "Total bytes sent: $(du -cb "${args[@]}" | tail -n 1 | cut -f1)"
+exit 0
+''',
+
+    'ping' : '''#!/bin/bash
+exit 0
+''',
+
+    'sudo' : '''#!/bin/bash
+exec "$@"
+''',
+    }
+
+def install_shims(bin_dir):
+    '''Write the shims into bin_dir and put it at the front of PATH.'''
+    if not os.path.exists(bin_dir): os.makedirs(bin_dir)
+    for name, body in _shims.iteritems():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as fp:
+            fp.write(body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
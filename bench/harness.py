@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Measurement and bookkeeping for the orchestration benchmarks: counts
+# subprocesses, bytes pushed through rsync and EC2 API calls while an
+# operation runs, and compares the collected numbers against a stored
+# baseline.
+
+import fakes
+import json, os, subprocess, time, threading
+
+Metrics = ['wall_s', 'subprocesses', 'bytes', 'api_calls', 'sleep_s']
+'''Metrics recorded for every operation. sleep_s is time the code
+asked to sleep (polling intervals), which we skip rather than wait
+out, so it is reported separately from wall_s.'''
+
+def _path_size(path):
+    if os.path.isfile(path): return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            fpath = os.path.join(dirpath, fname)
+            if os.path.isfile(fpath): total += os.path.getsize(fpath)
+    return total
+
+def _transfer_bytes(argv):
+    '''Estimate bytes pushed by an rsync invocation from the sizes of
+    its local source arguments.'''
+    if not argv or os.path.basename(argv[0]) != 'rsync': return 0
+    paths = []
+    skip = False
+    for arg in argv[1:]:
+        if skip:
+            skip = False
+            continue
+        if arg in ['-e', '--bwlimit']:
+            skip = True
+            continue
+        if arg.startswith('-'): continue
+        paths.append(arg)
+    return sum([_path_size(p) for p in paths[:-1] if ':' not in p and os.path.exists(p)])
+
+
+class Counters(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.subprocesses = 0
+        self.bytes = 0
+        self.sleep_s = 0.0
+        fakes.account.api_calls = 0
+
+    def add_process(self, argv):
+        nbytes = _transfer_bytes(argv)
+        with self.lock:
+            self.subprocesses += 1
+            self.bytes += nbytes
+
+    def add_sleep(self, secs):
+        with self.lock:
+            self.sleep_s += secs
+
+counters = Counters()
+
+
+_RealPopen = subprocess.Popen
+_real_sleep = time.sleep
+
+class CountingPopen(_RealPopen):
+    def __init__(self, args, *pargs, **kwargs):
+        argv = args if isinstance(args, (list, tuple)) else [args]
+        counters.add_process(list(argv))
+        _RealPopen.__init__(self, args, *pargs, **kwargs)
+
+def _counting_sleep(secs):
+    counters.add_sleep(secs)
+
+def install():
+    '''Route subprocess creation and sleeps through the counters.
+    subprocess.call looks Popen up in the module namespace, so patching
+    the attribute covers both.'''
+    subprocess.Popen = CountingPopen
+    time.sleep = _counting_sleep
+
+def uninstall():
+    subprocess.Popen = _RealPopen
+    time.sleep = _real_sleep
+
+
+def measure(fn, repeat=1, setup=None, teardown=None):
+    '''Run fn repeat times, returning the metrics of the median run by
+    wall time. setup and teardown run around each repetition but
+    outside of the measurement.'''
+    runs = []
+    for rep in range(repeat):
+        if setup is not None: setup()
+        counters.reset()
+        start = time.time()
+        retcode = fn()
+        wall = time.time() - start
+        runs.append({
+                'wall_s' : wall,
+                'subprocesses' : counters.subprocesses,
+                'bytes' : counters.bytes,
+                'api_calls' : fakes.account.api_calls,
+                'sleep_s' : counters.sleep_s,
+                'ok' : (retcode is None or retcode == 0),
+                })
+        if teardown is not None: teardown()
+    runs.sort(key=lambda r: r['wall_s'])
+    return runs[len(runs)/2]
+
+
+def save(results, path):
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=4, sort_keys=True)
+
+def load(path):
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+def compare(results, baseline, threshold=0.2, min_wall_s=0.05):
+    '''Compare results against baseline, returning a list of
+    (backend, op, metric, baseline value, new value) tuples for every
+    metric that grew by more than threshold (a fraction). Wall time
+    differences below min_wall_s are treated as noise.'''
+    regressions = []
+    for backend, ops in results['results'].iteritems():
+        base_ops = baseline.get('results', {}).get(backend, {})
+        for op, metrics in ops.iteritems():
+            if op not in base_ops: continue
+            for metric in Metrics:
+                if metric not in metrics or metric not in base_ops[op]: continue
+                old, new = base_ops[op][metric], metrics[metric]
+                if new <= old * (1.0 + threshold): continue
+                if metric == 'wall_s' and (new - old) < min_wall_s: continue
+                regressions.append( (backend, op, metric, old, new) )
+    return regressions
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""
+Usage: bench/redis_profiles.py [--ops=50000] [--value-size=1024]
+                               [--profiles=snapshot,memory,aof,replica]
+                               [--redis-server=redis-server] [--output=redis-profiles.json]
+
+Compares write latency of the Redis deployment profiles used by the
+sirikata_redis node types against a local redis-server. Each profile
+is rendered with the same settings the puppet template would produce,
+started on a local port with its data in a temporary directory, and
+sent a stream of SETs from a single client, recording the latency of
+every request. We report the median, tail percentiles and the worst
+request, which is where fork-induced stalls from snapshots show up.
+
+The snapshot profile approximates the stock config: its save rules
+are scaled down ('save 1 1000') so snapshots actually happen within
+the benchmark's run time. For the replica profile, writes go to an
+in-memory master with the replica attached, and reads are measured
+against the replica.
+"""
+
+import os, sys, shutil, socket, subprocess, tempfile, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fakes
+# Importing cluster requires boto even though we don't use EC2 here
+fakes.install_boto()
+
+import cluster.util.config as config
+import cluster.ec2.redisconf as redisconf
+import harness
+
+BasePort = 16379
+
+
+class Client(object):
+    '''Minimal blocking Redis client, enough to time individual requests.'''
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fp = self.sock.makefile('rb')
+
+    def command(self, *args):
+        req = '*%d\r\n' % len(args) + ''.join(['$%d\r\n%s\r\n' % (len(str(a)), a) for a in args])
+        self.sock.sendall(req)
+        return self._reply()
+
+    def _reply(self):
+        line = self.fp.readline()
+        kind, rest = line[0], line[1:-2]
+        if kind == '-': raise Exception(rest)
+        if kind in '+:': return rest
+        if kind == '$':
+            if int(rest) < 0: return None
+            val = self.fp.read(int(rest) + 2)
+            return val[:-2]
+        if kind == '*':
+            return [self._reply() for x in range(int(rest))]
+        raise Exception("Unexpected reply from redis: %s" % line)
+
+    def close(self):
+        self.sock.close()
+
+
+def profile_settings(profile, workdir, port, master_port=None):
+    '''Settings for running a profile locally.'''
+    if profile == 'snapshot':
+        settings = redisconf.settings('memory', 'm1.large')
+        settings['save'] = '1 1000'
+    elif profile == 'replica':
+        settings = redisconf.settings('replica', 'm1.large', master='127.0.0.1')
+        settings['slaveof'] = '127.0.0.1 %d' % (master_port)
+    else:
+        settings = redisconf.settings(profile, 'm1.large')
+    # Run in the foreground out of a scratch directory
+    datadir = os.path.join(workdir, str(port))
+    os.makedirs(datadir)
+    settings.update({
+            'daemonize' : 'no',
+            'port' : port,
+            'bind' : '127.0.0.1',
+            'dir' : datadir,
+            'pidfile' : os.path.join(datadir, 'redis.pid'),
+            'logfile' : os.path.join(datadir, 'redis.log'),
+            })
+    return settings
+
+def start_server(redis_server, workdir, profile, port, master_port=None):
+    settings = profile_settings(profile, workdir, port, master_port=master_port)
+    conf_path = os.path.join(settings['dir'], 'redis.conf')
+    with open(conf_path, 'w') as fp:
+        fp.write(redisconf.render(settings))
+    proc = subprocess.Popen([redis_server, conf_path])
+    for x in range(100):
+        try:
+            client = Client(port)
+            client.command('PING')
+            return proc, client
+        except socket.error:
+            time.sleep(0.05)
+    proc.kill()
+    raise Exception("redis-server for profile %s didn't start" % (profile))
+
+def stop_server(proc, client):
+    client.close()
+    proc.terminate()
+    proc.wait()
+
+def timed(client, nops, fn):
+    latencies = []
+    for idx in xrange(nops):
+        start = time.time()
+        fn(client, idx)
+        latencies.append(time.time() - start)
+    return latencies
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return {
+        'ops' : len(latencies),
+        'ops_per_s' : len(latencies) / sum(latencies),
+        'p50_ms' : pct(0.5),
+        'p99_ms' : pct(0.99),
+        'p999_ms' : pct(0.999),
+        'max_ms' : latencies[-1] * 1000,
+        }
+
+def bench_profile(redis_server, workdir, profile, nops, value):
+    set_op = lambda client, idx: client.command('SET', 'object:%d' % idx, value)
+    get_op = lambda client, idx: client.command('GET', 'object:%d' % idx)
+
+    results = {}
+    if profile == 'replica':
+        master, master_client = start_server(redis_server, workdir, 'memory', BasePort)
+        replica, replica_client = start_server(redis_server, workdir, 'replica', BasePort + 1, master_port=BasePort)
+        try:
+            # Wait for the initial sync
+            while 'master_link_status:up' not in replica_client.command('INFO'):
+                time.sleep(0.1)
+            results['set'] = summarize(timed(master_client, nops, set_op))
+            # Let the replica catch up before reading from it
+            time.sleep(1)
+            results['get'] = summarize(timed(replica_client, nops, get_op))
+        finally:
+            stop_server(replica, replica_client)
+            stop_server(master, master_client)
+    else:
+        proc, client = start_server(redis_server, workdir, profile, BasePort)
+        try:
+            results['set'] = summarize(timed(client, nops, set_op))
+            results['get'] = summarize(timed(client, nops, get_op))
+        finally:
+            stop_server(proc, client)
+    return results
+
+
+def main(args):
+    kwargs = {}
+    for arg in args:
+        if not arg.startswith('--'):
+            print __doc__
+            return 1
+        if '=' in arg:
+            k,v = arg[2:].split('=', 1)
+        else:
+            k,v = (arg[2:], True)
+        kwargs[k] = v
+
+    nops = int(config.kwarg_or_default('ops', kwargs, default=50000))
+    value_size = int(config.kwarg_or_default('value-size', kwargs, default=1024))
+    profiles = config.kwarg_or_default('profiles', kwargs, default='snapshot,memory,aof,replica').split(',')
+    redis_server = config.kwarg_or_default('redis-server', kwargs, default='redis-server')
+    output = config.kwarg_or_default('output', kwargs, default='redis-profiles.json')
+
+    workdir = tempfile.mkdtemp(prefix='sirikata-redis-bench-')
+    value = 'x' * value_size
+    results = { 'meta' : { 'time' : time.time(), 'ops' : nops, 'value_size' : value_size }, 'results' : {} }
+    try:
+        for profile in profiles:
+            print "Benchmarking Redis profile %s..." % (profile)
+            results['results'][profile] = bench_profile(redis_server, os.path.join(workdir, profile), profile, nops, value)
+    except OSError:
+        print "Couldn't run %s, is Redis installed?" % (redis_server)
+        return 1
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    harness.save(results, output)
+
+    print
+    print "%-10s %-4s %10s %9s %9s %9s %9s" % ('profile', 'op', 'ops/s', 'p50_ms', 'p99_ms', 'p999_ms', 'max_ms')
+    for profile in profiles:
+        for op, m in sorted(results['results'][profile].items(), reverse=True):
+            print "%-10s %-4s %10.0f %9.3f %9.3f %9.3f %9.3f" % (profile, op, m['ops_per_s'], m['p50_ms'], m['p99_ms'], m['p999_ms'], m['max_ms'])
+    print
+    print "Results written to %s" % (output)
+    return 0
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
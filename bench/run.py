@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+"""
+Usage: bench/run.py [--nodes=4] [--repeat=3] [--archive-mb=8] [--latency=0]
+                    [--backends=adhoc,ec2,local] [--output=bench-results.json]
+                    [--baseline=bench/baseline.json] [--threshold=0.2]
+                    [--save-baseline]
+
+Benchmarks the orchestration hot paths (add service, sync sirikata,
+wait ready, ...) against an adhoc cluster of localhost nodes, an EC2
+cluster backed by a fake EC2 API and ssh layer, and a local cluster of
+virtual nodes that runs everything without ssh. For each operation
+we record wall time, subprocesses spawned, bytes pushed and EC2 API
+calls, write them to the output file and compare against the baseline,
+exiting with a non-zero code if any metric regressed by more than the
+threshold.
+
+--latency adds a fixed delay (in seconds) to each fake ssh/rsync
+invocation to model a network round trip. --save-baseline stores this
+run's results as the new baseline.
+"""
+
+import os, sys, shutil, subprocess, tempfile, time, getpass
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fakes
+# Must happen before cluster is imported since cluster.ec2 checks for boto
+fakes.install_boto()
+
+import cluster.util.config as config
+import cluster.adhoc.nodes as adhoc_nodes
+import cluster.local.nodes as local_nodes
+import cluster.ec2.nodes as ec2_nodes
+import cluster.ec2.sirikata as ec2_sirikata
+import cluster.ec2.client as ec2_client
+from cluster.adhoc.groupconfig import AdHocGroupConfig
+from cluster.ec2.groupconfig import EC2GroupConfig
+import harness
+
+
+def make_archive(workdir, size_mb):
+    '''Build an installed-Sirikata-like tree and package it.'''
+    installed = os.path.join(workdir, 'installed')
+    for sub in ['bin', 'lib', 'share']:
+        os.makedirs(os.path.join(installed, sub))
+    with open(os.path.join(installed, 'lib', 'libpayload.so'), 'wb') as fp:
+        fp.write(os.urandom(size_mb * 1024 * 1024))
+    with open(os.path.join(installed, 'bin', 'space'), 'w') as fp:
+        fp.write('#!/bin/sh\n')
+    subprocess.check_call(['tar', '-cjf', 'sirikata.tar.bz2', './bin', './lib', './share'], cwd=installed)
+    return os.path.join(installed, 'sirikata.tar.bz2')
+
+
+def bench_adhoc(workdir, archive, nnodes, repeat):
+    os.environ['BENCH_REMOTE'] = 'local'
+
+    user = getpass.getuser()
+    node_specs = []
+    for idx in range(nnodes):
+        base = os.path.join(workdir, 'adhoc', 'node%d' % idx)
+        for sub in ['sirikata', 'work', 'scratch']:
+            os.makedirs(os.path.join(base, sub))
+        node_specs.append({
+                'id' : 'node%d' % idx,
+                'dns_name' : 'localhost',
+                'sirikata_path' : os.path.join(base, 'sirikata'),
+                'default_working_path' : os.path.join(base, 'work'),
+                'workspace_path' : os.path.join(base, 'scratch'),
+                })
+    cc = AdHocGroupConfig('bench-adhoc', nodes=node_specs, username=user,
+                          default_sirikata_path=node_specs[0]['sirikata_path'],
+                          default_work_path=node_specs[0]['default_working_path'],
+                          default_scratch_path=node_specs[0]['workspace_path'])
+    cc.save()
+
+    service_names = ['bench%d' % idx for idx in range(nnodes)]
+    def add_services():
+        for idx,sname in enumerate(service_names):
+            ret = adhoc_nodes.add_service(cc, sname, 'node%d' % idx, '/bin/sleep', '600', **{'force-daemonize' : True})
+            if ret != 0: return ret
+        return 0
+    def service_status():
+        for sname in service_names:
+            ret = adhoc_nodes.service_status(cc, sname)
+            if ret != 0: return ret
+        return 0
+    def remove_services():
+        for sname in service_names:
+            ret = adhoc_nodes.remove_service(cc, sname)
+            if ret != 0: return ret
+        return 0
+
+    results = {}
+    results['sync sirikata'] = harness.measure(lambda: adhoc_nodes.sync_sirikata(cc, archive), repeat=repeat)
+    results['add service'] = harness.measure(add_services, repeat=repeat, teardown=remove_services)
+    add_services()
+    results['service status'] = harness.measure(service_status, repeat=repeat)
+    results['remove service'] = harness.measure(remove_services, repeat=repeat, setup=add_services)
+
+    # The same operations through the node agents, with the forwarded
+    # connections already open as they would be after the first command
+    results['agent install'] = harness.measure(lambda: adhoc_nodes.agent_install(cc), repeat=1)
+    for node in cc.nodes: adhoc_nodes.agent_connection(cc, node)
+    results['add service (agent)'] = harness.measure(add_services, repeat=repeat, teardown=remove_services)
+    add_services()
+    results['service status (agent)'] = harness.measure(service_status, repeat=repeat)
+    results['remove service (agent)'] = harness.measure(remove_services, repeat=repeat, setup=add_services)
+
+    # Pulling a file off a node: a new ssh running cat vs. streaming it
+    # from the agent
+    node = cc.nodes[0]
+    payload = os.path.join(cc.workspace_path(node), 'payload')
+    with open(payload, 'wb') as fp:
+        fp.write(os.urandom(16 * 1024 * 1024))
+    def read_ssh():
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.call(['ssh', cc.node_ssh_address(node), 'cat', payload], stdout=devnull)
+    def read_agent():
+        with open(os.devnull, 'wb') as devnull:
+            adhoc_nodes.agent_connection(cc, node).stream(payload, devnull)
+    results['read file (ssh)'] = harness.measure(read_ssh, repeat=repeat)
+    results['read file (agent)'] = harness.measure(read_agent, repeat=repeat)
+
+    adhoc_nodes.agent_remove(cc)
+    cc.delete()
+    return results
+
+
+def bench_local(workdir, archive, nnodes, repeat):
+    local_nodes.create('bench-local', nnodes, os.path.join(workdir, 'local'))
+    cc = local_nodes.LocalGroupConfig('bench-local')
+
+    service_names = ['bench%d' % idx for idx in range(nnodes)]
+    def add_services():
+        for idx,sname in enumerate(service_names):
+            ret = local_nodes.add_service(cc, sname, 'node-%d' % idx, '/bin/sleep', '600', **{'force-daemonize' : True})
+            if ret != 0: return ret
+        return 0
+    def service_status():
+        for sname in service_names:
+            ret = local_nodes.service_status(cc, sname)
+            if ret != 0: return ret
+        return 0
+    def remove_services():
+        for sname in service_names:
+            ret = local_nodes.remove_service(cc, sname)
+            if ret != 0: return ret
+        return 0
+
+    results = {}
+    results['sync sirikata'] = harness.measure(lambda: local_nodes.sync_sirikata(cc, archive), repeat=repeat)
+    results['add service'] = harness.measure(add_services, repeat=repeat, teardown=remove_services)
+    add_services()
+    results['service status'] = harness.measure(service_status, repeat=repeat)
+    results['remove service'] = harness.measure(remove_services, repeat=repeat, setup=add_services)
+    cc.delete()
+    return results
+
+
+def bench_ec2(workdir, archive, nnodes, repeat):
+    os.environ['BENCH_REMOTE'] = 'noop'
+    fakes.patch_cluster()
+
+    pemfile = os.path.join(workdir, 'bench.pem')
+    open(pemfile, 'w').close()
+    # Some handlers call each other without passing the pem file along
+    config.SIRIKATA_CLUSTER_PEMFILE = pemfile
+    puppet_path = os.path.join(workdir, 'puppet')
+
+    cc = EC2GroupConfig('bench-ec2', size=nnodes, keypair='bench',
+                        instance_type='m1.large', group='bench',
+                        ami='ami-bench', puppet_master='puppet.example.com')
+    cc.save()
+
+    def reset_nodes():
+        for key in ['reservation', 'instances', 'instance_props', 'spot', 'services', 'placement']:
+            if key in cc.state: del cc.state[key]
+        fakes.account.reset()
+        ec2_client.reset()
+    def boot():
+        return ec2_nodes.boot(cc, pem=pemfile)
+    def wait_ready():
+        return ec2_nodes.wait_nodes_ready(cc, pem=pemfile)
+
+    service_names = ['bench%d' % idx for idx in range(nnodes)]
+    def add_services():
+        for idx,sname in enumerate(service_names):
+            ret = ec2_nodes.add_service(cc, sname, str(idx), '/home/ubuntu/sirikata/bin/space', '--pid-file=PIDFILE', pem=pemfile)
+            if ret != 0: return ret
+        return 0
+    def remove_services():
+        return ec2_nodes.remove_all_services(cc, pem=pemfile)
+
+    results = {}
+    results['nodes boot'] = harness.measure(boot, repeat=repeat, setup=reset_nodes)
+    def boot_placed():
+        cc.placement_strategy, cc.zone_selection = 'cluster', 'fulfillment'
+        try:
+            return boot()
+        finally:
+            cc.placement_strategy, cc.zone_selection = None, 'random'
+    results['nodes boot (placement)'] = harness.measure(boot_placed, repeat=repeat, setup=reset_nodes)
+    def boot_throttled():
+        fakes.account.throttle_every = 3
+        try:
+            return boot()
+        finally:
+            fakes.account.throttle_every = None
+    results['nodes boot (throttled)'] = harness.measure(boot_throttled, repeat=repeat, setup=reset_nodes)
+    results['wait ready'] = harness.measure(wait_ready, repeat=repeat)
+    results['add service'] = harness.measure(add_services, repeat=repeat, teardown=remove_services)
+    results['remove service'] = harness.measure(remove_services, repeat=repeat, setup=add_services)
+    results['sync sirikata'] = harness.measure(lambda: ec2_sirikata.sync_sirikata(archive, **{'puppet-path' : puppet_path, 'notify-puppets' : cc, 'pem' : pemfile}), repeat=repeat)
+    cc.delete()
+    return results
+
+
+Backends = {
+    'adhoc' : bench_adhoc,
+    'ec2' : bench_ec2,
+    'local' : bench_local,
+    }
+
+def main(args):
+    kwargs = {}
+    for arg in args:
+        if not arg.startswith('--'):
+            print __doc__
+            return 1
+        if '=' in arg:
+            k,v = arg[2:].split('=', 1)
+        else:
+            k,v = (arg[2:], True)
+        kwargs[k] = v
+
+    nnodes = int(config.kwarg_or_default('nodes', kwargs, default=4))
+    repeat = int(config.kwarg_or_default('repeat', kwargs, default=3))
+    archive_mb = int(config.kwarg_or_default('archive-mb', kwargs, default=8))
+    latency = config.kwarg_or_default('latency', kwargs, default=None)
+    backends = config.kwarg_or_default('backends', kwargs, default='adhoc,ec2,local').split(',')
+    output = config.kwarg_or_default('output', kwargs, default='bench-results.json')
+    baseline_path = config.kwarg_or_default('baseline', kwargs, default=os.path.join(BENCH_DIR, 'baseline.json'))
+    threshold = float(config.kwarg_or_default('threshold', kwargs, default=0.2))
+    save_baseline = bool(config.kwarg_or_default('save-baseline', kwargs, default=False))
+
+    output = os.path.abspath(output)
+    baseline_path = os.path.abspath(baseline_path)
+
+    workdir = tempfile.mkdtemp(prefix='sirikata-cluster-bench-')
+    origdir = os.getcwd()
+    try:
+        # Cluster configs are saved to the current directory, keep them out of the way
+        os.chdir(workdir)
+        fakes.install_shims(os.path.join(workdir, 'bin'))
+        if latency is not None: os.environ['BENCH_LATENCY'] = str(latency)
+        archive = make_archive(workdir, archive_mb)
+
+        results = {
+            'meta' : {
+                'time' : time.time(),
+                'nodes' : nnodes,
+                'repeat' : repeat,
+                'archive_mb' : archive_mb,
+                'latency' : latency,
+                },
+            'results' : {}
+            }
+        harness.install()
+        try:
+            for backend in backends:
+                print "Benchmarking %s..." % (backend)
+                results['results'][backend] = Backends[backend](workdir, archive, nnodes, repeat)
+        finally:
+            harness.uninstall()
+    finally:
+        os.chdir(origdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    harness.save(results, output)
+
+    print
+    print "%-8s %-24s %10s %8s %12s %6s %8s" % ('backend', 'operation', 'wall_s', 'procs', 'bytes', 'api', 'sleep_s')
+    for backend, ops in sorted(results['results'].items()):
+        for op, m in sorted(ops.items()):
+            print "%-8s %-24s %10.3f %8d %12d %6d %8.1f%s" % (backend, op, m['wall_s'], m['subprocesses'], m['bytes'], m['api_calls'], m['sleep_s'], '' if m['ok'] else '  FAILED')
+    print
+    print "Results written to %s" % (output)
+
+    if save_baseline:
+        harness.save(results, baseline_path)
+        print "Saved as baseline %s" % (baseline_path)
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print "No baseline found at %s, skipping comparison" % (baseline_path)
+        return 0
+
+    regressions = harness.compare(results, harness.load(baseline_path), threshold=threshold)
+    if not regressions:
+        print "No regressions against baseline (threshold %d%%)" % (threshold * 100)
+        return 0
+    print "Regressions against baseline (threshold %d%%):" % (threshold * 100)
+    for backend, op, metric, old, new in regressions:
+        print "  %s %s: %s %s -> %s" % (backend, op, metric, old, new)
+    return 1
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
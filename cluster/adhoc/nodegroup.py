@@ -1,5 +1,7 @@
 import nodes
 import cluster.util
+import cluster.util.results as results
+import cluster.util.dag as dag
 from groupconfig import AdHocGroupConfig
 
 class NodeGroup(cluster.util.NodeGroup):
@@ -11,10 +13,23 @@ class NodeGroup(cluster.util.NodeGroup):
         ('adhoc ssh', nodes.ssh),
         ('adhoc sync sirikata', nodes.sync_sirikata),
         ('adhoc sync files', nodes.sync_files),
+        ('adhoc gather', nodes.gather),
+        ('adhoc logs follow', nodes.logs_follow),
         ('adhoc add service', nodes.add_service),
+        ('adhoc services up', nodes.services_up),
         ('adhoc service status', nodes.service_status),
+        ('adhoc services rolling-restart', nodes.services_rolling_restart),
         ('adhoc remove service', nodes.remove_service),
+        ('adhoc agent install', nodes.agent_install),
+        ('adhoc agent remove', nodes.agent_remove),
         ('adhoc destroy', nodes.destroy),
+        ('adhoc facts refresh', nodes.facts_refresh),
+        ('adhoc facts show', nodes.facts_show),
+        ('adhoc network probe', nodes.network_probe),
+        ('adhoc versions install', nodes.versions_install),
+        ('adhoc versions activate', nodes.versions_activate),
+        ('adhoc versions list', nodes.versions_list),
+        ('adhoc versions gc', nodes.versions_gc),
         ]
 
     ConfigClass = AdHocGroupConfig
@@ -25,29 +40,47 @@ class NodeGroup(cluster.util.NodeGroup):
 
     def boot(self, **kwargs):
         # Nothing to do, we assume the lifecycle for ad-hoc clusters are managed separately
-        return True
+        return results.Result('adhoc boot', retcode=0).finish()
 
     def nodes(self, **kwargs):
         return nodes.members_info_data(self.config)
 
     def sync_sirikata(self, path, **kwargs):
-        return (nodes.sync_sirikata(self.config, path) == 0)
+        return results.wrap('adhoc sync sirikata', nodes.sync_sirikata(self.config, path))
 
     def sync_files(self, target, src, dest, **kwargs):
-        return (nodes.sync_files(self.config, target, src, dest, **kwargs) == 0)
+        return results.wrap('adhoc sync files', nodes.sync_files(self.config, target, src, dest, **kwargs))
+
+    def gather(self, remote_path, local_dir, **kwargs):
+        return results.wrap('adhoc gather', nodes.gather(self.config, remote_path, local_dir, **kwargs))
+
+    def log_streams(self, service_names=None, lines=10, pattern=None, **kwargs):
+        return nodes.log_streams(self.config, service_names, lines=lines, pattern=pattern)
 
     def add_service(self, name, target, command, user=None, cwd=None, **kwargs):
         nkwargs = dict(kwargs)
         if user is not None: nkwargs['user'] = user
         if cwd is not None: nkwargs['cwd'] = cwd
-        return (nodes.add_service(self.config, name, target, *command, **nkwargs) == 0)
+        return results.wrap('adhoc add service', nodes.add_service(self.config, name, target, *command, **nkwargs))
+
+    def start_services(self, specs, parallelism=None, timeout=300, **kwargs):
+        return results.wrap('adhoc services up', nodes.start_services(self.config, dag.validate(specs), parallelism=parallelism, timeout=timeout, **kwargs))
 
-    def service_status(self, name, **kwargs):
-        return (nodes.service_status(self.config, name) == 0)
+    def probe(self, checks, **kwargs):
+        return nodes.probe_services(self.config, checks, **kwargs)
+
+    def service_status(self, *names, **kwargs):
+        return results.wrap('adhoc service status', nodes.service_status(self.config, *names, **kwargs))
+
+    def restart_service(self, name, version=None, **kwargs):
+        return nodes.restart_service(self.config, name, version=version, **kwargs)
 
     def remove_service(self, name, **kwargs):
-        return (nodes.remove_service(self.config, name) == 0)
+        return results.wrap('adhoc remove service', nodes.remove_service(self.config, name))
+
+    def facts(self, node=None, ttl=None, **kwargs):
+        return nodes.node_facts(self.config, node, ttl=ttl, **kwargs)
 
     def terminate(self, **kwargs):
         # Nothing to do, we assume the lifecycle for ad-hoc clusters are managed separately
-        return True
+        return results.Result('adhoc terminate', retcode=0).finish()
@@ -5,7 +5,20 @@ import cluster.util.config as config
 import cluster.util.data as data
 import cluster.util.arguments as arguments
 import cluster.util.sirikata as util_sirikata
-import json, os, time, subprocess
+import cluster.util.trace as trace
+import cluster.util.results as results
+import cluster.util.parallel as parallel
+import cluster.util.transfer as transfer
+import cluster.util.logs as logs
+import cluster.util.dag as dag
+import cluster.util.resources as resources
+import cluster.util.agent as agent
+import cluster.util.facts as facts
+import cluster.util.network as network
+import cluster.util.journal as journal
+import cluster.util.versions as versions
+import cluster.util.services as services
+import json, os, sys, time, subprocess
 import re
 
 def ssh_escape(x):
@@ -63,7 +76,9 @@ def members_info(*args, **kwargs):
     """
 
     instances = members_info_data(*args, **kwargs)
-    print json.dumps(instances, indent=4)
+    if results.get_format() == 'text':
+        print json.dumps(instances, indent=4)
+    return results.Result('adhoc members info', retcode=0, data=instances)
 
 
 
@@ -77,38 +92,77 @@ def node_ssh(*args, **kwargs):
 
     name, cc = name_and_config(name_or_config)
 
-    cmd = ["ssh", cc.node_ssh_address(cc.get_node(idx_or_name_or_node))] + [ssh_escape(x) for x in remote_cmd]
-    return subprocess.call(cmd)
+    node = cc.get_node(idx_or_name_or_node)
+    conn = agent_connection(cc, node) if remote_cmd else None
+    if conn is not None:
+        try:
+            # Same quoting as ssh, which hands the command to a shell
+            with trace.span('node ssh', node=node['id']):
+                retcode, out, err = conn.run(['/bin/bash', '-c', ' '.join([ssh_escape(x) for x in remote_cmd])])
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            return retcode
+        except agent.AgentError as e:
+            agent.lost((cc.name, node['id']), e)
+    cmd = ["ssh", cc.node_ssh_address(node)] + [ssh_escape(x) for x in remote_cmd]
+    with trace.span('node ssh', node=node['id']):
+        return subprocess.call(cmd)
+
+def agent_connection(cc, node):
+    '''Get a connection to the node's agent, or None if it doesn't have
+    one (see agent install) or it can't be reached.'''
+    socket_path = cc.state.get('agent', {}).get(node['id'])
+    if socket_path is None: return None
+    return agent.connection((cc.name, node['id']), node['id'], ['ssh', cc.node_ssh_address(node)], socket_path)
 
 
 def ssh(*args, **kwargs):
-    """adhoc ssh cluster_name_or_config [required additional arguments give command just like with real ssh]
+    """adhoc ssh cluster_name_or_config [--parallel=1] [required additional arguments give command just like with real ssh]
 
-    Run an SSH command on every node in the cluster. Note that this
-    currently doesn't parallelize at all, so it can be a bit
-    slow. This won't do ssh sessions -- you *must* provide a command
-    to execute.
+    Run an SSH command on every node in the cluster. By default nodes
+    are handled one at a time; use --parallel=N to run on up to N
+    nodes at once (output from different nodes may interleave). This
+    won't do ssh sessions -- you *must* provide a command to execute.
     """
 
     name_or_config, remote_cmd = arguments.parse_or_die(ssh, [object], rest=True, *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=1))
     if not remote_cmd:
         print "You need to add a command to execute across all the nodes."
-        exit(1)
+        return 1
 
     name, cc = name_and_config(name_or_config)
-    for inst_idx in range(len(cc.nodes)):
-        node_ssh(cc, inst_idx, *remote_cmd)
+
+    result = results.Result('adhoc ssh')
+    def run_on_node(node):
+        start = time.time()
+        retcode = node_ssh(cc, node, *remote_cmd)
+        result.add_node(node['id'], retcode, duration=time.time()-start)
+    parallel.run(run_on_node, cc.nodes, parallelism=parallelism)
+    return result.finish()
 
 
 def sync_sirikata(*args, **kwargs):
-    """adhoc sync sirikata cluster_name_or_config /path/to/installed/sirikata/or/tbz2
+    """adhoc sync sirikata cluster_name_or_config /path/to/installed/sirikata/or/tbz2 [--resume]
 
     Synchronize Sirikata binaries by copying the specified data to this cluster's nodes.
+
+    Nodes that fail to copy or extract the archive don't stop the
+    others. Progress is journaled, so --resume after a partial failure
+    only copies to and extracts on the nodes that didn't finish, as
+    long as the archive is the same.
     """
 
     name_or_config, path = arguments.parse_or_die(sync_sirikata, [object, str], *args)
+    resume = bool(config.kwarg_or_default('resume', kwargs, default=False))
 
     name, cc = name_and_config(name_or_config)
+    # Extracting through the link would change an installed version
+    # under its ID
+    linked = [node['id'] for node in cc.nodes if cc.state.get('versions', {}).get(node['id'], {}).get('active')]
+    if linked:
+        print "Nodes %s run installed versions, use versions install instead" % (', '.join(linked))
+        return 1
 
     # If they specify a directory, package it and replace the path with the package
     if os.path.isdir(path):
@@ -117,57 +171,146 @@ def sync_sirikata(*args, **kwargs):
         path = os.path.join(path, 'sirikata.tar.bz2')
 
     sirikata_archive_name = os.path.basename(path)
+    archive_size = os.path.getsize(path)
     node_archive_path = [os.path.join(cc.workspace_path(node), sirikata_archive_name) for node in cc.nodes]
 
-    for inst_idx in range(len(cc.nodes)):
+    result = results.Result('adhoc sync sirikata')
+    progress = journal.Journal(cc, 'sync sirikata', resume=resume, key=journal.file_key(path))
+    node_idxs = [inst_idx for inst_idx, node in enumerate(cc.nodes) if not progress.done(node['id'], 'extract')]
+    for inst_idx, node in enumerate(cc.nodes):
+        if inst_idx not in node_idxs: progress.skip(result, node['id'], 'extract')
+    # If we know the nodes' free space, catch nodes that can't even
+    # hold the archive before copying anything
+    short = [(node_id, node_facts['disk_free']) for node_id, node_facts in sorted(facts.cached(cc, [cc.nodes[inst_idx]['id'] for inst_idx in node_idxs]).items())
+             if node_facts.get('disk_free', archive_size) < archive_size]
+    if short:
+        for node_id, free in short:
+            print "Node %s only has %d MB free, the archive needs %d MB" % (node_id, free / 1024**2, archive_size / 1024**2)
+            result.add_node(node_id, 1, error='not enough disk space')
+        return result.finish()
+
+    copy_times = {}
+    copied = []
+    for inst_idx in node_idxs:
+        node_id = cc.nodes[inst_idx]['id']
+        if progress.done(node_id, 'copy'):
+            copy_times[inst_idx] = 0
+            copied.append(inst_idx)
+            continue
         print "Copying data to node %d" % (inst_idx)
         cmd = ['rsync', '--progress',
                path,
                cc.node_ssh_address(cc.get_node(inst_idx)) + ":" + node_archive_path[inst_idx]]
-        retcode = subprocess.call(cmd)
+        start = time.time()
+        with trace.span('copy archive', node=node_id):
+            retcode = subprocess.call(cmd)
+        copy_times[inst_idx] = time.time() - start
+        progress.mark(node_id, 'copy', retcode == 0, error='copying archive failed')
         if retcode != 0:
             print "Failed to rsync from first node to node %d" % (inst_idx)
             print "Command was:", cmd
-            return retcode
+            result.add_node(node_id, retcode, duration=copy_times[inst_idx], error='copying archive failed')
+            continue
+        copied.append(inst_idx)
 
-    for inst_idx,node in enumerate(cc.nodes):
+    for inst_idx in copied:
+        node = cc.nodes[inst_idx]
         print "Extracting data on node %d" % (inst_idx)
-        retcode = node_ssh(cc, inst_idx,
-                           'cd', cc.sirikata_path(node=node), '&&',
-                           'tar', '-xf',
-                           node_archive_path[inst_idx])
+        start = time.time()
+        with trace.span('extract archive', node=node['id']):
+            retcode = node_ssh(cc, inst_idx,
+                               'cd', cc.sirikata_path(node=node), '&&',
+                               'tar', '-xf',
+                               node_archive_path[inst_idx])
+        duration = copy_times[inst_idx] + (time.time() - start)
+        progress.mark(node['id'], 'extract', retcode == 0, error='extracting archive failed')
         if retcode != 0:
             print "Failed to extract archive on node %d" % (inst_idx)
-            return retcode
+            result.add_node(node['id'], retcode, duration=duration, bytes=archive_size, error='extracting archive failed')
+            continue
+        result.add_node(node['id'], 0, duration=duration, bytes=archive_size)
 
-    return 0
+    # Free space and the Sirikata version have changed
+    facts.forget(cc, [cc.nodes[inst_idx]['id'] for inst_idx in copied])
+    return progress.finish(result.finish())
 
 
 def sync_files(*args, **kwargs):
-    """adhoc sync files cluster_name_or_config idx_or_name_or_node target local_or_remote:/path local_or_remote:/path
-
-    Synchronize files or directories between a the local host and a cluster node.
+    """adhoc sync files cluster_name_or_config all|idx_or_name_or_node[,idx_or_name_or_node...] local_or_remote:/path local_or_remote:/path [--parallel=N] [--bwlimit=KBPS] [--node-bwlimit=KBPS] [--compress]
+
+    Synchronize files or directories between a the local host and a
+    cluster node, a list of nodes or all nodes. Transfers to multiple
+    nodes run concurrently (up to --parallel at a time). --bwlimit
+    caps the total bandwidth used across all transfers and
+    --node-bwlimit the bandwidth of each one, both in KB/s. --compress
+    compresses data on the wire.
     """
 
     name_or_config, idx_or_name_or_node, src_path, dest_path = arguments.parse_or_die(sync_files, [object, object, str, str], *args)
+    options = transfer.Options(kwargs)
 
     name, cc = name_and_config(name_or_config)
 
-    node_address = cc.node_ssh_address(cc.get_node(idx_or_name_or_node))
+    targets = transfer.split_targets(idx_or_name_or_node)
+    if targets is None:
+        node_list = cc.nodes
+    else:
+        node_list = [cc.get_node(target) for target in targets]
+
+    transfers = []
+    for node in node_list:
+        node_address = cc.node_ssh_address(node)
+        paths = [p.replace('local:', '').replace('remote:', node_address + ":") for p in [src_path, dest_path]]
+        transfers.append( (node['id'], paths[0], paths[1]) )
 
-    # Get correct values out for names
-    paths = [src_path, dest_path]
-    paths = [p.replace('local:', '').replace('remote:', node_address + ":") for p in paths]
-    src_path, dest_path = tuple(paths)
+    return transfer.run('adhoc sync files', transfers, options)
 
-    # Make a single copy onto one of the nodes
-    retcode = subprocess.call(['rsync',
-                               src_path,
-                               dest_path])
-    return retcode
+def gather(*args, **kwargs):
+    """adhoc gather cluster_name_or_config /remote/path /local/dir [--incremental] [--parallel=N] [--bwlimit=KBPS] [--node-bwlimit=KBPS] [--compress=false]
+
+    Pull a file or directory from every node concurrently into
+    /local/dir/<node id>/, e.g. to collect logs, traces and stats after
+    an experiment. Interrupted transfers are resumed and data is
+    compressed on the wire. With --incremental, only data appended to
+    files since the last gather is fetched, so collecting growing logs
+    periodically during a long run is cheap.
+    """
+
+    name_or_config, remote_path, local_dir = arguments.parse_or_die(gather, [object, str, str], *args)
+    incremental = bool(config.kwarg_or_default('incremental', kwargs, default=False))
+    options = transfer.Options(kwargs, compress=True)
+
+    name, cc = name_and_config(name_or_config)
+
+    sources = [ (node['id'], cc.node_ssh_address(node) + ':' + remote_path) for node in cc.nodes ]
+    return transfer.gather('adhoc gather', sources, local_dir, options, incremental=incremental)
+
+def log_streams(cc, service_names=None, lines=10, pattern=None):
+    '''Get a logs.Stream for each node running the services.'''
+    return [logs.Stream(node_id, ['ssh', cc.node_ssh_address(cc.get_node(node_id))], logfiles, lines=lines, pattern=pattern)
+            for node_id, logfiles in sorted(logs.service_logfiles(cc.state.get('services', {}), service_names).items())]
+
+def logs_follow(*args, **kwargs):
+    """adhoc logs follow cluster_name_or_config [service_id...] [--filter=REGEX] [--lines=10] [--lag=1.0]
+
+    Stream the logs of the cluster's services (or just the listed
+    ones) live, merged from all nodes into a single stream ordered by
+    time. Each node gets one connection and only lines matching
+    --filter (a Perl regex, applied on the node) are sent. --lines
+    sets how many existing lines of each log to start with and --lag
+    how long (in seconds) to wait for slower nodes before printing a
+    line out of order. Services need a recorded log file, see add
+    service.
+    """
+
+    name_or_config, service_names = arguments.parse_or_die(logs_follow, [object], rest=True, *args)
+    lines, pattern, lag = logs.options(kwargs)
+
+    name, cc = name_and_config(name_or_config)
+    return logs.follow(log_streams(cc, service_names, lines=lines, pattern=pattern), lag=lag)
 
 def add_service(*args, **kwargs):
-    """adhoc add service cluster_name_or_config service_id target_node|any [--user=user] [--cwd=/path/to/execute] [--] command to run
+    """adhoc add service cluster_name_or_config service_id target_node|any|near:service[,service...] [--user=user] [--cwd=/path/to/execute] [--log-file=/path/to/log] [--probe=SPEC] [--wait-ready[=SECONDS]] [--ports=name=PORT,...] [--cpus=N|--cpuset=LIST] [--memory=SIZE] [--nice=N] [--ionice=CLASS[:N]] [--] command to run
 
     Add a service to run on the cluster. The service needs to be
     assigned a unique id (a string) and takes the form of a command
@@ -180,94 +323,248 @@ def add_service(*args, **kwargs):
     user specifies the user account that should execute the service
     cwd sets the working directory for the service
 
+    A target of near:service[,service...] picks the node with the
+    lowest round trip time to the nodes running those services, as
+    measured by network probe, for services that talk to them a lot.
+
     To make handling PID files easier, any appearance of PIDFILE in
     your command arguments will be replaced with the path to the PID
     file selected. For example, you might add --pid-file=PIDFILE as an
     argument.
+
+    Similarly, LOGFILE is replaced with a log file path, which is
+    recorded so logs follow can stream the service's output. If the
+    service writes its log somewhere else, give the path with
+    --log-file.
+
+    Ports don't need to be hard-coded: each PORT is replaced with a
+    free port in 6000-10000 that no other service on the node has, and
+    PORT:name with the same port everywhere it appears (including in
+    --probe, e.g. --probe=tcp:PORT:name). PRIVATE_IP is replaced with
+    the node's private_ip property (or its hostname if it doesn't have
+    one) and NODE_INDEX with its index. Allocated ports are saved with
+    the service and freed when it is removed. --ports=name=PORT,...
+    uses the given ports for those names instead of allocating them.
+
+    --probe=SPEC saves a probe with the service, one of tcp:PORT,
+    http:PORT/path, cmd:COMMAND, log:REGEX or pidfile (see
+    cluster/util/probes.py), which service status also checks.
+    --wait-ready[=SECONDS] waits (default: up to 60 seconds) until the
+    service's process is alive and its probe passes, recording how
+    long startup took, and fails if it doesn't become ready in time.
+
+    --cpus=N, --cpuset=LIST, --memory=SIZE, --nice=N and
+    --ionice=CLASS[:N] limit the resources the service can use (see
+    cluster/util/resources.py). --cpus allocates N cores that no other
+    service on the node has, preferring cores from one NUMA node.
     """
 
     name_or_config, service_name, target_node, service_cmd = arguments.parse_or_die(add_service, [object, str, str], rest=True, *args)
     cname, cc = name_and_config(name_or_config)
+    return services.add(ServiceBackend('adhoc', cc, **kwargs), service_name, target_node, service_cmd, **kwargs)
+
+def run_script(cc, node_id, script):
+    '''Run a shell script on a node and return (retcode, output).'''
+    node = cc.get_node(node_id)
+    conn = agent_connection(cc, node)
+    with trace.span('run script', node=node_id):
+        if conn is not None:
+            try:
+                retcode, out, err = conn.run(['/bin/bash', '-s'], input=script)
+                sys.stderr.write(err)
+                return retcode, out
+            except agent.AgentError as e:
+                agent.lost((cc.name, node_id), e)
+        proc = subprocess.Popen(['ssh', cc.node_ssh_address(node), '/bin/bash', '-s'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, err = proc.communicate(script)
+    return proc.returncode, out
+
+def node_start_service(cc, node, daemon_cmd):
+    '''Run the start-stop-daemon command for a service, returning its
+    exit code.'''
+    conn = agent_connection(cc, node)
+    if conn is not None:
+        try:
+            with trace.span('start service', node=node['id']):
+                retcode, out, err = conn.start_service(daemon_cmd)
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            return retcode
+        except agent.AgentError as e:
+            agent.lost((cc.name, node['id']), e)
+    return node_ssh(cc, node, *daemon_cmd)
+
+def node_stop_service(cc, node, pidfile, cleanup=None):
+    '''Stop the service with the given pid file, sending TERM and then
+    KILL if it doesn't exit, and then run the cleanup script, if any.
+    It isn't an error if the service is already gone, since it probably
+    crashed. Returns the exit code for stopping the service.'''
+    conn = agent_connection(cc, node)
+    if conn is not None:
+        try:
+            with trace.span('stop service', node=node['id']):
+                stopped = conn.call([ { 'op' : 'stop_service', 'pidfile' : pidfile, 'schedule' : [['TERM', 6], ['KILL', 5]] } ])[0]
+            if not stopped['ok']:
+                print stopped['error']
+                return 1
+            # Like the ssh path, only clean up once the service is gone
+            if stopped['retcode'] == 0 and cleanup is not None:
+                conn.run(['/bin/bash', '-c', cleanup])
+            return stopped['retcode']
+        except agent.AgentError as e:
+            agent.lost((cc.name, node['id']), e)
+    retcode = node_ssh(cc, node,
+                       'start-stop-daemon', '--stop',
+                       '--retry', 'TERM/6/KILL/5',
+                       '--pidfile', pidfile,
+                       # oknodo allows a successful return if the
+                       # process couldn't actually be found, meaning
+                       # it probably crashed
+                       '--oknodo'
+#                       '--test',
+                       )
+    if retcode == 0 and cleanup is not None:
+        run_script(cc, node['id'], cleanup)
+    return retcode
 
-    user = config.kwarg_or_default('user', kwargs, default=None)
-    cwd = config.kwarg_or_default('cwd', kwargs, default=None)
-    force_daemonize = bool(config.kwarg_or_default('force-daemonize', kwargs, default=False))
+def node_topology(cc, node_id, **kwargs):
+    '''Get the node's cores and their NUMA nodes, as { cpu : numa
+    node }. This is looked up once and saved in the cluster state.'''
+    with cc.lock:
+        topology = cc.state.get('node-topology', {}).get(node_id)
+    if topology is None:
+        retcode, out = run_script(cc, node_id, resources.TopologyScript)
+        # JSON only has string keys
+        topology = dict([(str(cpu), numa) for cpu, numa in resources.parse_topology(out).items()])
+        with cc.lock:
+            cc.state.setdefault('node-topology', {})[node_id] = topology
+            cc.save()
+    return dict([(int(cpu), numa) for cpu, numa in topology.items()])
 
-    if not len(service_cmd):
-        print "You need to specify a command for the service"
-        return 1
+class ServiceBackend(services.Backend):
+    '''Runs services on the nodes over ssh, or their agents.'''
 
-    if 'services' not in cc.state: cc.state['services'] = {}
-    if service_name in cc.state['services']:
-        print "The requested service already exists."
-        return 1
+    def node_ids(self):
+        return [node['id'] for node in self.cc.nodes]
 
-    if not os.path.isabs(service_cmd[0]):
-        print "The path to the service's binary isn't absolute (%s)" % service_cmd[0]
-        print args
-        print service_cmd
-        return 1
+    def node_id(self, node):
+        return self.cc.get_node(node)['id']
 
-    target_node = cc.get_node(target_node)
-    # Can now get default values that depend on the node
-    if user is None: user = cc.user(target_node)
-    if cwd is None: cwd = cc.default_working_path(target_node)
-
-    service_binary = service_cmd[0]
-
-    pidfile = os.path.join(cc.workspace_path(target_node), 'sirikata_%s.pid' % (service_name) )
-
-    daemon_cmd = ['start-stop-daemon', '--start',
-                  '--pidfile', pidfile,
-                  '--user', user,
-                  '--chdir', cwd,
-                  # '--test'
-                  ]
-    if force_daemonize:
-        daemon_cmd += ['--background', '--make-pidfile']
-    daemon_cmd += ['--exec', service_binary,
-                   '--'] + [arg.replace('PIDFILE', pidfile).replace('FQDN', cc.hostname(node=target_node)) for arg in service_cmd[1:]]
-    retcode = node_ssh(cc, target_node,
-                       *daemon_cmd)
-    if retcode != 0:
-        print "Failed to add cluster service"
-        return retcode
-
-    # Save a record of this service so we can find it again when we need to stop it.
-    cc.state['services'][service_name] = {
-        'node' : target_node['id'],
-        'binary' : service_binary
-        }
-    cc.save()
+    def node_index(self, node_id):
+        return self.cc.nodes.index(self.cc.get_node(node_id))
 
-    return retcode
+    def private_ip(self, node_id):
+        node = self.cc.get_node(node_id)
+        return node.get('private_ip', self.cc.hostname(node=node))
 
-def service_status(*args, **kwargs):
-    """adhoc service status cluster_name_or_config service_id [--pem=/path/to/pem.key]
+    def workspace(self, node_id):
+        return self.cc.workspace_path(self.cc.get_node(node_id))
+
+    def default_cwd(self, node_id):
+        return self.cc.default_working_path(self.cc.get_node(node_id))
+
+    def default_user(self, node_id):
+        return self.cc.user(self.cc.get_node(node_id))
+
+    def substitute(self, node_id, arg):
+        return arg.replace('FQDN', self.cc.hostname(node=self.cc.get_node(node_id)))
+
+    def sirikata_path(self, node_id):
+        return self.cc.sirikata_path(node=self.cc.get_node(node_id))
+
+    def version_store(self, node_id):
+        return versions.store_path(self.cc.workspace_path(self.cc.get_node(node_id)))
+
+    def run_script(self, node_id, script):
+        return run_script(self.cc, node_id, script)
+
+    def start_service(self, node_id, daemon_cmd, cwd):
+        return node_start_service(self.cc, self.cc.get_node(node_id), daemon_cmd)
+
+    def stop_service(self, node_id, pidfile, cleanup=None):
+        return node_stop_service(self.cc, self.cc.get_node(node_id), pidfile, cleanup=cleanup)
+
+    def topology(self, node_id):
+        return node_topology(self.cc, node_id, **self.kwargs)
 
-    Check the status of a service from the cluster. Returns 0 if it is
-    active and running, non-zero otherwise.
+def probe_services(cc, checks, **kwargs):
+    '''Evaluate readiness probes for services, given as a list of
+    (service name, probe), with one script per node. Returns
+    { service name : passed }.'''
+    return services.probe(ServiceBackend('adhoc', cc, **kwargs), checks)
+
+def start_services(cc, specs, parallelism=None, timeout=300, **kwargs):
+    '''Start services described by specs (see cluster.util.dag) in
+    dependency order.'''
+    return services.start(ServiceBackend('adhoc', cc, **kwargs), specs, parallelism=parallelism, timeout=timeout, **kwargs)
+
+def services_up(*args, **kwargs):
+    """adhoc services up cluster_name_or_config services.json [--parallel=N] [--timeout=300]
+
+    Start the services described in services.json, a list of
+    services with a name, target, command, the services they depend_on
+    and a readiness probe (tcp:PORT, pidfile or log:REGEX). Each
+    service is started as soon as all of its dependencies pass their
+    probes, so independent services start in parallel. --parallel
+    limits how many services are started at once and --timeout how
+    long to wait for a service to become ready. Reports when each
+    service became ready, the critical path and the total time.
     """
 
-    name_or_config, service_name = arguments.parse_or_die(service_status, [object, str], *args)
+    name_or_config, spec_path = arguments.parse_or_die(services_up, [object, str], *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+    timeout = float(config.kwarg_or_default('timeout', kwargs, default=300))
+    nkwargs = dict([(k, v) for k, v in kwargs.items() if k not in ['parallel', 'timeout']])
 
-    cname, cc = name_and_config(name_or_config)
+    name, cc = name_and_config(name_or_config)
+    return start_services(cc, dag.load(spec_path), parallelism=parallelism, timeout=timeout, **nkwargs)
 
-    if service_name not in cc.state['services']:
-        print "Couldn't find record of service '%s'" % (service_name)
-        return 1
+def service_status(*args, **kwargs):
+    """adhoc service status cluster_name_or_config service_id|all [service_id...]
+
+    Check the status of services from the cluster. A service is
+    healthy if its process is alive and the probe saved with it, if
+    any, passes. Returns 0 if all the services are healthy, non-zero
+    otherwise. Checks for services on the same node are batched into a
+    single script.
+    """
 
-    target_node = cc.get_node( cc.state['services'][service_name]['node'] )
-    pidfile = os.path.join(cc.workspace_path(target_node), 'sirikata_%s.pid' % (service_name) )
+    name_or_config, service_name, more_names = arguments.parse_or_die(service_status, [object, str], rest=True, *args)
 
-    # Check if the process can respond to signals, i.e. just if it is alive
-    retcode = node_ssh(cc, target_node,
-                       '/bin/bash', '-c',
-                       "kill -0 `grep -o '[0-9]*' %s`" % (pidfile)
-                       )
+    cname, cc = name_and_config(name_or_config)
+    return services.status(ServiceBackend('adhoc', cc, **kwargs), service_name, more_names)
+
+def restart_service(cc, service_name, version=None, **kwargs):
+    '''Stop a service and start it again with the command and options
+    it was added with, on the same ports and cores. With version, the
+    command is pointed at the Sirikata installed in that directory
+    instead of the node's usual one (see cluster.util.rolling).
+    Returns True on success.'''
+    return services.restart(ServiceBackend('adhoc', cc, **kwargs), service_name, version=version, **kwargs)
+
+def services_rolling_restart(*args, **kwargs):
+    """adhoc services rolling-restart cluster_name_or_config service_id|all [service_id...] [--batch-size=1] [--max-failure-rate=0] [--timeout=60] [--version=[node:]/path/to/sirikata,...]
+
+    Restart services a batch at a time, e.g. to move them onto new
+    binaries after sync sirikata without taking them all down at once.
+    Each service is stopped and started again with the command and
+    options it was added with, on the same ports and cores, and the
+    next batch starts once every service in the batch is alive and
+    passes its probe (or --timeout seconds pass). Once more than
+    --max-failure-rate of the restarts so far have failed (by default,
+    any of them), the remaining services are left running as they are.
+
+    --version moves services to a different Sirikata install: paths in
+    their commands under the node's Sirikata path are pointed into the
+    given directory instead, or into an installed version if given its
+    ID (see versions install). node:/path selects the version for one
+    node. Reports each batch's downtime and the total time taken.
+    """
 
-    return retcode
+    name_or_config, service_name, more_names = arguments.parse_or_die(services_rolling_restart, [object, str], rest=True, *args)
 
+    cname, cc = name_and_config(name_or_config)
+    return services.rolling_restart(ServiceBackend('adhoc', cc, **kwargs), service_name, more_names, **kwargs)
 
 
 def remove_service(*args, **kwargs):
@@ -279,36 +576,269 @@ def remove_service(*args, **kwargs):
     name_or_config, service_name = arguments.parse_or_die(remove_service, [object, str], *args)
 
     cname, cc = name_and_config(name_or_config)
+    return services.remove(ServiceBackend('adhoc', cc, **kwargs), service_name)
+
+
+
+def collect_facts(cc, node_id, **kwargs):
+    '''Run the facts script on a node, returning (retcode, output).'''
+    node = cc.get_node(node_id)
+    return run_script(cc, node_id, facts.script(cc.sirikata_path(node=node), cc.workspace_path(node)))
+
+def node_facts(cc, node=None, ttl=None, **kwargs):
+    '''Get a node's facts, or { node id : facts } for all nodes if node
+    is None, from the cache in the cluster state. Facts that are
+    missing or older than ttl seconds are collected first, from all the
+    nodes that need it at once.'''
+    node_ids = [n['id'] for n in cc.nodes] if node is None else [cc.get_node(node)['id']]
+    if ttl is None: ttl = facts.DefaultTTL
+    all_facts = facts.get('adhoc facts', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), ttl=ttl)
+    if node is None: return all_facts
+    return all_facts.get(node_ids[0])
+
+def facts_refresh(*args, **kwargs):
+    """adhoc facts refresh cluster_name_or_config [node...] [--max-age=SECONDS] [--parallel=N]
+
+    Collect facts about nodes (cores, memory, free disk, kernel and
+    installed Sirikata version) from all nodes, or the given ones, in
+    one parallel sweep, and cache them in the cluster state for
+    placement and validation. With --max-age, nodes whose cached facts
+    are newer than that are skipped.
+    """
+
+    name_or_config, targets = arguments.parse_or_die(facts_refresh, [object], rest=True, *args)
+    max_age = config.kwarg_or_default('max-age', kwargs, default=None)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
 
-    if service_name not in cc.state['services']:
-        print "Couldn't find record of service '%s'" % (service_name)
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [cc.get_node(target)['id'] for target in targets] if targets else [n['id'] for n in cc.nodes]
+    if max_age is not None:
+        node_ids = [node_id for node_id in node_ids if not facts.fresh(cc.state.get('facts', {}).get(node_id), float(max_age))]
+    result = facts.refresh('adhoc facts refresh', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), parallelism=parallelism)
+    if results.get_format() == 'text':
+        print facts.format_table(dict([(node_id, cc.state['facts'][node_id]) for node_id in node_ids if node_id in cc.state.get('facts', {})]))
+    return result
+
+def facts_show(*args, **kwargs):
+    """adhoc facts show cluster_name_or_config [node...] [--ttl=SECONDS]
+
+    Show the cached facts about nodes, collecting them first for nodes
+    without facts or whose facts are older than --ttl seconds (default
+    an hour).
+    """
+
+    name_or_config, targets = arguments.parse_or_die(facts_show, [object], rest=True, *args)
+    ttl = float(config.kwarg_or_default('ttl', kwargs, default=facts.DefaultTTL))
+
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [cc.get_node(target)['id'] for target in targets] if targets else [n['id'] for n in cc.nodes]
+    all_facts = facts.get('adhoc facts show', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), ttl=ttl)
+    if results.get_format() == 'text':
+        print facts.format_table(all_facts)
+    return results.Result('adhoc facts show', retcode=0 if len(all_facts) == len(node_ids) else 1, data=all_facts)
+
+
+def network_probe(*args, **kwargs):
+    """adhoc network probe cluster_name_or_config [--port=PORT] [--bytes=N] [--count=N]
+
+    Measure the round trip time and TCP throughput between every pair
+    of nodes and save them in the cluster state, for placing services
+    with near:SERVICE. Pairs are measured in rounds, each node in at
+    most one pair per round, so measurements don't interfere. --port
+    is the port measurements use on each node; by default it's the
+    highest port in the range open to Sirikata that no service has and
+    nothing listens on. --bytes is the size of the bulk transfer and
+    --count the number of round trips timed per pair.
+    """
+
+    name_or_config = arguments.parse_or_die(network_probe, [object], *args)
+    port = config.kwarg_or_default('port', kwargs, default=None)
+    nbytes = int(config.kwarg_or_default('bytes', kwargs, default=network.DefaultBytes))
+    count = int(config.kwarg_or_default('count', kwargs, default=network.DefaultCount))
+
+    name, cc = name_and_config(name_or_config)
+    free_port = services.probe_ports(ServiceBackend('adhoc', cc, **kwargs))
+
+    result = network.probe('adhoc network probe', [node['id'] for node in cc.nodes],
+                           lambda node_id, script: run_script(cc, node_id, script),
+                           lambda node_id: cc.get_node(node_id).get('private_ip', cc.hostname(node=cc.get_node(node_id))),
+                           lambda node_id: int(port) if port is not None else free_port(node_id),
+                           count=count, nbytes=nbytes)
+    cc.state['network'] = result.data
+    cc.save()
+    if results.get_format() == 'text':
+        print network.format_table(result.data, 'rtt_ms')
+        print network.format_table(result.data, 'bandwidth_mbps')
+    return result
+
+
+def version_store(cc, **kwargs):
+    '''The version store of cc's nodes, see cluster.util.versions.'''
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+    return versions.Store(cc,
+                          lambda node_id, script: run_script(cc, node_id, script),
+                          lambda node_id: versions.store_path(cc.workspace_path(cc.get_node(node_id))),
+                          lambda node_id: cc.sirikata_path(node=cc.get_node(node_id)),
+                          parallelism=parallelism)
+
+def versions_install(*args, **kwargs):
+    """adhoc versions install cluster_name_or_config /path/to/installed/sirikata/or/tbz2 [--activate] [--budget=MB] [--parallel=N]
+
+    Install a Sirikata build on every node next to the ones already
+    there, in sirikata-versions/ID under the node's workspace, where
+    ID is a hash of the archive. Nodes that already have it are
+    skipped. --activate switches all the nodes to it once it's
+    installed everywhere, and --budget then removes least recently
+    used versions until each node's store fits in that many MB.
+    """
+
+    name_or_config, path = arguments.parse_or_die(versions_install, [object, str], *args)
+    activate = bool(config.kwarg_or_default('activate', kwargs, default=False))
+    budget = config.kwarg_or_default('budget', kwargs, default=None)
+
+    name, cc = name_and_config(name_or_config)
+
+    if os.path.isdir(path):
+        retcode = util_sirikata.package(path)
+        if retcode != 0: return retcode
+        path = os.path.join(path, 'sirikata.tar.bz2')
+
+    def copy(node_id, archive, dest):
+        node = cc.get_node(node_id)
+        address = cc.node_ssh_address(node)
+        with trace.span('copy archive', node=node_id):
+            retcode = subprocess.call(['ssh', address, 'mkdir', '-p', ssh_escape(os.path.dirname(dest))])
+            if retcode != 0: return retcode
+            return subprocess.call(['rsync', '--progress', archive, address + ':' + dest])
+
+    store = version_store(cc, **kwargs)
+    node_ids = [node['id'] for node in cc.nodes]
+    result = store.install('adhoc versions install', node_ids, path, copy=copy)
+    version = result.data['version']
+    print "Installed version %s" % (version)
+    if result != 0 or not activate: return result
+    result = store.activate('adhoc versions activate', node_ids, version)
+    if result != 0 or budget is None: return result
+    return store.gc('adhoc versions gc', node_ids, int(float(budget) * 1024**2))
+
+def versions_activate(*args, **kwargs):
+    """adhoc versions activate cluster_name_or_config version [--parallel=N]
+
+    Switch every node to an installed Sirikata version by pointing the
+    node's Sirikata path at it, on all nodes at once. The switch is a
+    single rename on each node, so nothing sees a half-updated
+    install. Running services keep the binaries they started with
+    until they're restarted, e.g. with services rolling-restart. The
+    Sirikata path has to be a link already or not exist, not a
+    directory from sync sirikata.
+    """
+
+    name_or_config, version = arguments.parse_or_die(versions_activate, [object, str], *args)
+
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [node['id'] for node in cc.nodes]
+    return version_store(cc, **kwargs).activate('adhoc versions activate', node_ids, version)
+
+def versions_list(*args, **kwargs):
+    """adhoc versions list cluster_name_or_config [--parallel=N]
+
+    List the Sirikata versions installed on each node, with their size
+    and when they were last installed or activated. The active version
+    is marked with a *.
+    """
+
+    name_or_config = arguments.parse_or_die(versions_list, [object], *args)
+
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [node['id'] for node in cc.nodes]
+    result = version_store(cc, **kwargs).refresh('adhoc versions list', node_ids)
+    if results.get_format() == 'text':
+        print versions.format_table(cc.state, node_ids)
+    return result
+
+def versions_gc(*args, **kwargs):
+    """adhoc versions gc cluster_name_or_config --budget=MB [--parallel=N]
+
+    Remove Sirikata versions from each node, least recently used
+    first, until the node's store fits in --budget MB. The active
+    version and versions services were started with are kept, even if
+    that leaves the store over budget.
+    """
+
+    name_or_config = arguments.parse_or_die(versions_gc, [object], *args)
+    budget = config.kwarg_or_default('budget', kwargs, default=None)
+    if budget is None:
+        print "Specify the disk budget for each node with --budget=MB"
         return 1
 
-    target_node = cc.get_node( cc.state['services'][service_name]['node'] )
-    pidfile = os.path.join(cc.workspace_path(target_node), 'sirikata_%s.pid' % (service_name) )
+    name, cc = name_and_config(name_or_config)
 
-    retcode = node_ssh(cc, target_node,
-                       'start-stop-daemon', '--stop',
-                       '--retry', 'TERM/6/KILL/5',
-                       '--pidfile', pidfile,
-                       # oknodo allows a successful return if the
-                       # process couldn't actually be found, meaning
-                       # it probably crashed
-                       '--oknodo'
-#                       '--test',
-                       )
+    node_ids = [node['id'] for node in cc.nodes]
+    return version_store(cc, **kwargs).gc('adhoc versions gc', node_ids, int(float(budget) * 1024**2))
+
+
+def agent_install(*args, **kwargs):
+    """adhoc agent install cluster_name_or_config [--parallel=N]
 
-    if retcode != 0:
-        print "Failed to remove service."
-        return retcode
+    Copy the node agent into each node's workspace and start it. Once
+    a node has an agent, remote commands, scripts and starting and
+    stopping services go to it over a single forwarded ssh connection
+    instead of a new ssh connection each. Nodes where the agent can't
+    be reached fall back to ssh.
+    """
+
+    name_or_config = arguments.parse_or_die(agent_install, [object], *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+
+    name, cc = name_and_config(name_or_config)
 
-    # Destroy the record of the service.
-    # Save a record of this service so we can find it again when we need to stop it.
-    del cc.state['services'][service_name]
+    result = results.Result('adhoc agent install')
+    sockets = {}
+    def install_on_node(node):
+        start = time.time()
+        workspace = cc.workspace_path(node)
+        retcode = node_ssh(cc, node, 'mkdir', '-p', workspace)
+        if retcode == 0:
+            with trace.span('rsync', node=node['id'], cmd=agent.ScriptName):
+                retcode = subprocess.call(['rsync', agent.script_path(), cc.node_ssh_address(node) + ':' + workspace + '/'])
+        if retcode == 0:
+            retcode = node_ssh(cc, node, *agent.start_command(workspace))
+        if retcode != 0:
+            print "Failed to install the agent on %s" % (node['id'])
+            result.add_node(node['id'], retcode, duration=time.time()-start, error='failed to install agent')
+            return
+        sockets[node['id']] = os.path.join(workspace, agent.SocketName)
+        result.add_node(node['id'], retcode, duration=time.time()-start, data={ 'socket' : sockets[node['id']] })
+    parallel.run(install_on_node, cc.nodes, parallelism=parallelism)
+
+    cc.state.setdefault('agent', {}).update(sockets)
     cc.save()
+    return result.finish()
 
-    return retcode
+def agent_remove(*args, **kwargs):
+    """adhoc agent remove cluster_name_or_config
+
+    Stop the node agents and go back to running commands over ssh.
+    """
 
+    name_or_config = arguments.parse_or_die(agent_remove, [object], *args)
+
+    name, cc = name_and_config(name_or_config)
+
+    result = results.Result('adhoc agent remove')
+    for node in cc.nodes:
+        if node['id'] not in cc.state.get('agent', {}): continue
+        start = time.time()
+        del cc.state['agent'][node['id']]
+        agent.forget((cc.name, node['id']))
+        retcode = node_ssh(cc, node, *agent.stop_command(cc.workspace_path(node)))
+        result.add_node(node['id'], retcode, duration=time.time()-start)
+    cc.save()
+    return result.finish()
 
 
 def destroy(*args, **kwargs):
@@ -0,0 +1 @@
+from nodegroup import NodeGroup, AggregateNodeGroup
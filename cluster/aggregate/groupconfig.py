@@ -0,0 +1,95 @@
+from cluster.util.nodegroup import NodeGroupConfig
+
+class AggregateGroupConfig(NodeGroupConfig):
+    '''A meta-cluster built from other clusters (members). We only
+    store the type and name of each member; everything about the nodes
+    themselves comes from the members' own configs.'''
+
+    TypeName = 'aggregate'
+    Attributes = ['name', 'typename', 'size', 'state',
+                  'members', # List of {'type' : cluster type, 'name' : cluster name}
+                  ]
+
+    def __init__(self, name, **kwargs):
+        # If we've got any non-name params, ensure we have the expected set
+        if kwargs:
+            assert('members' in kwargs)
+
+            # Members can be given as type:name strings
+            members = []
+            for member in kwargs['members']:
+                if isinstance(member, basestring):
+                    if member.find(':') == -1:
+                        raise Exception("Members should be specified as type:name, got '%s'" % (member))
+                    member_type, member_name = member.split(':', 1)
+                    member = { 'type' : member_type, 'name' : member_name }
+                members.append(member)
+
+            member_names = set()
+            for member in members:
+                if member['name'] in member_names: raise Exception('Found duplicate member clusters: ' + member['name'])
+                member_names.add(member['name'])
+
+            # Size is the number of member clusters, the number of
+            # nodes depends on the state of the members
+            nkwargs = dict(kwargs)
+            nkwargs['members'] = members
+            nkwargs['size'] = len(members)
+            super(AggregateGroupConfig, self).__init__(name, typename=self.TypeName, **nkwargs)
+        else:
+            super(AggregateGroupConfig, self).__init__(name, **kwargs)
+        self._member_groups = {}
+
+
+    def member_names(self):
+        return [member['name'] for member in self.members]
+
+    def member(self, name):
+        '''Get the NodeGroup for a member cluster.'''
+        if name not in self._member_groups:
+            # Imported here since the set of cluster types includes us
+            import cluster
+            types = dict([(ng.ConfigClass.TypeName, ng) for ng in cluster.ClusterTypes])
+            matches = [member for member in self.members if member['name'] == name]
+            if not matches: raise Exception("Couldn't find member cluster '%s'" % (name))
+            self._member_groups[name] = types[matches[0]['type']](matches[0]['name'])
+        return self._member_groups[name]
+
+    def member_node(self, node):
+        '''Get the member NodeGroup and the member's own node info for one
+        of our nodes.'''
+        member = self.member(node['member'])
+        member_node = dict(node)
+        member_node['id'] = node['member_id']
+        return member, member_node
+
+
+
+    def user(self, node=None):
+        if node is None: return self.member(self.members[0]['name']).user()
+        member, member_node = self.member_node(node)
+        return member.user(member_node)
+
+    def hostname(self, node=None):
+        member, member_node = self.member_node(node)
+        return member.hostname(member_node)
+
+    def sirikata_path(self, node=None):
+        if node is None: return self.member(self.members[0]['name']).sirikata_path()
+        member, member_node = self.member_node(node)
+        return member.sirikata_path(member_node)
+
+    def default_working_path(self, node=None):
+        if node is None: return self.member(self.members[0]['name']).default_working_path()
+        member, member_node = self.member_node(node)
+        return member.default_working_path(member_node)
+
+    def workspace_path(self, node=None):
+        if node is None: return self.member(self.members[0]['name']).workspace_path()
+        member, member_node = self.member_node(node)
+        return member.workspace_path(member_node)
+
+    def capabilities(self, node=None):
+        assert(node is not None and "You must specify a node to look up capabilities.")
+        member, member_node = self.member_node(node)
+        return member.capabilities(member_node)
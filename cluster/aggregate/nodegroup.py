@@ -0,0 +1,103 @@
+import nodes
+import cluster.util
+import cluster.util.results as results
+import cluster.util.dag as dag
+from groupconfig import AggregateGroupConfig
+
+class NodeGroup(cluster.util.NodeGroup):
+    '''
+    A meta-cluster wrapping several other NodeGroups, e.g. EC2 spot
+    instances for space servers plus an ad-hoc rack for databases. Its
+    nodes are the union of the members' nodes, operations on the whole
+    cluster are run on all members concurrently, and per-member
+    results are kept in the result's data['members'].
+    '''
+
+    # Raw command handlers, exported to the sirikata-cluster.py tool.
+    handlers = [
+        ('aggregate create', nodes.create),
+        ('aggregate members info', nodes.members_info),
+        ('aggregate boot', nodes.boot),
+        ('aggregate sync sirikata', nodes.sync_sirikata),
+        ('aggregate gather', nodes.gather),
+        ('aggregate logs follow', nodes.logs_follow),
+        ('aggregate add service', nodes.add_service),
+        ('aggregate services up', nodes.services_up),
+        ('aggregate service status', nodes.service_status),
+        ('aggregate services rolling-restart', nodes.services_rolling_restart),
+        ('aggregate remove service', nodes.remove_service),
+        ('aggregate facts refresh', nodes.facts_refresh),
+        ('aggregate facts show', nodes.facts_show),
+        ('aggregate terminate', nodes.terminate),
+        ('aggregate destroy', nodes.destroy),
+        ]
+
+    ConfigClass = AggregateGroupConfig
+
+    def __init__(self, name):
+        super(NodeGroup, self).__init__(name=name)
+
+
+    def members(self):
+        '''Get the member NodeGroups.'''
+        return [self.config.member(name) for name in self.config.member_names()]
+
+    def boot(self, **kwargs):
+        return results.wrap('aggregate boot', nodes.boot(self.config, **kwargs))
+
+    def nodes(self, **kwargs):
+        return nodes.nodes_data(self.config)
+
+    def sync_sirikata(self, path, **kwargs):
+        return results.wrap('aggregate sync sirikata', nodes.sync_sirikata(self.config, path, **kwargs))
+
+    def sync_files(self, target, src, dest, **kwargs):
+        if target == 'all':
+            return nodes.merge('aggregate sync files', nodes.for_each_member(self.config, lambda member: member.sync_files('all', src, dest, **kwargs)))
+        member_name, member_node = nodes.place(self.config, target)
+        return results.wrap('aggregate sync files', nodes.merge('aggregate sync files', [ (member_name, self.config.member(member_name).sync_files(member_node, src, dest, **kwargs)) ]))
+
+    def gather(self, remote_path, local_dir, **kwargs):
+        return results.wrap('aggregate gather', nodes.gather(self.config, remote_path, local_dir, **kwargs))
+
+    def log_streams(self, service_names=None, lines=10, pattern=None, **kwargs):
+        return nodes.log_streams(self.config, service_names, lines=lines, pattern=pattern, **kwargs)
+
+    def add_service(self, name, target, command, user=None, cwd=None, **kwargs):
+        nkwargs = dict(kwargs)
+        if user is not None: nkwargs['user'] = user
+        if cwd is not None: nkwargs['cwd'] = cwd
+        return results.wrap('aggregate add service', nodes.add_services(self.config, [ (name, target, command) ], **nkwargs))
+
+    def add_services(self, services, user=None, cwd=None, **kwargs):
+        '''Add several services at once, given as a list of (name,
+        target, command) tuples. Members start their services
+        concurrently.'''
+        nkwargs = dict(kwargs)
+        if user is not None: nkwargs['user'] = user
+        if cwd is not None: nkwargs['cwd'] = cwd
+        return results.wrap('aggregate add service', nodes.add_services(self.config, services, **nkwargs))
+
+    def start_services(self, specs, parallelism=None, timeout=300, **kwargs):
+        return results.wrap('aggregate services up', nodes.start_services(self.config, dag.validate(specs), parallelism=parallelism, timeout=timeout, **kwargs))
+
+    def probe(self, checks, **kwargs):
+        return nodes.probe_services(self.config, checks, **kwargs)
+
+    def service_status(self, *names, **kwargs):
+        return results.wrap('aggregate service status', nodes.service_status(self.config, *names, **kwargs))
+
+    def restart_service(self, name, version=None, **kwargs):
+        return nodes.restart_service(self.config, name, version=version, **kwargs)
+
+    def remove_service(self, name, **kwargs):
+        return results.wrap('aggregate remove service', nodes.remove_service(self.config, name))
+
+    def facts(self, node=None, ttl=None, **kwargs):
+        return nodes.node_facts(self.config, node, ttl=ttl, **kwargs)
+
+    def terminate(self, **kwargs):
+        return results.wrap('aggregate terminate', nodes.terminate(self.config, **kwargs))
+
+# Descriptive alias for use outside the cluster.aggregate package
+AggregateNodeGroup = NodeGroup
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+from groupconfig import AggregateGroupConfig
+import cluster.util.config as config
+import cluster.util.arguments as arguments
+import cluster.util.results as results
+import cluster.util.parallel as parallel
+import cluster.util.logs as logs
+import cluster.util.dag as dag
+import cluster.util.rolling as rolling
+import cluster.util.facts as facts
+import json, os, random
+
+# Nodes in an aggregate are named member/node_id so nodes with the
+# same id in different members stay distinct.
+NodeSeparator = '/'
+
+def name_and_config(name_or_config):
+    '''Get a name and config given either a name or a config.'''
+    if isinstance(name_or_config, AggregateGroupConfig):
+        return (name_or_config.name, name_or_config)
+    else:
+        return (name_or_config, AggregateGroupConfig(name_or_config))
+
+def merge(op, member_results):
+    '''Combine the Results from operations on several members into one,
+    prefixing node names with the member name. The members' own
+    results are kept under data['members'].'''
+    result = results.Result(op)
+    result.data = { 'members' : {} }
+    for member_name, member_result in member_results:
+        member_result = results.wrap(op, member_result)
+        result.data['members'][member_name] = member_result.to_dict()
+        for nr in member_result.nodes:
+            node = member_name + NodeSeparator + str(nr.node) if nr.node is not None else member_name
+            # Members already streamed their per-node results, so
+            # don't go through add_node and emit them again
+            result.nodes.append(results.NodeResult(node, nr.retcode, duration=nr.duration, bytes=nr.bytes, error=nr.error, data=nr.data))
+        for err in member_result.errors:
+            result.error('%s: %s' % (member_name, err))
+        if member_result.retcode != 0 and not member_result.nodes and not member_result.errors:
+            result.error('%s: failed with code %d' % (member_name, member_result.retcode))
+    return result.finish()
+
+def for_each_member(cc, fn, member_names=None):
+    '''Run fn(member NodeGroup) on each member concurrently, returning
+    a list of (member name, result).'''
+    if member_names is None: member_names = cc.member_names()
+    # Load configs up front, from this thread
+    for member_name in member_names: cc.member(member_name)
+    values = parallel.run(lambda member_name: fn(cc.member(member_name)), member_names)
+    return zip(member_names, values)
+
+
+def nodes_data(cc):
+    '''Get the union of all member clusters' nodes.'''
+    all_nodes = []
+    for member_name in cc.member_names():
+        for node in cc.member(member_name).nodes():
+            node = dict(node)
+            node['member'] = member_name
+            node['member_id'] = node['id']
+            node['id'] = member_name + NodeSeparator + node['id']
+            all_nodes.append(node)
+    return all_nodes
+
+def node_load(cc, node_id):
+    return len([s for s in cc.state.get('services', {}).values() if s['node'] == node_id])
+
+def cached_cores(cc, nodes):
+    '''Core counts for nodes (from nodes_data) from the members' cached
+    facts, without contacting any nodes. Empty unless all the nodes
+    have fresh facts, so loads are only weighed when they're
+    comparable.'''
+    cores = {}
+    for node in nodes:
+        node_facts = facts.cached(cc.member(node['member']).config, [node['member_id']]).get(node['member_id'])
+        if not node_facts or not node_facts.get('cores'): return {}
+        cores[node['id']] = node_facts['cores']
+    return cores
+
+def place(cc, target, pending=None):
+    '''Resolve a target to a (member name, member node id) pair. The
+    target can be a node from members info (member/node_id),
+    member:target where target is anything the member cluster
+    understands, or 'any'/'member:any' to choose the least loaded node
+    in the whole pool or in one member. pending is a list of node ids
+    chosen earlier in the same batch so they count towards the load.
+    If facts are cached for the candidate nodes (see facts refresh),
+    load is counted per core so larger nodes get more services.'''
+
+    if pending is None: pending = []
+    member_name = None
+    if target != 'any':
+        if target.find(':') != -1:
+            member_name, target = target.split(':', 1)
+        elif target.find(NodeSeparator) != -1:
+            member_name, target = target.split(NodeSeparator, 1)
+        else:
+            raise Exception("Target '%s' should be any, member:node or member%snode" % (target, NodeSeparator))
+        if member_name not in cc.member_names():
+            raise Exception("Couldn't find member cluster '%s'" % (member_name))
+        if target != 'any':
+            return (member_name, target)
+
+    candidates = [node for node in nodes_data(cc) if member_name is None or node['member'] == member_name]
+    if not candidates: raise Exception("No nodes available for placement")
+    cores = cached_cores(cc, candidates)
+    loads = dict([(node['id'], float(node_load(cc, node['id']) + pending.count(node['id'])) / cores.get(node['id'], 1)) for node in candidates])
+    least = min(loads.values())
+    node = random.choice([node for node in candidates if loads[node['id']] == least])
+    return (node['member'], node['member_id'])
+
+
+
+def create(*args, **kwargs):
+    """aggregate create name member_type:member_name [member_type:member_name...]
+
+    Create a new aggregate cluster made up of existing clusters,
+    e.g. ec2:spotcluster adhoc:rack. This just creates a record of the
+    cluster and saves its properties.
+    """
+
+    name, members = arguments.parse_or_die(create, [str], rest=True, *args)
+    if not members:
+        print "You need to specify at least one member cluster."
+        return 1
+
+    cc = AggregateGroupConfig(name, members=members)
+    cc.save()
+
+    return 0
+
+def members_info(*args, **kwargs):
+    """aggregate members info cluster_name_or_config
+
+    Get a list of members of all the member clusters and their
+    properties, in json.
+    """
+
+    name_or_config = arguments.parse_or_die(members_info, [object], *args)
+    name, cc = name_and_config(name_or_config)
+
+    instances = nodes_data(cc)
+    if results.get_format() == 'text':
+        print json.dumps(instances, indent=4)
+    return results.Result('aggregate members info', retcode=0, data=instances)
+
+def boot(*args, **kwargs):
+    """aggregate boot cluster_name_or_config
+
+    Boot all member clusters concurrently.
+    """
+
+    name_or_config = arguments.parse_or_die(boot, [object], *args)
+    name, cc = name_and_config(name_or_config)
+
+    return merge('aggregate boot', for_each_member(cc, lambda member: member.boot(**kwargs)))
+
+def sync_sirikata(*args, **kwargs):
+    """aggregate sync sirikata cluster_name_or_config /path/to/installed/sirikata/or/tbz2
+
+    Synchronize Sirikata binaries to all member clusters concurrently,
+    each using its own distribution mechanism.
+    """
+
+    name_or_config, path = arguments.parse_or_die(sync_sirikata, [object, str], *args)
+    name, cc = name_and_config(name_or_config)
+
+    return merge('aggregate sync sirikata', for_each_member(cc, lambda member: member.sync_sirikata(path, **kwargs)))
+
+def gather(*args, **kwargs):
+    """aggregate gather cluster_name_or_config /remote/path /local/dir [--incremental] [member cluster options]
+
+    Pull a file or directory from every node of every member cluster
+    concurrently into /local/dir/<member>/<node id>/.
+    """
+
+    name_or_config, remote_path, local_dir = arguments.parse_or_die(gather, [object, str, str], *args)
+    name, cc = name_and_config(name_or_config)
+
+    return merge('aggregate gather', for_each_member(cc, lambda member: member.gather(remote_path, os.path.join(local_dir, member.config.name), **kwargs)))
+
+def log_streams(cc, service_names=None, lines=10, pattern=None, **kwargs):
+    '''Collect log streams from the members running the services,
+    naming nodes member/node_id.'''
+    services = cc.state.get('services', {})
+    if not service_names: service_names = sorted(services.keys())
+    by_member = {}
+    for service_name in service_names:
+        if service_name not in services:
+            raise Exception("Couldn't find record of service '%s'" % (service_name))
+        by_member.setdefault(services[service_name]['member'], []).append(service_name)
+
+    streams = []
+    for member_name in sorted(by_member.keys()):
+        for stream in cc.member(member_name).log_streams(by_member[member_name], lines=lines, pattern=pattern, **kwargs):
+            stream.node = member_name + NodeSeparator + str(stream.node)
+            streams.append(stream)
+    return streams
+
+def logs_follow(*args, **kwargs):
+    """aggregate logs follow cluster_name_or_config [service_id...] [--filter=REGEX] [--lines=10] [--lag=1.0] [member cluster options]
+
+    Stream the logs of services across all member clusters, merged
+    into a single stream ordered by time. See the member cluster
+    types' logs follow.
+    """
+
+    name_or_config, service_names = arguments.parse_or_die(logs_follow, [object], rest=True, *args)
+    lines, pattern, lag = logs.options(kwargs)
+    name, cc = name_and_config(name_or_config)
+
+    return logs.follow(log_streams(cc, service_names, lines=lines, pattern=pattern, **kwargs), lag=lag)
+
+def add_services(cc, services, **kwargs):
+    '''Add a batch of services, given as (name, target, command)
+    tuples. Placement is resolved up front, then each member starts its
+    services while the members run concurrently.'''
+
+    if 'services' not in cc.state: cc.state['services'] = {}
+    by_member = {}
+    chosen = []
+    for service_name, target, command in services:
+        if service_name in cc.state['services']:
+            print "The requested service %s already exists." % (service_name)
+            return 1
+        member_name, member_node = place(cc, target, pending=chosen)
+        chosen.append(member_name + NodeSeparator + member_node)
+        by_member.setdefault(member_name, []).append( (service_name, member_node, command) )
+
+    def add_to_member(member_name):
+        member = cc.member(member_name)
+        member_result = results.Result('aggregate add service')
+        for service_name, member_node, command in by_member[member_name]:
+            one_result = member.add_service(service_name, member_node, command, **kwargs)
+            member_result.nodes += one_result.nodes
+            member_result.errors += one_result.errors
+            if one_result.ok:
+                # Members add services concurrently
+                with cc.lock:
+                    cc.state['services'][service_name] = {
+                        'member' : member_name,
+                        'node' : member_name + NodeSeparator + member_node,
+                        }
+        return member_result.finish()
+
+    member_names = sorted(by_member.keys())
+    result = merge('aggregate add service', for_each_member(cc, lambda member: add_to_member(member.config.name), member_names=member_names))
+    cc.save()
+    return result
+
+def add_service(*args, **kwargs):
+    """aggregate add service cluster_name_or_config service_id target_node|member:target_node|member:any|any [--user=user] [--cwd=/path/to/execute] [--] command to run
+
+    Add a service to run on one of the member clusters. With 'any',
+    the service is placed on the least loaded node across all member
+    clusters; with member:any, the least loaded node in that member.
+    Otherwise this works the same as the member clusters' add service.
+    """
+
+    name_or_config, service_name, target_node, service_cmd = arguments.parse_or_die(add_service, [object, str, str], rest=True, *args)
+    cname, cc = name_and_config(name_or_config)
+
+    if not len(service_cmd):
+        print "You need to specify a command for the service"
+        return 1
+
+    return add_services(cc, [ (service_name, target_node, service_cmd) ], **kwargs)
+
+def probe_services(cc, checks, **kwargs):
+    '''Evaluate readiness probes, given as (service name, probe), by
+    passing them on to the members running the services.'''
+    by_member = {}
+    for service_name, probe in checks:
+        by_member.setdefault(cc.state['services'][service_name]['member'], []).append( (service_name, probe) )
+    passed = {}
+    for member_name, member_passed in for_each_member(cc, lambda member: member.probe(by_member[member.config.name], **kwargs), member_names=sorted(by_member.keys())):
+        passed.update(member_passed)
+    return passed
+
+def start_services(cc, specs, parallelism=None, timeout=300, **kwargs):
+    '''Start services described by specs (see cluster.util.dag) in
+    dependency order, placing them like add service.'''
+    def start(spec):
+        nkwargs = dict(kwargs)
+        nkwargs.update(dag.spec_kwargs(spec))
+        if spec['probe']: nkwargs['probe'] = spec['probe']
+        return results.wrap('aggregate add service', add_services(cc, [ (spec['name'], spec['target'], spec['command']) ], **nkwargs)).ok
+    return dag.bring_up('aggregate services up', specs, start, lambda checks: probe_services(cc, checks, **kwargs),
+                        node_of=lambda name: cc.state.get('services', {}).get(name, {}).get('node'),
+                        parallelism=parallelism, timeout=timeout)
+
+def services_up(*args, **kwargs):
+    """aggregate services up cluster_name_or_config services.json [--parallel=N] [--timeout=300] [member cluster options]
+
+    Start the services described in services.json in dependency order
+    across the member clusters. Targets can be anything add service
+    accepts, e.g. member:any. See the member cluster types' services
+    up for the file format.
+    """
+
+    name_or_config, spec_path = arguments.parse_or_die(services_up, [object, str], *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+    timeout = float(config.kwarg_or_default('timeout', kwargs, default=300))
+    nkwargs = dict([(k, v) for k, v in kwargs.items() if k not in ['parallel', 'timeout']])
+
+    name, cc = name_and_config(name_or_config)
+    return start_services(cc, dag.load(spec_path), parallelism=parallelism, timeout=timeout, **nkwargs)
+
+def service_status(*args, **kwargs):
+    """aggregate service status cluster_name_or_config service_id|all [service_id...]
+
+    Check the status of services from the cluster. Returns 0 if they
+    are all active, running and pass their probes, non-zero otherwise.
+    Members check their services concurrently.
+    """
+
+    name_or_config, service_name, more_names = arguments.parse_or_die(service_status, [object, str], rest=True, *args)
+    cname, cc = name_and_config(name_or_config)
+
+    services = cc.state.get('services', {})
+    names = sorted(services.keys()) if service_name == 'all' else [service_name] + list(more_names)
+    by_member = {}
+    for name in names:
+        if name not in services:
+            print "Couldn't find record of service '%s'" % (name)
+            return 1
+        by_member.setdefault(services[name]['member'], []).append(name)
+
+    return merge('aggregate service status', for_each_member(cc, lambda member: member.service_status(*by_member[member.config.name], **kwargs), member_names=sorted(by_member.keys())))
+
+def restart_service(cc, service_name, version=None, **kwargs):
+    '''Restart a service through the member running it.'''
+    return cc.member(cc.state['services'][service_name]['member']).restart_service(service_name, version=version, **kwargs)
+
+def services_rolling_restart(*args, **kwargs):
+    """aggregate services rolling-restart cluster_name_or_config service_id|all [service_id...] [--batch-size=1] [--max-failure-rate=0] [--timeout=60] [--version=[member/node:]/path/to/sirikata,...] [member cluster options]
+
+    Restart services a batch at a time across the member clusters; a
+    batch can hold services from several members. See the member
+    cluster types' services rolling-restart. Nodes for --version are
+    given as member/node_id.
+    """
+
+    name_or_config, service_name, more_names = arguments.parse_or_die(services_rolling_restart, [object, str], rest=True, *args)
+    batch_size, max_failure_rate, timeout, versions = rolling.options(kwargs)
+    nkwargs = dict([(k, v) for k, v in kwargs.items() if k not in rolling.OptionKeys])
+
+    cname, cc = name_and_config(name_or_config)
+    services = cc.state.get('services', {})
+    names = sorted(services.keys()) if service_name == 'all' else [service_name] + list(more_names)
+    for name in names:
+        if name not in services:
+            print "Couldn't find record of service '%s'" % (name)
+            return 1
+    # Load member configs up front, from this thread
+    for name in names: cc.member(services[name]['member'])
+
+    return rolling.run('aggregate services rolling-restart', names,
+                       lambda name: restart_service(cc, name, version=rolling.version_for(versions, services[name]['node']), **nkwargs),
+                       lambda names: probe_services(cc, [ (name, None) for name in names ], **nkwargs),
+                       lambda name: services[name]['node'],
+                       batch_size=batch_size, max_failure_rate=max_failure_rate, timeout=timeout)
+
+def remove_service(*args, **kwargs):
+    """aggregate remove service cluster_name_or_config service_id
+
+    Remove a service from the cluster.
+    """
+
+    name_or_config, service_name = arguments.parse_or_die(remove_service, [object, str], *args)
+    cname, cc = name_and_config(name_or_config)
+
+    if service_name not in cc.state.get('services', {}):
+        print "Couldn't find record of service '%s'" % (service_name)
+        return 1
+
+    member_name = cc.state['services'][service_name]['member']
+    result = merge('aggregate remove service', [ (member_name, cc.member(member_name).remove_service(service_name, **kwargs)) ])
+    if result.ok:
+        del cc.state['services'][service_name]
+        cc.save()
+    return result
+
+def node_facts(cc, node=None, ttl=None, **kwargs):
+    '''Get a node's facts from its member, or { member/node id : facts }
+    for all nodes if node is None. Members collect missing or stale
+    facts concurrently.'''
+    if node is not None:
+        member_name, member_node = place(cc, node)
+        return cc.member(member_name).facts(member_node, ttl=ttl, **kwargs)
+    all_facts = {}
+    for member_name, member_facts in for_each_member(cc, lambda member: member.facts(ttl=ttl, **kwargs)):
+        for node_id, node_facts in member_facts.items():
+            all_facts[member_name + NodeSeparator + node_id] = node_facts
+    return all_facts
+
+def facts_show(*args, **kwargs):
+    """aggregate facts show cluster_name_or_config [member/node...] [--ttl=SECONDS]
+
+    Show the cached facts about nodes in all member clusters,
+    collecting them first for nodes without facts or whose facts are
+    older than --ttl seconds (default an hour).
+    """
+
+    name_or_config, targets = arguments.parse_or_die(facts_show, [object], rest=True, *args)
+    ttl = float(config.kwarg_or_default('ttl', kwargs, default=facts.DefaultTTL))
+    name, cc = name_and_config(name_or_config)
+
+    if targets:
+        all_facts = dict([(target, node_facts(cc, target, ttl=ttl, **kwargs)) for target in targets])
+        all_facts = dict([(target, target_facts) for target, target_facts in all_facts.items() if target_facts is not None])
+    else:
+        all_facts = node_facts(cc, ttl=ttl, **kwargs)
+    if results.get_format() == 'text':
+        print facts.format_table(all_facts)
+    return results.Result('aggregate facts show', retcode=0 if not targets or len(all_facts) == len(targets) else 1, data=all_facts)
+
+def facts_refresh(*args, **kwargs):
+    """aggregate facts refresh cluster_name_or_config
+
+    Collect facts about all nodes in all member clusters, with the
+    members working concurrently.
+    """
+
+    name_or_config = arguments.parse_or_die(facts_refresh, [object], *args)
+    name, cc = name_and_config(name_or_config)
+
+    all_facts = node_facts(cc, ttl=0, **kwargs)
+    if results.get_format() == 'text':
+        print facts.format_table(all_facts)
+    return results.Result('aggregate facts refresh', retcode=0 if len(all_facts) == len(nodes_data(cc)) else 1, data=all_facts)
+
+def terminate(*args, **kwargs):
+    """aggregate terminate cluster_name_or_config
+
+    Terminate all member clusters concurrently.
+    """
+
+    name_or_config = arguments.parse_or_die(terminate, [object], *args)
+    name, cc = name_and_config(name_or_config)
+
+    result = merge('aggregate terminate', for_each_member(cc, lambda member: member.terminate(**kwargs)))
+    if 'services' in cc.state:
+        del cc.state['services']
+        cc.save()
+    return result
+
+def destroy(*args, **kwargs):
+    """aggregate destroy name_or_config
+
+    Destroy the aggregate cluster's record. Member clusters aren't
+    affected.
+    """
+
+    name_or_config = arguments.parse_or_die(destroy, [object], *args)
+
+    name, cc = name_and_config(name_or_config)
+
+    cc.delete()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""
+Usage: sirikata-agent.py --socket=/path/to/agent.sock [--daemon] [--stop] [--check]
+
+A small agent that runs on each cluster node so sirikata-cluster.py
+doesn't need a new ssh connection, and a round of shell escaping, for
+every command. It listens on a unix socket, which the controlling
+machine reaches through an ssh-forwarded socket, and accepts batched
+JSON RPCs, one request per line:
+
+  { "id" : 1, "calls" : [ { "op" : "run", "argv" : ["uptime"] }, ... ],
+    "parallel" : false }
+
+and answers each request with one line:
+
+  { "id" : 1, "results" : [ { "ok" : true, "retcode" : 0, ... }, ... ] }
+
+Calls in a request run in order, or concurrently with "parallel".
+Supported operations:
+
+  ping                                  agent version and pid
+  run { argv, cwd, env, input }         run a command, returning its
+                                        retcode, stdout and stderr
+  start_service { argv, cwd, env }      like run, for commands that
+                                        daemonize (e.g. start-stop-daemon)
+  stop_service { pidfile, schedule }    signal the process in pidfile
+                                        following schedule, e.g.
+                                        [["TERM", 6], ["KILL", 5]]
+  service_status { pidfile }            whether the process is alive
+  stat { paths }                        size, mtime and mode of files
+  read_file { path, offset, length }    part of a file, base64 encoded
+  stream_file { path, offset, chunk }   a whole file, as a series of
+                                        { "id", "bytes" } lines, each
+                                        followed by that many raw bytes,
+                                        before the final result; must be
+                                        the only call in its request
+
+--daemon detaches and leaves a pid file and log next to the socket,
+doing nothing if an agent is already answering on the socket. --stop
+stops a daemonized agent and --check exits with 0 if an agent is
+answering. The agent only uses the standard library and runs under
+Python 2.6+ and 3.
+"""
+
+import base64, errno, json, os, signal, socket, subprocess, sys, tempfile, threading, time
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+Version = 1
+
+
+def _text(data):
+    if isinstance(data, bytes): return data.decode('utf-8', 'replace')
+    return data
+
+def _env(env):
+    if not env: return None
+    full = dict(os.environ)
+    full.update(env)
+    return full
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # Another user's process is still a live process
+        if e.errno != errno.EPERM: return False
+    # Zombies still accept signals but are gone as far as we care
+    try:
+        with open('/proc/%d/stat' % (pid), 'r') as fp:
+            return fp.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return True
+
+def _read_pid(pidfile):
+    try:
+        with open(pidfile, 'r') as fp:
+            return int(fp.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def op_ping(call):
+    return { 'version' : Version, 'pid' : os.getpid() }
+
+def _run(call, use_input):
+    # Output goes to temporary files rather than pipes so commands that
+    # leave daemons behind holding the descriptors don't keep us waiting
+    out = tempfile.TemporaryFile()
+    err = tempfile.TemporaryFile()
+    stdin = subprocess.PIPE if use_input else open(os.devnull, 'r')
+    try:
+        proc = subprocess.Popen(call['argv'], cwd=call.get('cwd'), env=_env(call.get('env')),
+                                stdin=stdin, stdout=out, stderr=err, close_fds=True)
+        if use_input:
+            proc.stdin.write(call['input'].encode('utf-8'))
+            proc.stdin.close()
+        retcode = proc.wait()
+        out.seek(0)
+        err.seek(0)
+        return { 'retcode' : retcode, 'stdout' : _text(out.read()), 'stderr' : _text(err.read()) }
+    finally:
+        if not use_input: stdin.close()
+        out.close()
+        err.close()
+
+def op_run(call):
+    return _run(call, 'input' in call)
+
+def op_start_service(call):
+    return _run(call, False)
+
+def op_stop_service(call):
+    pid = _read_pid(call['pidfile'])
+    if pid is None or not _pid_alive(pid):
+        return { 'retcode' : 0, 'stopped' : False }
+    for signame, timeout in call.get('schedule', [['TERM', 6], ['KILL', 5]]):
+        try:
+            os.kill(pid, getattr(signal, 'SIG' + signame))
+        except OSError as e:
+            # Like start-stop-daemon, give up if we can't signal it
+            if e.errno == errno.EPERM: return { 'retcode' : 2, 'stopped' : False }
+        deadline = time.time() + timeout
+        while time.time() < deadline and _pid_alive(pid):
+            time.sleep(0.05)
+        if not _pid_alive(pid):
+            return { 'retcode' : 0, 'stopped' : True }
+    return { 'retcode' : 2, 'stopped' : False }
+
+def op_service_status(call):
+    pid = _read_pid(call['pidfile'])
+    return { 'alive' : pid is not None and _pid_alive(pid), 'pid' : pid }
+
+def op_stat(call):
+    stats = {}
+    for path in call['paths']:
+        try:
+            st = os.stat(path)
+            stats[path] = { 'exists' : True, 'size' : st.st_size, 'mtime' : st.st_mtime, 'mode' : st.st_mode, 'isdir' : os.path.isdir(path) }
+        except OSError:
+            stats[path] = { 'exists' : False }
+    return { 'stats' : stats }
+
+def op_read_file(call):
+    with open(call['path'], 'rb') as fp:
+        fp.seek(call.get('offset', 0))
+        data = fp.read(call.get('length', 1024*1024))
+    return { 'data' : _text(base64.b64encode(data)), 'bytes' : len(data) }
+
+Ops = {
+    'ping' : op_ping,
+    'run' : op_run,
+    'start_service' : op_start_service,
+    'stop_service' : op_stop_service,
+    'service_status' : op_service_status,
+    'stat' : op_stat,
+    'read_file' : op_read_file,
+    }
+
+def dispatch(call):
+    try:
+        if call.get('op') not in Ops: raise Exception("Unknown operation '%s'" % (call.get('op')))
+        result = Ops[call['op']](call)
+        result['ok'] = True
+        return result
+    except Exception as e:
+        return { 'ok' : False, 'error' : str(e) }
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def send(self, msg):
+        self.wfile.write((json.dumps(msg) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def stream_file(self, req_id, call):
+        chunk = call.get('chunk', 1024*1024)
+        total = 0
+        with open(call['path'], 'rb') as fp:
+            fp.seek(call.get('offset', 0))
+            while True:
+                data = fp.read(chunk)
+                if not data: break
+                total += len(data)
+                self.wfile.write((json.dumps({ 'id' : req_id, 'bytes' : len(data) }) + '\n').encode('utf-8'))
+                self.wfile.write(data)
+        return { 'ok' : True, 'bytes' : total }
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                req = json.loads(_text(line))
+            except ValueError:
+                self.send({ 'id' : None, 'error' : 'malformed request' })
+                continue
+            calls = req.get('calls', [])
+            if len(calls) == 1 and calls[0].get('op') == 'stream_file':
+                try:
+                    results = [self.stream_file(req.get('id'), calls[0])]
+                except Exception as e:
+                    results = [{ 'ok' : False, 'error' : str(e) }]
+            elif req.get('parallel'):
+                results = [None] * len(calls)
+                def run_one(idx):
+                    results[idx] = dispatch(calls[idx])
+                threads = [threading.Thread(target=run_one, args=(idx,)) for idx in range(len(calls))]
+                for t in threads: t.start()
+                for t in threads: t.join()
+            else:
+                results = [dispatch(call) for call in calls]
+            self.send({ 'id' : req.get('id'), 'results' : results })
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def check(sock_path):
+    '''Whether an agent is answering on sock_path.'''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(5)
+        s.connect(sock_path)
+        s.sendall(b'{"id":0,"calls":[{"op":"ping"}]}\n')
+        return s.makefile('rb').readline().find(b'"ok": true') != -1
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+def daemonize(log_path, pid_path):
+    if os.fork() != 0: os._exit(0)
+    os.setsid()
+    if os.fork() != 0: os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    os.dup2(devnull, 0)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    with open(pid_path, 'w') as fp:
+        fp.write('%d\n' % (os.getpid()))
+
+def main(args):
+    sock_path, daemon, stop, check_only = None, False, False, False
+    for arg in args:
+        if arg.startswith('--socket='): sock_path = arg[len('--socket='):]
+        elif arg == '--daemon': daemon = True
+        elif arg == '--stop': stop = True
+        elif arg == '--check': check_only = True
+        else:
+            sys.stderr.write(__doc__)
+            return 1
+    if sock_path is None:
+        sys.stderr.write(__doc__)
+        return 1
+    sock_path = os.path.abspath(sock_path)
+    pid_path = sock_path + '.pid'
+
+    if check_only:
+        return 0 if check(sock_path) else 1
+    if stop:
+        pid = _read_pid(pid_path)
+        if pid is not None and _pid_alive(pid): os.kill(pid, signal.SIGTERM)
+        return 0
+
+    if check(sock_path):
+        sys.stdout.write('Agent already running on %s\n' % (sock_path))
+        return 0
+    if os.path.exists(sock_path): os.remove(sock_path)
+
+    if daemon: daemonize(sock_path + '.log', pid_path)
+    old_umask = os.umask(0o077)
+    server = Server(sock_path, Handler)
+    os.umask(old_umask)
+    def shutdown(signum, frame):
+        if os.path.exists(sock_path): os.remove(sock_path)
+        os._exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    server.serve_forever()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
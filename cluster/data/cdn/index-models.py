@@ -0,0 +1,43 @@
+# Runs on a cluster node (piped to 'python - /mnt/models' over ssh) and
+# prints a JSON index of the local CDN directory: relative path ->
+# [size, mtime, sha1]. Hashes are cached in .cdn-index in the directory
+# so unchanged files aren't rehashed on every replication pass.
+
+import os, sys, json, hashlib
+
+root = sys.argv[1]
+cache_path = os.path.join(root, '.cdn-index')
+
+try:
+    with open(cache_path, 'r') as fp:
+        cache = json.load(fp)
+except:
+    cache = {}
+
+index = {}
+for dirpath, dirnames, filenames in os.walk(root):
+    for fname in filenames:
+        full = os.path.join(dirpath, fname)
+        rel = os.path.relpath(full, root)
+        if rel == '.cdn-index' or not os.path.isfile(full): continue
+        st = os.stat(full)
+        key = [st.st_size, int(st.st_mtime)]
+        cached = cache.get(rel)
+        if cached and cached[0:2] == key:
+            index[rel] = cached
+            continue
+        h = hashlib.sha1()
+        with open(full, 'rb') as fp:
+            while True:
+                chunk = fp.read(1 << 20)
+                if not chunk: break
+                h.update(chunk)
+        index[rel] = key + [h.hexdigest()]
+
+try:
+    with open(cache_path, 'w') as fp:
+        json.dump(index, fp)
+except:
+    pass
+
+json.dump(index, sys.stdout)
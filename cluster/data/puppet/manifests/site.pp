@@ -8,6 +8,9 @@ node default {
   include sirikata_local_cdn
 }
 
+# Redis nodes set with 'ec2 node set type' are generated in nodes.pp
+# with settings for their profile. This uses the default in-memory
+# settings.
 node sirikata_redis inherits default {
   include redis
 }
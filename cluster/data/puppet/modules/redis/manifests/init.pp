@@ -1,4 +1,19 @@
-class redis {
+# Redis server. settings is a hash of redis.conf settings, normally
+# generated from one of the profiles in cluster/ec2/redisconf.py. The
+# default is an in-memory only server without snapshots.
+class redis($settings = {
+    'daemonize' => 'yes',
+    'pidfile' => '/var/run/redis/redis-server.pid',
+    'port' => '6379',
+    'bind' => '0.0.0.0',
+    'timeout' => '0',
+    'loglevel' => 'notice',
+    'logfile' => '/var/log/redis/redis-server.log',
+    'databases' => '16',
+    'dir' => '/var/lib/redis',
+    'appendonly' => 'no',
+    'save' => '""',
+  }) {
 
   package { 'redis-server':
     ensure => installed
@@ -6,7 +21,7 @@ class redis {
 
   file { '/etc/redis/redis.conf':
     ensure => file,
-    source  => "puppet:///modules/redis/etc/redis/redis.conf",
+    content => template('redis/redis.conf.erb'),
     require => Package['redis-server'],
   }
 
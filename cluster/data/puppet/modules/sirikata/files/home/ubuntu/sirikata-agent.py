@@ -0,0 +1 @@
+../../../../../../agent/sirikata-agent.py
\ No newline at end of file
@@ -50,6 +50,25 @@ class sirikata($archive_url, $archive_name = 'sirikata.tar.bz2') {
     require => [ Exec['Download Sirikata Binaries'], File['/home/ubuntu/sirikata'] ],
   }
 
+  # NODE AGENT Lets sirikata-cluster.py send commands over a single
+  # forwarded ssh connection instead of a new ssh connection per
+  # command. It still has to be enabled with 'ec2 agent install'.
+  file { '/home/ubuntu/sirikata-agent.py':
+    ensure => file,
+    source => 'puppet:///modules/sirikata/home/ubuntu/sirikata-agent.py',
+    owner => 'ubuntu',
+    group => 'ubuntu',
+    mode => '0755',
+  }
+  exec { 'Sirikata Agent':
+    command => 'python /home/ubuntu/sirikata-agent.py --daemon --socket=/home/ubuntu/sirikata-agent.sock',
+    cwd => '/home/ubuntu',
+    path => [ '/bin', '/usr/bin' ],
+    user => 'ubuntu',
+    unless => 'python /home/ubuntu/sirikata-agent.py --check --socket=/home/ubuntu/sirikata-agent.sock',
+    require => File['/home/ubuntu/sirikata-agent.py'],
+  }
+
   # READINESS INDICATORS These create files that let us know when
   # things are ready.
   file { '/home/ubuntu/ready' :
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+# Replication between the per-node CDNs set up by the
+# sirikata_local_cdn puppet module. Each node serves /mnt/models over
+# HTTP, but a model generated on one space server is only available
+# from that node. These commands propagate files between nodes by
+# content hash so identical meshes are only transferred once.
+
+import cluster.util.config as config
+import cluster.util.data as data
+import cluster.util.arguments as arguments
+import cluster.util.results as results
+import cluster.util.parallel as parallel
+import cluster.util.trace as trace
+import nodes
+import provision
+import json, os, pipes, shutil, subprocess, tarfile, tempfile, threading, time
+
+# Must match the sirikata_local_cdn puppet module
+MODELS_PATH = '/mnt/models'
+
+def index_node(cc, node_id, pemfile):
+    '''Get the {relative path : (size, mtime, sha1)} index of a node's
+    CDN directory.'''
+    cmd = nodes.node_ssh_args(cc, node_id, pemfile) + ['python', '-', MODELS_PATH]
+    with trace.span('cdn index', node=node_id, cmd=' '.join(cmd)):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, err = proc.communicate(data.load('cdn', 'index-models.py'))
+    if proc.returncode != 0:
+        raise Exception("Couldn't index CDN directory on node %s" % (node_id))
+    return dict([ (rel, tuple(val)) for rel,val in json.loads(out).iteritems() ])
+
+def plan(indexes, targets):
+    '''Work out what each target node is missing. Returns a dict of
+    node -> list of (relative path, size, sha1, how, source) where how
+    is 'local' if the node already has identical content under another
+    name (source) and can just copy it, or 'transfer' otherwise. If
+    nodes disagree about the content of a path, the newest version
+    wins.'''
+
+    wanted = {}
+    for node, index in indexes.iteritems():
+        for rel, (size, mtime, sha1) in index.iteritems():
+            if rel not in wanted or wanted[rel][1] < mtime:
+                wanted[rel] = (size, mtime, sha1)
+
+    actions = {}
+    for node in targets:
+        index = indexes[node]
+        # Paths holding an older copy than the one that wins get
+        # replaced, so they can't be the source of local copies
+        stale = set([rel for rel, (size, mtime, sha1) in index.iteritems()
+                     if sha1 != wanted[rel][2] and mtime < wanted[rel][1]])
+        have_hashes = dict([(val[2], rel) for rel,val in index.iteritems() if rel not in stale])
+        node_actions = []
+        for rel, (size, mtime, sha1) in sorted(wanted.iteritems()):
+            if rel in index and rel not in stale: continue
+            if sha1 in have_hashes:
+                node_actions.append( (rel, size, sha1, 'local', have_hashes[sha1]) )
+            else:
+                node_actions.append( (rel, size, sha1, 'transfer', None) )
+                # Further copies of the same content on this node can
+                # come from the one we're about to transfer
+                have_hashes[sha1] = rel
+        actions[node] = node_actions
+    return actions
+
+def fetch(cc, source_node, rels, dest_dir, pemfile):
+    '''Pull the given files from a node into dest_dir using a single tar stream.'''
+    cmd = nodes.node_ssh_args(cc, source_node, pemfile) + ['tar', '-cf', '-', '-C', MODELS_PATH, '--null', '-T', '-']
+    with trace.span('cdn fetch', node=source_node):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # tar can start writing before it has read the whole list, so
+        # feed the list from another thread to avoid filling both pipes
+        def write_list():
+            proc.stdin.write('\0'.join(rels) + '\0')
+            proc.stdin.close()
+        writer = threading.Thread(target=write_list)
+        writer.start()
+        tf = tarfile.open(fileobj=proc.stdout, mode='r|')
+        tf.extractall(dest_dir)
+        tf.close()
+        writer.join()
+        return proc.wait()
+
+def push(cc, node_id, node_actions, cache, pemfile):
+    '''Apply a node's actions: one tar stream for files that need to be
+    transferred followed by one script doing the node-local copies.
+    Returns (retcode, bytes transferred).'''
+    transfers = [a for a in node_actions if a[3] == 'transfer']
+    local_copies = [a for a in node_actions if a[3] == 'local']
+    sent = 0
+
+    if transfers:
+        cmd = nodes.node_ssh_args(cc, node_id, pemfile) + ['tar', '-xf', '-', '-C', MODELS_PATH]
+        with trace.span('cdn push', node=node_id):
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            tf = tarfile.open(fileobj=proc.stdin, mode='w|')
+            for rel, size, sha1, how, source in transfers:
+                tf.add(cache[sha1], arcname=rel)
+                sent += size
+            tf.close()
+            proc.stdin.close()
+            retcode = proc.wait()
+        if retcode != 0: return (retcode, sent)
+
+    if local_copies:
+        # Done after the transfer since the source may have just arrived
+        lines = ['set -e', 'cd %s' % pipes.quote(MODELS_PATH)]
+        for rel, size, sha1, how, source in local_copies:
+            lines.append('mkdir -p %s' % (pipes.quote(os.path.dirname(rel) or '.')))
+            lines.append('cp -p %s %s' % (pipes.quote(source), pipes.quote(rel)))
+        cmd = nodes.node_ssh_args(cc, node_id, pemfile) + ['/bin/bash', '-s']
+        with trace.span('cdn local copy', node=node_id):
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            proc.communicate('\n'.join(lines) + '\n')
+        if proc.returncode != 0: return (proc.returncode, sent)
+
+    return (0, sent)
+
+
+def replicate_once(cc, targets, pemfile, parallelism=None, sources=None, op='ec2 cdn replicate'):
+    '''One replication pass: index every node (or just the nodes in
+    sources), then bring each target node up to date with the union of
+    their files.'''
+    result = results.Result(op)
+    node_ids = list(sources) if sources is not None else cc.state['instances']
+
+    print "Indexing CDN directories on %d nodes..." % (len(node_ids))
+    indexes = dict(zip(node_ids, parallel.run(lambda nid: index_node(cc, nid, pemfile), node_ids, parallelism=parallelism)))
+    actions = plan(indexes, targets)
+
+    # Figure out which content we need to pull and pick a source for
+    # each hash, grouping by source so each node is read with a single
+    # tar stream
+    needed = {}
+    for node_actions in actions.values():
+        for rel, size, sha1, how, source in node_actions:
+            if how == 'transfer': needed[sha1] = size
+    sources = {}
+    for node, index in indexes.iteritems():
+        for rel, (size, mtime, sha1) in index.iteritems():
+            if sha1 in needed and sha1 not in sources:
+                sources[sha1] = (node, rel)
+    by_source = {}
+    for sha1, (node, rel) in sources.iteritems():
+        by_source.setdefault(node, []).append(rel)
+
+    tmpdir = tempfile.mkdtemp(prefix='sirikata-cdn-')
+    try:
+        cache = {}
+        fetched = [0]
+        def fetch_source(node):
+            dest = os.path.join(tmpdir, node)
+            os.makedirs(dest)
+            retcode = fetch(cc, node, by_source[node], dest, pemfile)
+            if retcode != 0:
+                result.error("Failed to fetch files from %s" % (node))
+        if by_source:
+            print "Fetching %d unique files from %d nodes..." % (len(sources), len(by_source))
+        parallel.run(fetch_source, by_source.keys(), parallelism=parallelism)
+        for sha1, (node, rel) in sources.iteritems():
+            path = os.path.join(tmpdir, node, rel)
+            if os.path.exists(path):
+                cache[sha1] = path
+                fetched[0] += needed[sha1]
+
+        def push_node(node):
+            node_actions = [a for a in actions[node] if a[3] == 'local' or a[2] in cache]
+            start = time.time()
+            if not node_actions:
+                result.add_node(node, 0, duration=0, bytes=0, data={ 'transferred' : 0, 'local' : 0 })
+                return
+            retcode, sent = push(cc, node, node_actions, cache, pemfile)
+            result.add_node(node, retcode, duration=time.time()-start, bytes=sent,
+                            data={ 'transferred' : len([a for a in node_actions if a[3] == 'transfer']),
+                                   'local' : len([a for a in node_actions if a[3] == 'local']) })
+        parallel.run(push_node, targets, parallelism=parallelism)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # Without deduplication every missing file would be shipped to
+    # every node that needs it
+    naive = sum([a[1] for node_actions in actions.values() for a in node_actions])
+    result.data = {
+        'bytes_fetched' : fetched[0],
+        'bytes_pushed' : result.bytes,
+        'bytes_saved' : max(0, naive - result.bytes),
+        }
+    print "Fetched %d bytes, pushed %d bytes, saved %d bytes by deduplication" % (result.data['bytes_fetched'], result.data['bytes_pushed'], result.data['bytes_saved'])
+    return result.finish()
+
+
+def replicate(*args, **kwargs):
+    """ec2 cdn replicate cluster_name_or_config [--watch=seconds] [--parallel=N] [--pem=/path/to/key.pem]
+
+    Propagate files in the local CDN directory (/mnt/models) between
+    all nodes in the cluster so every node can serve every model. Files
+    are compared by content hash: content a node already has under
+    another name is copied locally on that node, and each unique file
+    is fetched from the cluster only once.
+
+    With --watch, keep replicating every given number of seconds until
+    interrupted, acting as a background replicator for long running
+    worlds.
+    """
+
+    name_or_config = arguments.parse_or_die(replicate, [object], *args)
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    watch = int(config.kwarg_or_default('watch', kwargs, default=0))
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+
+    name, cc = nodes.name_and_config(name_or_config)
+    if 'instances' not in cc.state:
+        print "It doesn't look like you've booted the cluster yet..."
+        return results.Result('ec2 cdn replicate', retcode=1).finish()
+
+    while True:
+        result = replicate_once(cc, cc.state['instances'], pemfile, parallelism=parallelism)
+        if not watch: return result
+        try:
+            time.sleep(watch)
+        except KeyboardInterrupt:
+            return result
+
+def seed(*args, **kwargs):
+    """ec2 cdn seed cluster_name_or_config node [--parallel=N] [--pem=/path/to/key.pem]
+
+    Pre-seed a node's local CDN directory with everything its peers
+    have, e.g. after replacing a node, so clients don't hit cold misses
+    when they start using it. boot and import do this for the nodes
+    they bring up.
+    """
+
+    name_or_config, node = arguments.parse_or_die(seed, [object, object], *args)
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+
+    name, cc = nodes.name_and_config(name_or_config)
+    if 'instances' not in cc.state:
+        print "It doesn't look like you've booted the cluster yet..."
+        return results.Result('ec2 cdn seed', retcode=1).finish()
+
+    return replicate_once(cc, [cc.get_node_name(node)], pemfile, parallelism=parallelism, op='ec2 cdn seed')
+
+def seed_ready(cc, pemfile, progress, parallelism=None):
+    '''Pre-seed the CDN directories of nodes that boot or import just
+    got ready with their peers' files, recording it in the journal
+    progress. Only ready nodes are read from. Returns a Result.'''
+    ready = [node_id for node_id in cc.state['instances'] if progress.status(node_id, 'ready') == 'done']
+    targets = [node_id for node_id in progress.todo(ready, 'cdn seed') if 'cdn' in provision.node_roles(cc, node_id)[0]]
+    if not targets: return results.Result('ec2 cdn seed', retcode=0).finish()
+    print "Seeding CDN directories of %d nodes from their peers..." % (len(targets))
+    try:
+        result = replicate_once(cc, targets, pemfile, parallelism=parallelism, sources=ready, op='ec2 cdn seed')
+    except Exception as e:
+        print "Couldn't index CDN directories: %s" % (str(e))
+        result = results.Result('ec2 cdn seed')
+        for node_id in targets: result.add_node(node_id, 1, error='seeding CDN failed')
+        result.finish()
+    failed = set(targets) if result.errors else set(result.failed_nodes())
+    for node_id in targets:
+        progress.mark(node_id, 'cdn seed', node_id not in failed, error='seeding CDN failed')
+    if failed:
+        print "Seeding the CDN failed on %d node%s, they'll start with a cold CDN (retry with ec2 cdn seed)" % (
+            len(failed), '' if len(failed) == 1 else 's')
+    return result
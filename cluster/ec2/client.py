@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+# A shared client for the EC2 API. Handlers get it from nodes.connect()
+# instead of opening their own EC2Connection, so all the requests a
+# command makes go through one place that keeps it under the API's
+# rate limits:
+#
+#  - every request takes a token from a bucket refilled at a steady
+#    rate, and requests EC2 throttles anyway (RequestLimitExceeded) are
+#    retried after a jittered exponential backoff;
+#  - identical describe requests made concurrently, e.g. get_node from
+#    per-node worker threads, share a single request, and the answer is
+#    reused for a couple of seconds (any other request clears it, since
+#    it may have changed what a describe would return);
+#  - tags and terminations are sent in as few requests as possible.
+#
+# Any other EC2Connection method can be called on the client and is
+# passed through with rate limiting and retries. stats() gives the
+# number of requests made, by action, and the time spent throttled.
+
+import cluster.util.trace as trace
+import atexit, random, threading, time
+
+# EC2 refills its request buckets at a few requests per second per
+# action and account, with some room for bursts
+DefaultRate = 5.0
+DefaultBurst = 20
+
+MaxRetries = 8
+BaseBackoff = 0.5
+MaxBackoff = 20.0
+
+# How long describe results are reused
+DescribeTTL = 2.0
+# Zones don't change while a command runs
+ZonesTTL = 300.0
+
+# Most actions accept at most this many resource ids per request
+MaxBatch = 1000
+
+ThrottleCodes = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException']
+
+def is_throttled(e):
+    '''Whether an exception from boto means the request was throttled.'''
+    return getattr(e, 'error_code', None) in ThrottleCodes
+
+def chunks(items, size=MaxBatch):
+    items = list(items)
+    return [items[idx:idx+size] for idx in range(0, len(items), size)]
+
+
+class TokenBucket(object):
+    '''Allows rate requests per second on average, and bursts of up to
+    burst requests.'''
+
+    def __init__(self, rate=DefaultRate, burst=DefaultBurst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Take a token, blocking until one is available. Returns the time
+        spent waiting.'''
+        # Tokens are taken immediately, going negative when the bucket is
+        # empty, so each caller waits once for its own turn
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = max(0.0, -self.tokens / self.rate)
+        if wait > 0: time.sleep(wait)
+        return wait
+
+    def drain(self):
+        '''Empty the bucket, e.g. after EC2 throttled us, so callers back
+        off together instead of each discovering the limit.'''
+        with self.lock:
+            self.tokens = 0.0
+            self.last = time.time()
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class Client(object):
+    '''Wraps an EC2Connection created by connect(), a function taking no
+    arguments.'''
+
+    def __init__(self, connect, rate=DefaultRate, burst=DefaultBurst, max_retries=MaxRetries):
+        self._connect = connect
+        self._conn = None
+        self._bucket = TokenBucket(rate, burst)
+        self._max_retries = max_retries
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._cache = {}
+        self._calls = {}
+        self._retries = 0
+        self._coalesced = 0
+        self._throttled_s = 0.0
+
+    def _connection(self):
+        with self._lock:
+            if self._conn is None: self._conn = self._connect()
+            return self._conn
+
+    def call(self, action, *args, **kwargs):
+        '''Make a request with the named EC2Connection method, waiting for
+        a token and retrying if EC2 throttles it.'''
+        conn = self._connection()
+        if not action.startswith('get_'): self.invalidate()
+        attempt = 0
+        while True:
+            waited = self._bucket.acquire()
+            with self._lock:
+                self._calls[action] = self._calls.get(action, 0) + 1
+                self._throttled_s += waited
+            try:
+                result = getattr(conn, action)(*args, **kwargs)
+                if not action.startswith('get_'): self.invalidate()
+                return result
+            except Exception as e:
+                if not is_throttled(e) or attempt >= self._max_retries: raise
+                self._bucket.drain()
+                backoff = min(MaxBackoff, BaseBackoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                with self._lock:
+                    self._retries += 1
+                    self._throttled_s += backoff
+                with trace.span('ec2 throttled', cmd=action):
+                    time.sleep(backoff)
+                attempt += 1
+
+    def __getattr__(self, action):
+        if action.startswith('_'): raise AttributeError(action)
+        return lambda *args, **kwargs: self.call(action, *args, **kwargs)
+
+    def _shared(self, key, ttl, fn):
+        '''Get fn()'s value, sharing it with concurrent callers using the
+        same key and reusing it for ttl seconds.'''
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and time.time() - cached[0] <= ttl:
+                self._coalesced += 1
+                return cached[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None: raise flight.error
+            return flight.value
+        try:
+            flight.value = fn()
+            with self._lock:
+                self._cache[key] = (time.time(), flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def invalidate(self):
+        '''Forget cached describe results.'''
+        with self._lock:
+            self._cache.clear()
+
+    def get_all_instances(self, instance_ids=None, max_age=DescribeTTL):
+        key = ('instances', tuple(sorted(instance_ids)) if instance_ids is not None else None)
+        return self._shared(key, max_age, lambda: self.call('get_all_instances', instance_ids=instance_ids))
+
+    def get_all_zones(self):
+        return self._shared(('zones',), ZonesTTL, lambda: self.call('get_all_zones'))
+
+    def create_tags(self, resource_ids, tags):
+        for ids in chunks(resource_ids):
+            self.call('create_tags', ids, tags)
+        return True
+
+    def tag_each(self, tags_by_id):
+        '''Tag several resources, each with its own tags, using one request
+        for each distinct set of tags.'''
+        groups = {}
+        for rid, tags in tags_by_id.items():
+            groups.setdefault(tuple(sorted(tags.items())), []).append(rid)
+        for tags, ids in sorted(groups.items()):
+            self.create_tags(sorted(ids), dict(tags))
+        return True
+
+    def terminate_instances(self, instance_ids):
+        terminated = []
+        for ids in chunks(instance_ids):
+            terminated += list(self.call('terminate_instances', ids))
+        return terminated
+
+    def stats(self):
+        with self._lock:
+            return { 'api_calls' : sum(self._calls.values()), 'calls' : dict(self._calls),
+                     'retries' : self._retries, 'coalesced' : self._coalesced, 'throttled_s' : self._throttled_s }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get(connect, rate=DefaultRate, burst=DefaultBurst):
+    '''The client shared by everything in this process, created with
+    connect (see Client) on first use.'''
+    global _client
+    with _client_lock:
+        if _client is None: _client = Client(connect, rate=rate, burst=burst)
+        return _client
+
+def reset():
+    '''Drop the shared client, e.g. when the account behind it changes.'''
+    global _client
+    with _client_lock:
+        _client = None
+
+def stats():
+    if _client is None: return { 'api_calls' : 0, 'calls' : {}, 'retries' : 0, 'coalesced' : 0, 'throttled_s' : 0.0 }
+    return _client.stats()
+
+def _report():
+    # Only worth mentioning when EC2 pushed back
+    summary = stats()
+    if summary['retries']:
+        print "EC2 API: %d requests, %d retried after throttling, %.1fs spent throttled" % (
+            summary['api_calls'], summary['retries'], summary['throttled_s'])
+
+atexit.register(_report)
@@ -6,6 +6,8 @@ class EC2GroupConfig(NodeGroupConfig):
     TypeName = 'ec2'
     Attributes = ['name', 'typename', 'size', 'state',
                   'keypair', 'instance_type', 'group', 'ami', 'puppet_master']
+    # See placement.py
+    OptionalAttributes = { 'placement_strategy' : None, 'zone_selection' : 'random' }
 
     def __init__(self, name, **kwargs):
         # If we've got any non-name params, ensure we have the expected set
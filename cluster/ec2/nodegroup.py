@@ -1,7 +1,13 @@
 import nodes
 import puppet
 import sirikata
+import cdn
+import provision
 import cluster.util
+import cluster.util.results as results
+import cluster.util.dag as dag
+import cluster.util.config as config
+import os
 from groupconfig import EC2GroupConfig
 
 class NodeGroup(cluster.util.NodeGroup):
@@ -11,25 +17,40 @@ class NodeGroup(cluster.util.NodeGroup):
         ('ec2 create', nodes.create),
         ('ec2 nodes boot', nodes.boot),
         ('ec2 nodes request spot instances', nodes.request_spot_instances),
+        ('ec2 zones rank', nodes.rank_zones),
         ('ec2 nodes import', nodes.import_nodes),
         ('ec2 nodes wait ready', nodes.wait_nodes_ready),
         ('ec2 members info', nodes.members_info),
         ('ec2 node ssh', nodes.node_ssh),
         ('ec2 ssh', nodes.ssh),
         ('ec2 add service', nodes.add_service),
+        ('ec2 services up', nodes.services_up),
         ('ec2 service status', nodes.service_status),
+        ('ec2 services rolling-restart', nodes.services_rolling_restart),
         ('ec2 list services', nodes.list_services),
         ('ec2 remove service', nodes.remove_service),
         ('ec2 remove all services', nodes.remove_all_services),
+        ('ec2 agent install', nodes.agent_install),
+        ('ec2 agent remove', nodes.agent_remove),
+        ('ec2 facts refresh', nodes.facts_refresh),
+        ('ec2 facts show', nodes.facts_show),
+        ('ec2 network probe', nodes.network_probe),
         ('ec2 node set type', nodes.set_node_type),
         ('ec2 nodes terminate', nodes.terminate),
         ('ec2 destroy', nodes.destroy),
         ('ec2 sync sirikata', sirikata.sync_sirikata),
         ('ec2 sync files', nodes.sync_files),
+        ('ec2 gather', nodes.gather),
+        ('ec2 logs follow', nodes.logs_follow),
+        ('ec2 cdn replicate', cdn.replicate),
+        ('ec2 cdn seed', cdn.seed),
 
         ('puppet master config', puppet.master_config),
         ('puppet slaves restart', puppet.slaves_restart),
         ('puppet update', puppet.update),
+        ('puppet node update', puppet.update_node),
+
+        ('provision push', provision.push),
 
         # Version that only packages into a tar.bz2 but doesn't
         # distribute. Needs to be included as a command somehwere, but
@@ -45,28 +66,47 @@ class NodeGroup(cluster.util.NodeGroup):
 
 
     def boot(self, **kwargs):
-        return (nodes.boot(self.config, **kwargs) == 0)
+        return results.wrap('ec2 boot', nodes.boot(self.config, **kwargs))
 
     def nodes(self, **kwargs):
         return nodes.members_info_data(self.config)
 
     def sync_sirikata(self, path, **kwargs):
-        return (sirikata.sync_sirikata(self.config, path) == 0)
+        return results.wrap('ec2 sync sirikata', sirikata.sync_sirikata(path, **{ 'notify-puppets' : self.config }))
 
     def sync_files(self, target, src, dest, **kwargs):
-        return (nodes.sync_files(self.config, target, src, dest, **kwargs) == 0)
+        return results.wrap('ec2 sync files', nodes.sync_files(self.config, target, src, dest, **kwargs))
+
+    def gather(self, remote_path, local_dir, **kwargs):
+        return results.wrap('ec2 gather', nodes.gather(self.config, remote_path, local_dir, **kwargs))
+
+    def log_streams(self, service_names=None, lines=10, pattern=None, **kwargs):
+        pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+        return nodes.log_streams(self.config, service_names, pemfile=pemfile, lines=lines, pattern=pattern)
 
     def add_service(self, name, target, command, user=None, cwd=None, **kwargs):
         nkwargs = dict(kwargs)
         if user is not None: nkwargs['user'] = user
         if cwd is not None: nkwargs['cwd'] = cwd
-        return (nodes.add_service(self.config, name, target, *command, **nkwargs) == 0)
+        return results.wrap('ec2 add service', nodes.add_service(self.config, name, target, *command, **nkwargs))
+
+    def start_services(self, specs, parallelism=None, timeout=300, **kwargs):
+        return results.wrap('ec2 services up', nodes.start_services(self.config, dag.validate(specs), parallelism=parallelism, timeout=timeout, **kwargs))
 
-    def service_status(self, name, **kwargs):
-        return (nodes.service_status(self.config, name) == 0)
+    def probe(self, checks, **kwargs):
+        return nodes.probe_services(self.config, checks, **kwargs)
+
+    def service_status(self, *names, **kwargs):
+        return results.wrap('ec2 service status', nodes.service_status(self.config, *names, **kwargs))
+
+    def restart_service(self, name, version=None, **kwargs):
+        return nodes.restart_service(self.config, name, version=version, **kwargs)
 
     def remove_service(self, name, **kwargs):
-        return (nodes.remove_service(self.config, name) == 0)
+        return results.wrap('ec2 remove service', nodes.remove_service(self.config, name))
+
+    def facts(self, node=None, ttl=None, **kwargs):
+        return nodes.node_facts(self.config, node, ttl=ttl, **kwargs)
 
     def terminate(self, **kwargs):
-        return (nodes.terminate(self.config, **kwargs) == 0)
+        return results.wrap('ec2 terminate', nodes.terminate(self.config, **kwargs))
@@ -4,10 +4,25 @@ from groupconfig import EC2GroupConfig
 import cluster.util.config as config
 import cluster.util.data as data
 import cluster.util.arguments as arguments
+import cluster.util.trace as trace
+import cluster.util.results as results
+import cluster.util.parallel as parallel
+import cluster.util.transfer as transfer
+import cluster.util.logs as logs
+import cluster.util.dag as dag
+import cluster.util.resources as resources
+import cluster.util.agent as agent
+import cluster.util.facts as facts
+import cluster.util.network as network
+import cluster.util.journal as journal
+import cluster.util.services as services
+import redisconf
+import placement
+import client
+import cdn
 from boto.ec2.connection import EC2Connection
-import json, os, time, subprocess
+import json, os, sys, time, subprocess
 import re
-import random
 
 def ssh_escape(x):
     '''Escaping rules are confusing... This escapes an argument enough to get it through ssh'''
@@ -18,6 +33,11 @@ def ssh_escape(x):
 def instance_name(cname, idx):
     return cname + '-' + str(idx)
 
+def connect():
+    '''The EC2 API client shared by all handlers, see client.py.'''
+    return client.get(lambda: EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY),
+                      rate=float(config.get('SIRIKATA_EC2_API_RATE', default=client.DefaultRate)))
+
 def name_and_config(name_or_config):
     '''Get a name and config given either a name or a config.'''
     if isinstance(name_or_config, EC2GroupConfig):
@@ -46,7 +66,7 @@ def create_security_group(*args, **kwargs):
 
     group_name, group_desc = arguments.parse_or_die(create_security_group, [str, str], *args)
 
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    conn = connect()
     # We may already have a security group with this name that needs updating
     sgs = conn.get_all_security_groups()
     matches = [sg for sg in sgs if sg.name == group_name]
@@ -84,10 +104,17 @@ def create_security_group(*args, **kwargs):
 
 
 def create(*args, **kwargs):
-    """ec2 create name size puppet_master keypair [--instance-type=t1.micro] [--group=security_group] [--ami=i-x7395]
+    """ec2 create name size puppet_master keypair [--instance-type=t1.micro] [--group=security_group] [--ami=i-x7395] [--placement=cluster|spread] [--zone=random|price|fulfillment|ZONE]
 
     Create a new cluster. This just creates a record of the cluster
     and saves its properties, it doesn't actually allocate any nodes.
+
+    --placement launches the nodes in a placement group, 'cluster' to
+    keep them close together on the network or 'spread' to keep them on
+    separate hardware. --zone chooses the availability zone: at
+    random (the default), with the lowest current spot price, where a
+    bid would have been met for most of the last day, or a specific
+    zone.
     """
 
     name, size, puppet_master, keypair = arguments.parse_or_die(create, [str, int, str, str], *args)
@@ -95,12 +122,22 @@ def create(*args, **kwargs):
     instance_type = config.kwarg_or_get('instance-type', kwargs, 'INSTANCE_TYPE')
     group = config.kwarg_or_get('group', kwargs, 'SECURITY_GROUP')
     ami = config.kwarg_or_get('ami', kwargs, 'BASE_AMI')
+    placement_strategy = config.kwarg_or_default('placement', kwargs, default=None)
+    zone_selection = config.kwarg_or_default('zone', kwargs, default='random')
+
+    try:
+        placement.validate(placement_strategy, zone_selection, size)
+    except Exception as e:
+        print str(e)
+        return 1
 
     cc = EC2GroupConfig(name,
                            size=size, keypair=keypair,
                            instance_type=instance_type,
                            group=group, ami=ami,
-                           puppet_master=puppet_master)
+                           puppet_master=puppet_master,
+                           placement_strategy=placement_strategy,
+                           zone_selection=zone_selection)
     cc.save()
 
     # Make sure we have a nodes config for puppet. Not needed here,
@@ -111,7 +148,7 @@ def create(*args, **kwargs):
     return 0
 
 def boot(*args, **kwargs):
-    """ec2 nodes boot name_or_config [--wait-timeout=300 --pem=/path/to/key.pem]
+    """ec2 nodes boot name_or_config [--wait-timeout=300 --pem=/path/to/key.pem] [--resume]
 
     Boot a cluster's nodes. The command will block for wait-timeout
     seconds, or until all nodes reach a ready state (currently defined
@@ -120,53 +157,68 @@ def boot(*args, **kwargs):
     file, either passed on the command line or through the environment
     is required for the timeout to work properly. Note that with
     timeouts enabled, this will check that the nodes reach a ready
-    state.
+    state. Nodes that become ready have their local CDN seeded with
+    their peers' models.
+
+    Each node's progress is journaled. If the boot is interrupted or
+    some nodes don't become ready, --resume continues with the nodes
+    that were already launched, only retrying the steps they haven't
+    completed.
     """
 
     name_or_config = arguments.parse_or_die(boot, [object], *args)
     timeout = config.kwarg_or_default('wait-timeout', kwargs, default=600)
     # Note pemfile is different from other places since it's only required with wait-timeout.
     pemfile = config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE', default=None)
+    resume = bool(config.kwarg_or_default('resume', kwargs, default=False))
     name, cc = name_and_config(name_or_config)
 
-    if 'reservation' in cc.state or 'spot' in cc.state or 'instances' in cc.state:
+    if resume and 'spot' in cc.state:
+        print "This cluster's nodes came from a spot request, use ec2 nodes import --resume instead."
+        return 1
+    if not resume and ('reservation' in cc.state or 'spot' in cc.state or 'instances' in cc.state):
         print "It looks like you already have active nodes for this cluster..."
-        exit(1)
+        print "Use --resume to finish setting up nodes from an interrupted boot."
+        return 1
 
     if timeout > 0 and not pemfile:
         print "You need to specify a pem file to use timeouts."
-        exit(1)
+        return 1
 
     # Load the setup script template, replace puppet master info
     user_data = data.load('ec2-user-data', 'node-setup.sh')
     user_data = user_data.replace('{{{PUPPET_MASTER}}}', cc.puppet_master)
 
-    # Unlike spot instances, where we can easily request that any
-    # availability zone be used by that all be in the same AZ, here we
-    # have to specify an AZ directly. We just choose one randomly for now...
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
-    zones = conn.get_all_zones()
-    zone = random.choice(zones).name
-
-    # Now create the nodes
-    reservation = conn.run_instances(cc.ami,
-                                     placement=zone,
-                                     min_count=cc.size, max_count=cc.size,
-                                     key_name=cc.keypair,
-                                     instance_type=cc.instance_type,
-                                     security_groups=[cc.group],
-                                     user_data=user_data
-                                     )
-
-    # Save reservation, instance info
-    cc.state['reservation'] = reservation.id
-    cc.state['instances'] = [inst.id for inst in reservation.instances]
-    cc.save()
+    conn = connect()
+    progress = journal.Journal(cc, 'boot', resume=resume)
+    if 'instances' in cc.state:
+        print "Nodes were already launched, continuing with their setup"
+    else:
+        # Unlike spot instances, where we can easily request that any
+        # availability zone be used by that all be in the same AZ, here we
+        # have to specify an AZ directly.
+        zone, group_name = choose_placement(cc, conn)
+
+        # Now create the nodes
+        reservation = conn.run_instances(cc.ami,
+                                         placement=zone,
+                                         placement_group=group_name,
+                                         min_count=cc.size, max_count=cc.size,
+                                         key_name=cc.keypair,
+                                         instance_type=cc.instance_type,
+                                         security_groups=[cc.group],
+                                         user_data=user_data
+                                         )
+
+        # Save reservation, instance info
+        cc.state['reservation'] = reservation.id
+        cc.state['instances'] = [inst.id for inst in reservation.instances]
+        cc.save()
     # Cache some information about the instances which shouldn't
     # change. However, this can take some time to come up properly, so
     # we may need to poll a few times before we get the right info
     print "Collecting node information..."
-    while True:
+    while 'instance_props' not in cc.state:
         new_instances = get_all_instances(cc, conn)
         if any([inst.ip_address is None or inst.dns_name is None or inst.private_ip_address is None or inst.private_dns_name is None for inst in new_instances.values()]):
             time.sleep(5)
@@ -180,9 +232,22 @@ def boot(*args, **kwargs):
                         'private_ip' : inst.private_ip_address,
                         'private_hostname' : inst.private_dns_name,
                         }) for inst in new_instances.values()])
-        break
     cc.save()
-    return name_and_boot_nodes(cc, conn, pemfile, timeout)
+    return name_and_boot_nodes(cc, conn, pemfile, timeout, progress)
+
+def choose_placement(cc, conn, bid=None):
+    '''Choose the zone and placement group for new nodes, recording
+    them in the cluster state. Returns (zone, placement group name or
+    None).'''
+    zone, ranking = placement.choose_zone(conn, cc, bid=bid)
+    if ranking and results.get_format() == 'text':
+        print placement.format_table(ranking)
+    group_name = placement.ensure_group(conn, cc)
+    print "Launching in %s%s" % (zone, (' in placement group %s (%s)' % (group_name, cc.placement_strategy)) if group_name else '')
+    cc.state['placement'] = { 'zone' : zone, 'group' : group_name, 'strategy' : cc.placement_strategy,
+                              'selection' : cc.zone_selection, 'ranking' : ranking }
+    cc.save()
+    return (zone, group_name)
 
 def request_spot_instances(*args, **kwargs):
     """ec2 nodes request spot instances name_or_config price
@@ -202,15 +267,22 @@ def request_spot_instances(*args, **kwargs):
 
     if 'reservation' in cc.state or 'spot' in cc.state or 'instances' in cc.state:
         print "It looks like you already have active nodes for this cluster..."
-        exit(1)
+        return 1
 
     # Load the setup script template, replace puppet master info
     user_data = data.load('ec2-user-data', 'node-setup.sh')
     user_data = user_data.replace('{{{PUPPET_MASTER}}}', cc.puppet_master)
 
     # Now create the nodes
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    conn = connect()
+    # With the default random zone selection we leave the choice to
+    # EC2, which only has to keep them in one zone
+    zone, group_name = None, placement.ensure_group(conn, cc)
+    if cc.zone_selection != 'random':
+        zone, group_name = choose_placement(cc, conn, bid=float(price))
     request = conn.request_spot_instances(price, cc.ami,
+                                          placement=zone,
+                                          placement_group=group_name,
                                           # launch group is just a
                                           # name that causes these to
                                           # only launch if all can be
@@ -235,8 +307,38 @@ def request_spot_instances(*args, **kwargs):
     print "Requested %d spot instances" % cc.size
     return 0
 
+def rank_zones(*args, **kwargs):
+    """ec2 zones rank name_or_config [--bid=PRICE] [--hours=24]
+
+    Show how the availability zones compare for this cluster's instance
+    type: their current spot price and the share of the last hours
+    during which a bid of PRICE (by default the median current price)
+    would have been met, in the order the cluster's zone selection
+    would prefer them.
+    """
+
+    name_or_config = arguments.parse_or_die(rank_zones, [object], *args)
+    bid = config.kwarg_or_default('bid', kwargs, default=None)
+    hours = float(config.kwarg_or_default('hours', kwargs, default=placement.DefaultHistoryHours))
+    name, cc = name_and_config(name_or_config)
+
+    conn = connect()
+    selection = cc.zone_selection if cc.zone_selection in ['price', 'fulfillment'] else 'price'
+    zones = [zone.name for zone in conn.get_all_zones()]
+    now = time.time()
+    ranking = placement.rank(placement.price_history(conn, cc.instance_type, zones, now - hours * 3600, now),
+                             selection, float(bid) if bid is not None else None, now - hours * 3600, now)
+
+    result = results.Result('zones rank')
+    for entry in ranking:
+        result.add_node(entry['zone'], 0, data=entry)
+    result.data = { 'selection' : selection, 'ranking' : ranking }
+    if results.get_format() == 'text':
+        print placement.format_table(ranking)
+    return result.finish()
+
 def import_nodes(*args, **kwargs):
-    """ec2 nodes import name_or_config instance1_id instance2_id ... [--wait-timeout=300 --pem=/path/to/key.pem]
+    """ec2 nodes import name_or_config instance1_id instance2_id ... [--wait-timeout=300 --pem=/path/to/key.pem] [--resume]
 
     Import instances from a spot reservation and then perform the boot sequence on them.
     The command will block for wait-timeout
@@ -246,22 +348,28 @@ def import_nodes(*args, **kwargs):
     file, either passed on the command line or through the environment
     is required for the timeout to work properly. Note that with
     timeouts enabled, this will check that the nodes reach a ready
-    state.
+    state. Nodes that become ready have their local CDN seeded with
+    their peers' models.
     """
 
     name_or_config, instances_to_add = arguments.parse_or_die(import_nodes, [object], rest=True, *args)
     timeout = config.kwarg_or_default('wait-timeout', kwargs, default=600)
     # Note pemfile is different from other places since it's only required with wait-timeout.
     pemfile = config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE', default=None)
+    resume = bool(config.kwarg_or_default('resume', kwargs, default=False))
     name, cc = name_and_config(name_or_config)
 
     if 'spot' not in cc.state:
         print "It looks like this cluster hasn't made a spot reservation..."
         return 1
 
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    conn = connect()
+    progress = journal.Journal(cc, 'boot', resume=resume)
 
     instances_to_add = list(instances_to_add)
+    if resume and not instances_to_add and 'instance_props' in cc.state:
+        print "Nodes were already imported, continuing with their setup"
+        return name_and_boot_nodes(cc, conn, pemfile, timeout, progress)
     if len(instances_to_add) == 0:
         print "No instances specified, trying to use full list of account instances..."
         reservations = conn.get_all_instances()
@@ -293,52 +401,72 @@ def import_nodes(*args, **kwargs):
                     }) for instid in instances_to_add])
     cc.save()
 
-    return name_and_boot_nodes(cc, conn, pemfile, timeout)
+    return name_and_boot_nodes(cc, conn, pemfile, timeout, progress)
 
-def name_and_boot_nodes(cc, conn, pemfile, timeout):
+def name_and_boot_nodes(cc, conn, pemfile, timeout, progress):
     '''After instances have been allocated to the cluster (by booting
     them directly or importing the instance IDs), this names them and
-    runs the boot sequence to get them configured.
+    runs the boot sequence to get them configured, recording each
+    node's progress in the journal progress.
     '''
 
     # Name the nodes
-    for idx,inst_id in enumerate(cc.state['instances']):
-        conn.create_tags([inst_id], {"Name": instance_name(cc.name, idx)})
+    to_name = progress.todo(cc.state['instances'], 'name')
+    conn.tag_each(dict([(inst_id, {"Name": instance_name(cc.name, cc.state['instances'].index(inst_id))}) for inst_id in to_name]))
+    for inst_id in to_name: progress.mark(inst_id, 'name', True)
 
     if timeout > 0:
-        wait_kwargs = { 'wait-timeout' : timeout }
+        wait_kwargs = { 'wait-timeout' : timeout, 'journal' : progress }
         if pemfile is not None: wait_kwargs['pem'] = pemfile
 
-        return wait_nodes_ready(cc, **wait_kwargs)
+        result = wait_nodes_ready(cc, **wait_kwargs)
+        # New nodes get their peers' models up front instead of
+        # serving cold misses. They work without them, so failing to
+        # seed doesn't fail the boot.
+        cdn.seed_ready(cc, os.path.expanduser(config.kwarg_or_get('pem', wait_kwargs, 'SIRIKATA_CLUSTER_PEMFILE')), progress)
+        return progress.finish(result)
 
-    return 0
+    return progress.finish(results.Result('ec2 nodes boot').finish())
 
 def wait_nodes_ready(*args, **kwargs):
-    '''ec2 nodes wait ready name_or_config [--wait-timeout=300 --pem=/path/to/key.pem]
+    '''ec2 nodes wait ready name_or_config [--wait-timeout=300 --pem=/path/to/key.pem] [--resume]
 
     Wait for nodes to finish booting and become fully ready, i.e. all
     packages to be installed have finished installing. Normally this
     will be invoked during boot or import, but can be useful if those
     run into a problem and you want to make sure all nodes have gotten
-    back to a good state.
+    back to a good state. With --resume, nodes found ready by an
+    earlier, partly failed run aren't checked again.
     '''
 
     name_or_config = arguments.parse_or_die(wait_nodes_ready, [object], *args)
     timeout = int(config.kwarg_or_get('timeout', kwargs, 'SIRIKATA_PING_WAIT_TIMEOUT', default=300))
     pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    resume = bool(config.kwarg_or_default('resume', kwargs, default=False))
 
     name, cc = name_and_config(name_or_config)
+    # boot and import pass in their journal, otherwise we keep our own
+    progress = kwargs.get('journal')
+    own_journal = progress is None
+    if own_journal: progress = journal.Journal(cc, 'wait ready', resume=resume)
 
+    result = results.Result('ec2 nodes wait ready')
     print "Waiting for nodes to become pingable..."
-    pingable = wait_pingable(cc, timeout=timeout)
-    if pingable != 0: return pingable
-    # Give a bit more time for the nodes to become ready, pinging
-    # may happen before all services are finished starting
-    print "Sleeping to allow nodes to finish booting"
-    time.sleep(15)
+    pingable = wait_pingable(cc, timeout=timeout, journal=progress)
+    # Nodes that never answered are done for this run, but the others
+    # can still become ready
+    result.nodes += [nr for nr in pingable.nodes if nr.retcode != 0]
+    if [node_id for node_id in cc.state['instances'] if progress.status(node_id, 'pingable') == 'done' and not progress.done(node_id, 'ready')]:
+        # Give a bit more time for the nodes to become ready, pinging
+        # may happen before all services are finished starting
+        print "Sleeping to allow nodes to finish booting"
+        time.sleep(15)
     print "Waiting for initial services and Sirikata binaries to install"
-    ready = wait_ready(cc, '/home/ubuntu/ready/sirikata', timeout=timeout, pem=pemfile)
-    return ready
+    ready = wait_ready(cc, '/home/ubuntu/ready/sirikata', timeout=timeout, pem=pemfile, journal=progress)
+    result.nodes += ready.nodes
+    result.finish()
+    if own_journal: return progress.finish(result)
+    return result
 
 
 def get_all_instances(cc, conn):
@@ -411,13 +539,22 @@ def wait_pingable(*args, **kwargs):
     name_or_config = arguments.parse_or_die(wait_pingable, [object], *args)
     timeout = int(config.kwarg_or_get('timeout', kwargs, 'SIRIKATA_PING_WAIT_TIMEOUT', default=0))
 
+    progress = kwargs.get('journal')
+
     name, cc = name_and_config(name_or_config)
 
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    result = results.Result('ec2 wait pingable')
+    pending = list(cc.state['instances'])
+    if progress is not None:
+        pending = progress.todo(pending, 'pingable')
+        for node_id in cc.state['instances']:
+            if node_id not in pending: progress.skip(result, node_id, 'pingable')
+
+    conn = connect()
     # We need to loop until we can get IPs for all nodes
     waited = 0
     while (timeout == 0 or waited < timeout):
-        instances_ips = get_all_ips(cc, conn)
+        instances_ips = dict([(node_id, ip) for node_id, ip in get_all_ips(cc, conn).items() if node_id in pending])
         not_pinged = set(instances_ips.keys())
 
         # If none are missing IPs, we can exit
@@ -435,18 +572,24 @@ def wait_pingable(*args, **kwargs):
         # One of those rare instances we just want to dump the output
         retcode = 0
         with open('/dev/null', 'w') as devnull:
-            retcode = subprocess.call(['ping', '-c', '2', str(ip)], stdout=devnull, stderr=devnull)
+            with trace.span('wait pingable', node=node_id):
+                retcode = subprocess.call(['ping', '-c', '2', str(ip)], stdout=devnull, stderr=devnull)
         if retcode == 0: # ping success
             not_pinged.remove(node_id)
+            if progress is not None: progress.mark(node_id, 'pingable', True)
+            result.add_node(node_id, 0, duration=result.duration)
             continue
         time.sleep(5)
         waited += 5
 
     if not_pinged:
         print "Failed to ping %s" % (next(iter(not_pinged)))
-        exit(1)
+        for node_id in not_pinged:
+            if progress is not None: progress.mark(node_id, 'pingable', False, error='not pingable')
+            result.add_node(node_id, 1, duration=result.duration, error='not pingable')
+        return result.finish()
     print "Success"
-    return 0
+    return result.finish()
 
 def wait_ready(*args, **kwargs):
     '''Wait for nodes to become ready, with an optional timeout. Ready
@@ -458,11 +601,21 @@ def wait_ready(*args, **kwargs):
     timeout = int(config.kwarg_or_get('timeout', kwargs, 'SIRIKATA_READY_WAIT_TIMEOUT', default=0))
     pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
 
+    progress = kwargs.get('journal')
+
     name, cc = name_and_config(name_or_config)
 
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    result = results.Result('ec2 wait ready')
+    pending = list(cc.state['instances'])
+    if progress is not None:
+        # Only nodes that were reachable can become ready
+        pending = progress.todo([node_id for node_id in pending if progress.status(node_id, 'pingable') == 'done'], 'ready')
+        for node_id in cc.state['instances']:
+            if progress.done(node_id, 'ready'): progress.skip(result, node_id, 'ready')
+
+    conn = connect()
 
-    instances_ips = get_all_ips(cc, conn)
+    instances_ips = dict([(node_id, ip) for node_id, ip in get_all_ips(cc, conn).items() if node_id in pending])
     not_ready = set(instances_ips.keys())
 
     # Just loop, waiting on any (i.e. the first) node in the set, reset our timeout
@@ -476,18 +629,24 @@ def wait_ready(*args, **kwargs):
         for file_to_check in files_to_check:
             if remote_cmd: remote_cmd.append('&&')
             remote_cmd += ['test', '-f', file_to_check]
-        retcode = node_ssh(cc, node_idx, *remote_cmd, pem=pemfile)
+        with trace.span('wait ready', node=node_id):
+            retcode = node_ssh(cc, node_idx, *remote_cmd, pem=pemfile)
         if retcode == 0: # command success
             not_ready.remove(node_id)
+            if progress is not None: progress.mark(node_id, 'ready', True)
+            result.add_node(node_id, 0, duration=result.duration)
             continue
         time.sleep(5)
         waited += 5
 
     if not_ready:
         print "Failed to find readiness indicators for %s" % (next(iter(not_ready)))
-        exit(1)
+        for node_id in not_ready:
+            if progress is not None: progress.mark(node_id, 'ready', False, error='readiness indicators not found')
+            result.add_node(node_id, 1, duration=result.duration, error='readiness indicators not found')
+        return result.finish()
     print "Success"
-    return 0
+    return result.finish()
 
 
 def members_info_data(*args, **kwargs):
@@ -501,7 +660,7 @@ def members_info_data(*args, **kwargs):
 
     if 'instances' not in cc.state or 'instance_props' not in cc.state:
         print "It doesn't look like you've booted the cluster yet..."
-        exit(1)
+        return []
 
     # We provide a bit more than what we store in the file
     inst_map = dict([ (instid,cc.state['instance_props'][instid]) for instid in cc.state['instances']])
@@ -527,8 +686,25 @@ def members_info(*args, **kwargs):
     """
 
     instances = members_info_data(*args, **kwargs)
-    print json.dumps(instances, indent=4)
+    if results.get_format() == 'text':
+        print json.dumps(instances, indent=4)
+    return results.Result('ec2 members info', retcode=0 if instances else 1, data=instances)
+
+
+def node_ssh_args(cc, idx_or_name_or_node, pemfile):
+    '''The ssh command line, up to but not including the remote
+    command, used to reach a node. Useful when you need to talk to the
+    remote command through pipes rather than just run it.'''
+    inst_info = cc.state['instance_props'][cc.get_node_name(idx_or_name_or_node)]
+    # StrictHostKeyChecking no -- causes the "authenticity of host can't be
+    # established" messages to not show up, and therefore not require prompting
+    # the user. Not entirely safe, but much less annoying than having each node
+    # require user interaction during boot phase
+    return ["ssh", "-o", "StrictHostKeyChecking no", "-i", pemfile, cc.user() + "@" + inst_info['hostname']]
 
+def rsync_ssh(pemfile):
+    '''The remote shell to give rsync's -e option to reach nodes.'''
+    return "ssh -o 'StrictHostKeyChecking no' -i " + pemfile
 
 def node_ssh(*args, **kwargs):
     """ec2 node ssh cluster_name_or_config idx_or_name_or_node [--pem=/path/to/key.pem] [optional additional arguments give command just like with real ssh]
@@ -543,81 +719,151 @@ def node_ssh(*args, **kwargs):
 
     if 'instances' not in cc.state:
         print "It doesn't look like you've booted the cluster yet..."
-        exit(1)
+        return 1
 
-    inst_info = cc.state['instance_props'][cc.get_node_name(idx_or_name_or_node)]
-
-    # StrictHostKeyChecking no -- causes the "authenticity of host can't be
-    # established" messages to not show up, and therefore not require prompting
-    # the user. Not entirely safe, but much less annoying than having each node
-    # require user interaction during boot phase
-    cmd = ["ssh", "-o", "StrictHostKeyChecking no", "-i", pemfile, cc.user() + "@" + inst_info['hostname']] + [ssh_escape(x) for x in remote_cmd]
-    return subprocess.call(cmd)
+    node_name = cc.get_node_name(idx_or_name_or_node)
+    conn = agent_connection(cc, node_name, pemfile) if remote_cmd else None
+    if conn is not None:
+        try:
+            # Same quoting as ssh, which hands the command to a shell
+            with trace.span('node ssh', node=node_name):
+                retcode, out, err = conn.run(['/bin/bash', '-c', ' '.join([ssh_escape(x) for x in remote_cmd])])
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            return retcode
+        except agent.AgentError as e:
+            agent.lost((cc.name, node_name), e)
+    cmd = node_ssh_args(cc, node_name, pemfile) + [ssh_escape(x) for x in remote_cmd]
+    with trace.span('node ssh', node=node_name):
+        return subprocess.call(cmd)
+
+def agent_connection(cc, node_id, pemfile=None):
+    '''Get a connection to the node's agent, or None if it doesn't have
+    one (see agent install) or it can't be reached.'''
+    socket_path = cc.state.get('agent', {}).get(node_id)
+    if socket_path is None: return None
+    if pemfile is None: pemfile = os.path.expanduser(config.kwarg_or_get('pem', {}, 'SIRIKATA_CLUSTER_PEMFILE'))
+    return agent.connection((cc.name, node_id), node_id, node_ssh_args(cc, node_id, pemfile), socket_path)
 
 def ssh(*args, **kwargs):
-    """ec2 ssh cluster_name_or_config [--pem=/path/to/key.pem] [required additional arguments give command just like with real ssh]
+    """ec2 ssh cluster_name_or_config [--pem=/path/to/key.pem] [--parallel=1] [required additional arguments give command just like with real ssh]
 
-    Run an SSH command on every node in the cluster. Note that this
-    currently doesn't parallelize at all, so it can be a bit
-    slow. This won't do ssh sessions -- you *must* provide a command
-    to execute.
+    Run an SSH command on every node in the cluster. By default nodes
+    are handled one at a time; use --parallel=N to run on up to N
+    nodes at once (output from different nodes may interleave). This
+    won't do ssh sessions -- you *must* provide a command to execute.
     """
 
     name_or_config, remote_cmd = arguments.parse_or_die(ssh, [object], rest=True, *args)
     pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=1))
     if not remote_cmd:
         print "You need to add a command to execute across all the nodes."
-        exit(1)
+        return 1
 
     name, cc = name_and_config(name_or_config)
-    for inst_idx in range(len(cc.state['instances'])):
-        node_ssh(cc, inst_idx, *remote_cmd, pem=pemfile)
 
+    result = results.Result('ec2 ssh')
+    def run_on_node(inst_id):
+        start = time.time()
+        retcode = node_ssh(cc, inst_id, *remote_cmd, pem=pemfile)
+        result.add_node(inst_id, retcode, duration=time.time()-start)
+    parallel.run(run_on_node, cc.state['instances'], parallelism=parallelism)
+    return result.finish()
 
-def sync_files(*args, **kwargs):
-    """ec2 sync files cluster_name_or_config idx_or_name_or_node target local_or_remote:/path local_or_remote:/path [--pem=/path/to/key.pem]
 
-    Synchronize files or directories between a the local host and a cluster node.
+def sync_files(*args, **kwargs):
+    """ec2 sync files cluster_name_or_config all|idx_or_name_or_node[,idx_or_name_or_node...] local_or_remote:/path local_or_remote:/path [--parallel=N] [--bwlimit=KBPS] [--node-bwlimit=KBPS] [--compress] [--pem=/path/to/key.pem]
+
+    Synchronize files or directories between a the local host and a
+    cluster node, a list of nodes or all nodes. Transfers to multiple
+    nodes run concurrently (up to --parallel at a time). --bwlimit
+    caps the total bandwidth used across all transfers and
+    --node-bwlimit the bandwidth of each one, both in KB/s. --compress
+    compresses data on the wire.
     """
 
     name_or_config, idx_or_name_or_node, src_path, dest_path = arguments.parse_or_die(sync_files, [object, object, str, str], *args)
     pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    options = transfer.Options(kwargs)
 
     name, cc = name_and_config(name_or_config)
 
     if 'instances' not in cc.state:
         print "It doesn't look like you've booted the cluster yet..."
-        exit(1)
+        return 1
 
-    # Get remote info
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
-    if idx_or_name_or_node == 'all':
-        instances_info = [ inst_props for instid, inst_props in cc.state['instance_props'].iteritems() ]
+    targets = transfer.split_targets(idx_or_name_or_node)
+    if targets is None:
+        instances_info = [ cc.state['instance_props'][instid] for instid in cc.state['instances'] ]
     else:
-        instances_info = [ cc.state['instance_props'][cc.get_node_name(idx_or_name_or_node)] ]
+        instances_info = [ cc.state['instance_props'][cc.get_node_name(target)] for target in targets ]
 
-    results = []
+    transfers = []
     for instance_info in instances_info:
         node_address = cc.user() + "@" + instance_info['hostname'] + ':'
+        paths = [p.replace('local:', '').replace('remote:', node_address) for p in [src_path, dest_path]]
+        transfers.append( (instance_info['id'], paths[0], paths[1]) )
 
-        # Get correct values out for names
-        paths = [src_path, dest_path]
-        paths = [p.replace('local:', '').replace('remote:', node_address) for p in paths]
-        src_path_final, dest_path_final = tuple(paths)
+    return transfer.run('ec2 sync files', transfers, options, ssh=rsync_ssh(pemfile))
 
-        # Make a single copy onto one of the nodes
-        results.append( subprocess.call(["rsync", "-e", "ssh -i " + pemfile, src_path_final, dest_path_final]) )
-        #results.append( subprocess.call(["scp", "-i", pemfile, src_path_final, dest_path_final]) )
+def gather(*args, **kwargs):
+    """ec2 gather cluster_name_or_config /remote/path /local/dir [--incremental] [--parallel=N] [--bwlimit=KBPS] [--node-bwlimit=KBPS] [--compress=false] [--pem=/path/to/key.pem]
 
-    # Just pick one non-zero return value if any failed
-    failed = [res for res in results if res != 0]
-    if failed:
-        return failed[0]
-    return 0
+    Pull a file or directory from every node concurrently into
+    /local/dir/<node id>/, e.g. to collect logs, traces and stats after
+    an experiment. Interrupted transfers are resumed and data is
+    compressed on the wire. With --incremental, only data appended to
+    files since the last gather is fetched, so collecting growing logs
+    periodically during a long run is cheap.
+    """
+
+    name_or_config, remote_path, local_dir = arguments.parse_or_die(gather, [object, str, str], *args)
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    incremental = bool(config.kwarg_or_default('incremental', kwargs, default=False))
+    options = transfer.Options(kwargs, compress=True)
+
+    name, cc = name_and_config(name_or_config)
+
+    if 'instances' not in cc.state:
+        print "It doesn't look like you've booted the cluster yet..."
+        return 1
+
+    sources = []
+    for instid in cc.state['instances']:
+        instance_info = cc.state['instance_props'][instid]
+        sources.append( (instance_info['id'], cc.user() + "@" + instance_info['hostname'] + ':' + remote_path) )
+    return transfer.gather('ec2 gather', sources, local_dir, options, incremental=incremental, ssh=rsync_ssh(pemfile))
+
+
+def log_streams(cc, service_names=None, pemfile=None, lines=10, pattern=None):
+    '''Get a logs.Stream for each node running the services.'''
+    return [logs.Stream(node_id, node_ssh_args(cc, node_id, pemfile), logfiles, lines=lines, pattern=pattern)
+            for node_id, logfiles in sorted(logs.service_logfiles(cc.state.get('services', {}), service_names).items())]
+
+def logs_follow(*args, **kwargs):
+    """ec2 logs follow cluster_name_or_config [service_id...] [--filter=REGEX] [--lines=10] [--lag=1.0] [--pem=/path/to/key.pem]
+
+    Stream the logs of the cluster's services (or just the listed
+    ones) live, merged from all nodes into a single stream ordered by
+    time. Each node gets one connection and only lines matching
+    --filter (a Perl regex, applied on the node) are sent. --lines
+    sets how many existing lines of each log to start with and --lag
+    how long (in seconds) to wait for slower nodes before printing a
+    line out of order. Services need a recorded log file, see add
+    service.
+    """
+
+    name_or_config, service_names = arguments.parse_or_die(logs_follow, [object], rest=True, *args)
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    lines, pattern, lag = logs.options(kwargs)
+
+    name, cc = name_and_config(name_or_config)
+    return logs.follow(log_streams(cc, service_names, pemfile=pemfile, lines=lines, pattern=pattern), lag=lag)
 
 
 def add_service(*args, **kwargs):
-    """ec2 add service cluster_name_or_config service_id target_node|any [--user=user] [--cwd=/path/to/execute] [--] command to run
+    """ec2 add service cluster_name_or_config service_id target_node|any|near:service[,service...] [--user=user] [--cwd=/path/to/execute] [--log-file=/path/to/log] [--probe=SPEC] [--wait-ready[=SECONDS]] [--ports=name=PORT,...] [--cpus=N|--cpuset=LIST] [--memory=SIZE] [--nice=N] [--ionice=CLASS[:N]] [--] command to run
 
     Add a service to run on the cluster. The service needs to be
     assigned a unique id (a string) and takes the form of a command
@@ -630,96 +876,263 @@ def add_service(*args, **kwargs):
     user specifies the user account that should execute the service
     cwd sets the working directory for the service
 
+    A target of near:service[,service...] picks the node with the
+    lowest round trip time to the nodes running those services, as
+    measured by network probe, for services that talk to them a lot.
+
     To make handling PID files easier, any appearance of PIDFILE in
     your command arguments will be replaced with the path to the PID
     file selected. For example, you might add --pid-file=PIDFILE as an
     argument.
+
+    Similarly, LOGFILE is replaced with a log file path, which is
+    recorded so logs follow can stream the service's output. If the
+    service writes its log somewhere else, give the path with
+    --log-file.
+
+    Ports don't need to be hard-coded: each PORT is replaced with a
+    free port in 6000-10000 that no other service on the node has, and
+    PORT:name with the same port everywhere it appears (including in
+    --probe, e.g. --probe=tcp:PORT:name). PRIVATE_IP and NODE_INDEX
+    are replaced with the node's private IP address and index.
+    Allocated ports are saved with the service and freed when it is
+    removed. --ports=name=PORT,... uses the given ports for those
+    names instead of allocating them.
+
+    --probe=SPEC saves a probe with the service, one of tcp:PORT,
+    http:PORT/path, cmd:COMMAND, log:REGEX or pidfile (see
+    cluster/util/probes.py), which service status also checks.
+    --wait-ready[=SECONDS] waits (default: up to 60 seconds) until the
+    service's process is alive and its probe passes, recording how
+    long startup took, and fails if it doesn't become ready in time.
+
+    --cpus=N, --cpuset=LIST, --memory=SIZE, --nice=N and
+    --ionice=CLASS[:N] limit the resources the service can use (see
+    cluster/util/resources.py). --cpus allocates N cores that no other
+    service on the node has, preferring cores from one NUMA node.
     """
 
     name_or_config, service_name, target_node, service_cmd = arguments.parse_or_die(add_service, [object, str, str], rest=True, *args)
     cname, cc = name_and_config(name_or_config)
+    return services.add(ServiceBackend('ec2', cc, **kwargs), service_name, target_node, service_cmd, **kwargs)
+
+def run_script(cc, node_id, script, pemfile=None):
+    '''Run a shell script on a node and return (retcode, output).'''
+    conn = agent_connection(cc, node_id, pemfile)
+    with trace.span('run script', node=node_id):
+        if conn is not None:
+            try:
+                retcode, out, err = conn.run(['/bin/bash', '-s'], input=script)
+                sys.stderr.write(err)
+                return retcode, out
+            except agent.AgentError as e:
+                agent.lost((cc.name, node_id), e)
+        proc = subprocess.Popen(node_ssh_args(cc, node_id, pemfile) + ['/bin/bash', '-s'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, err = proc.communicate(script)
+    return proc.returncode, out
+
+def node_start_service(cc, node_id, daemon_cmd, pemfile=None):
+    '''Run the start-stop-daemon command for a service, returning its
+    exit code.'''
+    conn = agent_connection(cc, node_id, pemfile)
+    if conn is not None:
+        try:
+            with trace.span('start service', node=node_id):
+                retcode, out, err = conn.start_service(daemon_cmd)
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            return retcode
+        except agent.AgentError as e:
+            agent.lost((cc.name, node_id), e)
+    return node_ssh(cc, node_id, *daemon_cmd)
+
+def node_stop_service(cc, node_id, pidfile, cleanup=None, pemfile=None):
+    '''Stop the service with the given pid file, sending TERM and then
+    KILL if it doesn't exit, and then run the cleanup script, if any.
+    It isn't an error if the service is already gone, since it probably
+    crashed. Returns the exit code for stopping the service.'''
+    conn = agent_connection(cc, node_id, pemfile)
+    if conn is not None:
+        try:
+            with trace.span('stop service', node=node_id):
+                stopped = conn.call([ { 'op' : 'stop_service', 'pidfile' : pidfile, 'schedule' : [['TERM', 6], ['KILL', 5]] } ])[0]
+            if not stopped['ok']:
+                print stopped['error']
+                return 1
+            # Like the ssh path, only clean up once the service is gone
+            if stopped['retcode'] == 0 and cleanup is not None:
+                conn.run(['/bin/bash', '-c', cleanup])
+            return stopped['retcode']
+        except agent.AgentError as e:
+            agent.lost((cc.name, node_id), e)
+    retcode = node_ssh(cc, node_id,
+                       'start-stop-daemon', '--stop',
+                       '--retry', 'TERM/6/KILL/5',
+                       '--pidfile', pidfile,
+                       # oknodo allows a successful return if the
+                       # process couldn't actually be found, meaning
+                       # it probably crashed
+                       '--oknodo'
+#                       '--test',
+                       )
+    if retcode == 0 and cleanup is not None:
+        run_script(cc, node_id, cleanup, pemfile=pemfile)
+    return retcode
 
-    user = config.kwarg_or_default('user', kwargs, default=None)
-    cwd = config.kwarg_or_default('cwd', kwargs, default=None)
-    force_daemonize = bool(config.kwarg_or_default('force-daemonize', kwargs, default=False))
-
-    if not len(service_cmd):
-        print "You need to specify a command for the service"
-        return 1
-
-    if 'services' not in cc.state: cc.state['services'] = {}
-    if service_name in cc.state['services']:
-        print "The requested service already exists."
-        return 1
-
-    if not os.path.isabs(service_cmd[0]):
-        print "The path to the service's binary isn't absolute (%s)" % service_cmd[0]
-        print args
-        print service_cmd
-        return 1
+def node_topology(cc, node_id, **kwargs):
+    '''Get the node's cores and their NUMA nodes, as { cpu : numa
+    node }. This is looked up once and saved in the cluster state.'''
+    with cc.lock:
+        topology = cc.state.get('node-topology', {}).get(node_id)
+    if topology is None:
+        retcode, out = run_script(cc, node_id, resources.TopologyScript, pemfile=os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE')))
+        # JSON only has string keys
+        topology = dict([(str(cpu), numa) for cpu, numa in resources.parse_topology(out).items()])
+        with cc.lock:
+            cc.state.setdefault('node-topology', {})[node_id] = topology
+            cc.save()
+    return dict([(int(cpu), numa) for cpu, numa in topology.items()])
+
+class ServiceBackend(services.Backend):
+    '''Runs services on the instances over ssh, or their agents.
+    Instance info is looked up once per command.'''
+
+    def __init__(self, name, cc, **kwargs):
+        super(ServiceBackend, self).__init__(name, cc, **kwargs)
+        self.conn = None
+        self.instances = {}
+        self.pemfile = None
+
+    def pem(self):
+        if self.pemfile is None:
+            self.pemfile = os.path.expanduser(config.kwarg_or_get('pem', self.kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+        return self.pemfile
+
+    def instance(self, node):
+        if node not in self.instances:
+            if self.conn is None: self.conn = connect()
+            inst = get_node(self.cc, self.conn, node)
+            self.instances[node] = self.instances[inst.id] = inst
+        return self.instances[node]
+
+    def node_ids(self):
+        return list(self.cc.state['instances'])
+
+    def node_id(self, node):
+        return self.instance(node).id
+
+    def node_index(self, node_id):
+        return self.cc.state['instances'].index(node_id)
+
+    def private_ip(self, node_id):
+        return self.instance(node_id).private_ip_address
+
+    def workspace(self, node_id):
+        return self.cc.workspace_path()
+
+    def default_cwd(self, node_id):
+        return self.cc.default_working_path()
+
+    def default_user(self, node_id):
+        return self.cc.user()
+
+    def substitute(self, node_id, arg):
+        return arg.replace('FQDN', self.cc.hostname(node=self.instance(node_id)))
+
+    def sirikata_path(self, node_id):
+        return self.cc.sirikata_path()
+
+    def run_script(self, node_id, script):
+        return run_script(self.cc, node_id, script, pemfile=self.pem())
+
+    def start_service(self, node_id, daemon_cmd, cwd):
+        return node_start_service(self.cc, node_id, daemon_cmd, pemfile=self.pem())
+
+    def stop_service(self, node_id, pidfile, cleanup=None):
+        return node_stop_service(self.cc, node_id, pidfile, cleanup=cleanup, pemfile=self.pem())
+
+    def topology(self, node_id):
+        return node_topology(self.cc, node_id, **self.kwargs)
+
+def probe_services(cc, checks, **kwargs):
+    '''Evaluate readiness probes for services, given as a list of
+    (service name, probe), with one script per node. Returns
+    { service name : passed }.'''
+    return services.probe(ServiceBackend('ec2', cc, **kwargs), checks)
+
+def start_services(cc, specs, parallelism=None, timeout=300, **kwargs):
+    '''Start services described by specs (see cluster.util.dag) in
+    dependency order.'''
+    return services.start(ServiceBackend('ec2', cc, **kwargs), specs, parallelism=parallelism, timeout=timeout, **kwargs)
+
+def services_up(*args, **kwargs):
+    """ec2 services up cluster_name_or_config services.json [--parallel=N] [--timeout=300] [--pem=/path/to/key.pem]
+
+    Start the services described in services.json, a list of
+    services with a name, target, command, the services they depend_on
+    and a readiness probe (tcp:PORT, pidfile or log:REGEX). Each
+    service is started as soon as all of its dependencies pass their
+    probes, so independent services start in parallel. --parallel
+    limits how many services are started at once and --timeout how
+    long to wait for a service to become ready. Reports when each
+    service became ready, the critical path and the total time.
+    """
 
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
-    target_node_inst = get_node(cc, conn, target_node)
-    target_node_pacemaker_id = get_node_pacemaker_id(cc, conn, target_node)
-    target_node_hostname = get_node_hostname(cc, conn, target_node)
-
-    # Can now get default values that depend on the node
-    if user is None: user = cc.user(target_node)
-    if cwd is None: cwd = cc.default_working_path(target_node)
-
-    service_binary = service_cmd[0]
-
-    pidfile = os.path.join(cc.workspace_path(), 'sirikata_%s.pid' % (service_name) )
-
-    daemon_cmd = ['start-stop-daemon', '--start',
-                  '--pidfile', pidfile,
-                  '--user', user,
-                  '--chdir', cwd,
-                  # '--test'
-                  ]
-    if force_daemonize:
-        daemon_cmd += ['--background', '--make-pidfile']
-    daemon_cmd += ['--exec', service_binary,
-                   '--'] + [arg.replace('PIDFILE', pidfile).replace('FQDN', target_node_hostname) for arg in service_cmd[1:]]
-    retcode = node_ssh(cc, target_node_inst.id,
-                       *daemon_cmd)
-    if retcode != 0:
-        print "Failed to add cluster service"
-        return retcode
-
-    # Save a record of this service so we can find it again when we need to stop it.
-    cc.state['services'][service_name] = {
-        'node' : target_node_inst.id,
-        'binary' : service_binary
-        }
-    cc.save()
+    name_or_config, spec_path = arguments.parse_or_die(services_up, [object, str], *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+    timeout = float(config.kwarg_or_default('timeout', kwargs, default=300))
+    nkwargs = dict([(k, v) for k, v in kwargs.items() if k not in ['parallel', 'timeout']])
 
-    return retcode
+    name, cc = name_and_config(name_or_config)
+    return start_services(cc, dag.load(spec_path), parallelism=parallelism, timeout=timeout, **nkwargs)
 
 def service_status(*args, **kwargs):
-    """ec2 service status cluster_name_or_config service_id [--pem=/path/to/pem.key]
+    """ec2 service status cluster_name_or_config service_id|all [service_id...] [--pem=/path/to/pem.key]
 
-    Check the status of a service from the cluster. Returns 0 if it is
-    active and running, non-zero otherwise.
+    Check the status of services from the cluster. A service is
+    healthy if its process is alive and the probe saved with it, if
+    any, passes. Returns 0 if all the services are healthy, non-zero
+    otherwise. Checks for services on the same node are batched into a
+    single script.
     """
 
-    name_or_config, service_name = arguments.parse_or_die(service_status, [object, str], *args)
+    name_or_config, service_name, more_names = arguments.parse_or_die(service_status, [object, str], rest=True, *args)
 
     cname, cc = name_and_config(name_or_config)
+    return services.status(ServiceBackend('ec2', cc, **kwargs), service_name, more_names)
+
+def restart_service(cc, service_name, version=None, **kwargs):
+    '''Stop a service and start it again with the command and options
+    it was added with, on the same ports and cores. With version, the
+    command is pointed at the Sirikata installed in that directory
+    instead of the node's usual one (see cluster.util.rolling).
+    Returns True on success.'''
+    return services.restart(ServiceBackend('ec2', cc, **kwargs), service_name, version=version, **kwargs)
+
+def services_rolling_restart(*args, **kwargs):
+    """ec2 services rolling-restart cluster_name_or_config service_id|all [service_id...] [--batch-size=1] [--max-failure-rate=0] [--timeout=60] [--version=[node:]/path/to/sirikata,...] [--pem=/path/to/pem.key]
+
+    Restart services a batch at a time, e.g. to move them onto new
+    binaries after sync sirikata without taking them all down at once.
+    Each service is stopped and started again with the command and
+    options it was added with, on the same ports and cores, and the
+    next batch starts once every service in the batch is alive and
+    passes its probe (or --timeout seconds pass). Once more than
+    --max-failure-rate of the restarts so far have failed (by default,
+    any of them), the remaining services are left running as they are.
+
+    --version moves services to a different Sirikata install: paths in
+    their commands under the node's Sirikata path are pointed into the
+    given directory instead. node:/path selects the version for one
+    node. Installed version IDs aren't accepted since EC2 nodes get
+    Sirikata from puppet. Reports each batch's downtime and the total
+    time taken.
+    """
 
-    if service_name not in cc.state['services']:
-        print "Couldn't find record of service '%s'" % (service_name)
-        return 1
-
-    pidfile = os.path.join(cc.workspace_path(), 'sirikata_%s.pid' % (service_name) )
-
-    # Check if the process can respond to signals, i.e. just if it is alive
-    retcode = node_ssh(cc, cc.state['services'][service_name]['node'],
-                       '/bin/bash', '-c',
-                       "kill -0 `grep -o '[0-9]*' %s`" % (pidfile)
-                       )
+    name_or_config, service_name, more_names = arguments.parse_or_die(services_rolling_restart, [object, str], rest=True, *args)
 
-    return retcode
+    cname, cc = name_and_config(name_or_config)
+    return services.rolling_restart(ServiceBackend('ec2', cc, **kwargs), service_name, more_names, **kwargs)
 
 
 def list_services(*args, **kwargs):
@@ -736,7 +1149,7 @@ def list_services(*args, **kwargs):
     for sidx,service_name in enumerate(cc.state['services']):
         print "[%d] %s" % (sidx, service_name)
 
-    return 0
+    return results.Result('ec2 list services', retcode=0, data=cc.state['services'])
 
 
 def remove_service(*args, **kwargs):
@@ -758,33 +1171,7 @@ def remove_service(*args, **kwargs):
     except:
         service_name = service_name_or_idx
 
-    if service_name not in cc.state['services']:
-        print "Couldn't find record of service '%s'" % (service_name)
-        return 1
-
-    pidfile = os.path.join(cc.workspace_path(), 'sirikata_%s.pid' % (service_name) )
-
-    retcode = node_ssh(cc, cc.state['services'][service_name]['node'],
-                       'start-stop-daemon', '--stop',
-                       '--retry', 'TERM/6/KILL/5',
-                       '--pidfile', pidfile,
-                       # oknodo allows a successful return if the
-                       # process couldn't actually be found, meaning
-                       # it probably crashed
-                       '--oknodo'
-#                       '--test',
-                       )
-
-    if retcode != 0:
-        print "Failed to remove service."
-        return retcode
-
-    # Destroy the record of the service.
-    # Save a record of this service so we can find it again when we need to stop it.
-    del cc.state['services'][service_name]
-    cc.save()
-
-    return retcode
+    return services.remove(ServiceBackend('ec2', cc, **kwargs), service_name)
 
 def remove_all_services(*args, **kwargs):
     """ec2 remove all services cluster_name_or_config [--pem=/path/to/pem.key]
@@ -796,47 +1183,229 @@ def remove_all_services(*args, **kwargs):
 
     cname, cc = name_and_config(name_or_config)
 
-    retcode = 0
+    result = results.Result('ec2 remove all services')
     for service_name in list(cc.state['services']):
-        one_retcode = remove_service(cc, service_name)
+        one_result = remove_service(cc, service_name, **kwargs)
         # Even if this didn't succeed, we'll try to get through
         # everything and remove it since that's the intent. We will,
         # however, make sure to return a bad return code and warn the
         # user.
-        if one_retcode != 0:
+        if one_result != 0:
             print "Removal of service %s failed" % (service_name)
-            retcode = one_retcode
+        if isinstance(one_result, results.Result):
+            result.nodes += one_result.nodes
+        else:
+            result.add_node(None, one_result, data={ 'service' : service_name })
+
+    return result.finish()
+
+
+def collect_facts(cc, node_id, **kwargs):
+    '''Run the facts script on a node, returning (retcode, output).'''
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    return run_script(cc, node_id, facts.script(cc.sirikata_path(), cc.workspace_path()), pemfile=pemfile)
+
+def node_facts(cc, node=None, ttl=None, **kwargs):
+    '''Get a node's facts, or { node id : facts } for all nodes if node
+    is None, from the cache in the cluster state. Facts that are
+    missing or older than ttl seconds are collected first, from all the
+    nodes that need it at once.'''
+    node_ids = list(cc.state['instances']) if node is None else [cc.get_node_name(node)]
+    if ttl is None: ttl = facts.DefaultTTL
+    all_facts = facts.get('ec2 facts', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), ttl=ttl)
+    if node is None: return all_facts
+    return all_facts.get(node_ids[0])
+
+def facts_refresh(*args, **kwargs):
+    """ec2 facts refresh cluster_name_or_config [node...] [--max-age=SECONDS] [--parallel=N] [--pem=/path/to/key.pem]
+
+    Collect facts about nodes (cores, memory, free disk, kernel and
+    installed Sirikata version) from all nodes, or the given ones, in
+    one parallel sweep, and cache them in the cluster state for
+    placement and validation. With --max-age, nodes whose cached facts
+    are newer than that are skipped.
+    """
+
+    name_or_config, targets = arguments.parse_or_die(facts_refresh, [object], rest=True, *args)
+    max_age = config.kwarg_or_default('max-age', kwargs, default=None)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [cc.get_node_name(target) for target in targets] if targets else list(cc.state['instances'])
+    if max_age is not None:
+        node_ids = [node_id for node_id in node_ids if not facts.fresh(cc.state.get('facts', {}).get(node_id), float(max_age))]
+    result = facts.refresh('ec2 facts refresh', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), parallelism=parallelism)
+    if results.get_format() == 'text':
+        print facts.format_table(dict([(node_id, cc.state['facts'][node_id]) for node_id in node_ids if node_id in cc.state.get('facts', {})]))
+    return result
+
+def facts_show(*args, **kwargs):
+    """ec2 facts show cluster_name_or_config [node...] [--ttl=SECONDS] [--pem=/path/to/key.pem]
+
+    Show the cached facts about nodes, collecting them first for nodes
+    without facts or whose facts are older than --ttl seconds (default
+    an hour).
+    """
+
+    name_or_config, targets = arguments.parse_or_die(facts_show, [object], rest=True, *args)
+    ttl = float(config.kwarg_or_default('ttl', kwargs, default=facts.DefaultTTL))
+
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [cc.get_node_name(target) for target in targets] if targets else list(cc.state['instances'])
+    all_facts = facts.get('ec2 facts show', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), ttl=ttl)
+    if results.get_format() == 'text':
+        print facts.format_table(all_facts)
+    return results.Result('ec2 facts show', retcode=0 if len(all_facts) == len(node_ids) else 1, data=all_facts)
 
-    return retcode
+
+def network_probe(*args, **kwargs):
+    """ec2 network probe cluster_name_or_config [--port=PORT] [--bytes=N] [--count=N] [--pem=/path/to/key.pem]
+
+    Measure the round trip time and TCP throughput between every pair
+    of nodes and save them in the cluster state, for placing services
+    with near:SERVICE. Pairs are measured in rounds, each node in at
+    most one pair per round, so measurements don't interfere. --port
+    is the port measurements use on each node; by default it's the
+    highest port in the range the security group opens that no service
+    has and nothing listens on. --bytes is the size of the bulk transfer and
+    --count the number of round trips timed per pair.
+    """
+
+    name_or_config = arguments.parse_or_die(network_probe, [object], *args)
+    port = config.kwarg_or_default('port', kwargs, default=None)
+    nbytes = int(config.kwarg_or_default('bytes', kwargs, default=network.DefaultBytes))
+    count = int(config.kwarg_or_default('count', kwargs, default=network.DefaultCount))
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+
+    name, cc = name_and_config(name_or_config)
+    free_port = services.probe_ports(ServiceBackend('ec2', cc, **kwargs))
+
+    result = network.probe('ec2 network probe', list(cc.state['instances']),
+                           lambda node_id, script: run_script(cc, node_id, script, pemfile=pemfile),
+                           lambda node_id: cc.state['instance_props'][node_id]['private_ip'],
+                           lambda node_id: int(port) if port is not None else free_port(node_id),
+                           count=count, nbytes=nbytes)
+    cc.state['network'] = result.data
+    cc.save()
+    if results.get_format() == 'text':
+        print network.format_table(result.data, 'rtt_ms')
+        print network.format_table(result.data, 'bandwidth_mbps')
+    return result
+
+
+def agent_install(*args, **kwargs):
+    """ec2 agent install cluster_name_or_config [--pem=/path/to/pem.key] [--parallel=N]
+
+    Copy the node agent to each node and start it. Nodes configured
+    with the sirikata Puppet class already run it; this records it in
+    the cluster state so it gets used. Once a node has an agent, remote
+    commands, scripts and starting and stopping services go to it over
+    a single forwarded ssh connection instead of a new ssh connection
+    each. Nodes where the agent can't be reached fall back to ssh.
+    """
+
+    name_or_config = arguments.parse_or_die(agent_install, [object], *args)
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+
+    name, cc = name_and_config(name_or_config)
+
+    if 'instances' not in cc.state:
+        print "It doesn't look like you've booted the cluster yet..."
+        return 1
+
+    workspace = cc.workspace_path()
+    result = results.Result('ec2 agent install')
+    sockets = {}
+    def install_on_node(inst_id):
+        start = time.time()
+        with trace.span('rsync', node=inst_id, cmd=agent.ScriptName):
+            retcode = subprocess.call(['rsync', '-e', rsync_ssh(pemfile), agent.script_path(),
+                                       node_ssh_args(cc, inst_id, pemfile)[-1] + ':' + workspace + '/'])
+        if retcode == 0:
+            retcode = node_ssh(cc, inst_id, *agent.start_command(workspace), pem=pemfile)
+        if retcode != 0:
+            print "Failed to install the agent on %s" % (inst_id)
+            result.add_node(inst_id, retcode, duration=time.time()-start, error='failed to install agent')
+            return
+        sockets[inst_id] = os.path.join(workspace, agent.SocketName)
+        result.add_node(inst_id, retcode, duration=time.time()-start, data={ 'socket' : sockets[inst_id] })
+    parallel.run(install_on_node, cc.state['instances'], parallelism=parallelism)
+
+    cc.state.setdefault('agent', {}).update(sockets)
+    cc.save()
+    return result.finish()
+
+def agent_remove(*args, **kwargs):
+    """ec2 agent remove cluster_name_or_config [--pem=/path/to/pem.key]
+
+    Stop the node agents and go back to running commands over ssh.
+    Nodes running the sirikata Puppet class will start the agent again
+    on their next Puppet run, but it won't be used.
+    """
+
+    name_or_config = arguments.parse_or_die(agent_remove, [object], *args)
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+
+    name, cc = name_and_config(name_or_config)
+
+    result = results.Result('ec2 agent remove')
+    for inst_id in list(cc.state.get('agent', {}).keys()):
+        start = time.time()
+        del cc.state['agent'][inst_id]
+        agent.forget((cc.name, inst_id))
+        retcode = node_ssh(cc, inst_id, *agent.stop_command(cc.workspace_path()), pem=pemfile)
+        result.add_node(inst_id, retcode, duration=time.time()-start)
+    cc.save()
+    return result.finish()
 
 
 def set_node_type(*args, **kwargs):
-    """ec2 node set type cluster_name_or_config node nodetype [--pem=/path/to/pem.key]
+    """ec2 node set type cluster_name_or_config node nodetype [--master=node] [--pem=/path/to/pem.key]
 
     Set the given node (by index, hostname, IP, etc) to be of the
-    specified node type in Puppet, e.g. setting sirikata_redis to make
-    it a Redis server. Setting to 'default' reverts to the original config.
+    specified node type in Puppet. Setting to 'default' reverts to the
+    original config. The Redis node types select a Redis profile, with
+    maxmemory sized to the cluster's instance type:
+
+      sirikata_redis - in-memory only, no persistence
+      sirikata_redis_aof - append-only file, fsync every second
+      sirikata_redis_replica - read replica of the Redis node given by --master
+
+    Redis nodes get the 'redis' capability, replicas 'redis-replica'.
     """
 
     name_or_config, nodeid, nodetype = arguments.parse_or_die(set_node_type, [object, str, str], *args)
     pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    master = config.kwarg_or_default('master', kwargs, default=None)
 
     # Explicit check for known types so we don't get our config into a bad state
-    if nodetype not in ['default', 'sirikata_redis']:
+    if nodetype != 'default' and nodetype not in redisconf.NodeTypes:
         print "The specified node type (%s) isn't known." % (nodetype)
         return 1
+    if redisconf.NodeTypes.get(nodetype) == 'replica':
+        if master is None:
+            print "Redis replicas need a master, specify it with --master=node."
+            return 1
+    else:
+        master = None
 
     name, cc = name_and_config(name_or_config)
     if 'instances' not in cc.state:
         print "No active instances were found, are you sure this cluster is currently running?"
-        exit(1)
+        return 1
 
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    conn = connect()
 
     # Update entry in local storage so we can update later
     if 'node-types' not in cc.state: cc.state['node-types'] = {}
     if 'capabilities' not in cc.state: cc.state['capabilities'] = {}
+    if 'redis-masters' not in cc.state: cc.state['redis-masters'] = {}
     inst = get_node(cc, conn, nodeid)
+    if pacemaker_id(inst) in cc.state['redis-masters']:
+        del cc.state['redis-masters'][pacemaker_id(inst)]
     if nodetype == 'default':
         if pacemaker_id(inst) in cc.state['node-types']:
             del cc.state['node-types'][pacemaker_id(inst)]
@@ -845,16 +1414,28 @@ def set_node_type(*args, **kwargs):
     else:
         cc.state['node-types'][pacemaker_id(inst)] = nodetype
         # Note currently only 1, the puppet setup doesn't really have composability right now anyway...
-        cc.state['capabilities'][inst.id] = 'redis'
+        if master is not None:
+            master_inst = get_node(cc, conn, master)
+            cc.state['redis-masters'][pacemaker_id(inst)] = master_inst.private_ip_address
+            cc.state['capabilities'][inst.id] = 'redis-replica'
+        else:
+            cc.state['capabilities'][inst.id] = 'redis'
     cc.save()
 
     # Generate config
-    node_config = ''.join(["node '%s' inherits %s {}" % (pacemakerid,nt) for pacemakerid,nt in cc.state['node-types'].iteritems()])
-    data.save(node_config, 'puppet', 'manifests', 'nodes.pp')
+    node_config = ''
+    for pacemakerid,nt in sorted(cc.state['node-types'].iteritems()):
+        if nt in redisconf.NodeTypes:
+            node_config += redisconf.puppet_node(pacemakerid, nt, cc.instance_type, master=cc.state['redis-masters'].get(pacemakerid))
+        else:
+            node_config += "node '%s' inherits %s {}\n" % (pacemakerid,nt)
+    puppet.save_cluster_node_config(cc.name, node_config)
 
+    # Only this node's configuration changed, so only it needs to
+    # re-run puppet
     pem_kwargs = {}
     if pemfile is not None: pem_kwargs['pem'] = pemfile
-    return puppet.update(cc, **pem_kwargs)
+    return puppet.update_node(cc, inst.id, **pem_kwargs)
 
 
 def terminate(*args, **kwargs):
@@ -868,9 +1449,9 @@ def terminate(*args, **kwargs):
     name, cc = name_and_config(name_or_config)
     if 'instances' not in cc.state:
         print "No active instances were found, are you sure this cluster is currently running?"
-        exit(1)
+        return 1
 
-    conn = EC2Connection(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    conn = connect()
     terminated = conn.terminate_instances(cc.state['instances'])
 
     if len(terminated) != len(cc.state['instances']):
@@ -879,8 +1460,18 @@ def terminate(*args, **kwargs):
         print "Terminated Instances:", terminated
         print "Unterminated:", list(set(cc.state['instances']).difference(set(terminated)))
 
-    if 'node-types' in cc.state: del cc.state['node-types']
+    if 'node-types' in cc.state:
+        del cc.state['node-types']
+        # Nodes with the same names may be handed to other clusters
+        puppet.save_cluster_node_config(cc.name, '')
     if 'capabilities' in cc.state: del cc.state['capabilities']
+    if 'redis-masters' in cc.state: del cc.state['redis-masters']
+    if 'provision-facts' in cc.state: del cc.state['provision-facts']
+    if 'node-topology' in cc.state: del cc.state['node-topology']
+    if 'agent' in cc.state: del cc.state['agent']
+    if 'placement' in cc.state: del cc.state['placement']
+    if 'journal' in cc.state: del cc.state['journal']
+    facts.forget(cc)
     del cc.state['instances']
     del cc.state['instance_props']
     if 'reservation' in cc.state:
@@ -902,6 +1493,10 @@ def destroy(*args, **kwargs):
 
     if 'reservation' in cc.state or 'spot' in cc.state or 'instances' in cc.state:
         print "You have an active reservation or nodes, use 'cluster terminate nodes' before destroying this cluster spec."
-        exit(1)
+        return 1
+
+    if cc.placement_strategy:
+        conn = connect()
+        placement.delete_group(conn, cc)
 
     cc.delete()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# Choosing where a cluster's nodes go. A cluster can ask for a
+# placement group, 'cluster' to pack the nodes close together on the
+# network or 'spread' to keep them on distinct hardware, and chooses
+# its availability zone by:
+#
+#   random        any available zone
+#   price         the lowest current spot price for the instance type
+#   fulfillment   the zone where a bid would have been met for the
+#                 largest share of the recent price history, i.e. the
+#                 one least likely to leave a request unfulfilled or
+#                 have its instances reclaimed
+#   ZONE          always use this zone, e.g. us-east-1b
+#
+# Both are recorded in the cluster's config by ec2 create, and the zone
+# chosen when nodes are booted or requested is kept in
+# state['placement'] along with the ranking that led to it. Only spot
+# prices are looked at, but they are also a fair sign of how much spare
+# capacity a zone has for on-demand instances.
+
+import calendar, random, time
+
+Strategies = ['cluster', 'spread']
+ZoneSelections = ['random', 'price', 'fulfillment']
+
+DefaultHistoryHours = 24
+ProductDescription = 'Linux/UNIX'
+
+# Spread placement groups hold at most this many instances per zone
+SpreadLimit = 7
+
+
+def parse_timestamp(ts):
+    '''Parse an EC2 timestamp, e.g. 2013-05-01T12:00:00.000Z, into
+    seconds since the epoch.'''
+    return calendar.timegm(time.strptime(ts[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def format_timestamp(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+def validate(strategy, selection, size):
+    '''Check the options given to ec2 create, raising an Exception
+    describing the problem if they aren't usable.'''
+    if strategy is not None and strategy not in Strategies:
+        raise Exception("Unknown placement strategy '%s', use one of %s" % (strategy, ', '.join(Strategies)))
+    if strategy == 'spread' and size > SpreadLimit:
+        raise Exception("Spread placement groups hold at most %d instances per availability zone" % (SpreadLimit))
+    if not selection:
+        raise Exception("Zone selection can't be empty, use one of %s or a zone name" % (', '.join(ZoneSelections)))
+
+
+def price_history(conn, instance_type, zones, start, end):
+    '''Get the spot price history for instance_type between start and
+    end as { zone : [(time, price), ...] }, oldest first.'''
+    histories = dict([(zone, []) for zone in zones])
+    next_token = None
+    while True:
+        page = conn.get_spot_price_history(start_time=format_timestamp(start), end_time=format_timestamp(end),
+                                           instance_type=instance_type, product_description=ProductDescription,
+                                           next_token=next_token)
+        for record in page:
+            if record.availability_zone not in histories: continue
+            histories[record.availability_zone].append((parse_timestamp(record.timestamp), float(record.price)))
+        next_token = getattr(page, 'next_token', None)
+        if not next_token: break
+    for points in histories.values(): points.sort()
+    return histories
+
+def current_price(points):
+    if not points: return None
+    return points[-1][1]
+
+def fulfillment(points, bid, start, end):
+    '''The fraction of the time between start and end that the price
+    was at or below bid. The first price is taken to have held from
+    start, since EC2 includes the price in effect at the start of the
+    window.'''
+    if not points or end <= start: return 0.0
+    met = 0.0
+    for idx, (t, price) in enumerate(points):
+        begin = start if idx == 0 else max(start, t)
+        finish = points[idx+1][0] if idx + 1 < len(points) else end
+        finish = min(finish, end)
+        if finish > begin and price <= bid: met += finish - begin
+    return met / (end - start)
+
+def rank(histories, selection, bid, start, end):
+    '''Order zones by preference for a price or fulfillment selection.
+    Without a bid (booting on-demand instances), fulfillment is measured
+    against the median of the zones' current prices. Zones without any
+    price history go last.'''
+    prices = dict([(zone, current_price(points)) for zone, points in histories.items()])
+    if bid is None:
+        known = sorted([price for price in prices.values() if price is not None])
+        bid = known[len(known) // 2] if known else 0.0
+    ranking = []
+    for zone, points in histories.items():
+        ranking.append({ 'zone' : zone, 'price' : prices[zone], 'fulfillment' : fulfillment(points, bid, start, end), 'bid' : bid })
+    def key(entry):
+        missing = entry['price'] is None
+        if selection == 'fulfillment':
+            return (missing, -entry['fulfillment'], entry['price'], entry['zone'])
+        return (missing, entry['price'], -entry['fulfillment'], entry['zone'])
+    ranking.sort(key=key)
+    return ranking
+
+def choose_zone(conn, cc, bid=None, hours=DefaultHistoryHours, now=None):
+    '''Choose the zone to launch cc's nodes in, returning (zone,
+    ranking). ranking is empty unless zones were compared by price.'''
+    selection = cc.zone_selection
+    if selection not in ZoneSelections:
+        return (selection, [])
+    zones = [zone.name for zone in conn.get_all_zones() if getattr(zone, 'state', 'available') == 'available']
+    if not zones: raise Exception("No availability zones are available")
+    if selection == 'random':
+        return (random.choice(zones), [])
+    if now is None: now = time.time()
+    start = now - hours * 3600
+    ranking = rank(price_history(conn, cc.instance_type, zones, start, now), selection, bid, start, now)
+    if ranking[0]['price'] is None:
+        print "No spot price history for %s, choosing a zone at random" % (cc.instance_type)
+        return (random.choice(zones), ranking)
+    return (ranking[0]['zone'], ranking)
+
+def group_name(cc):
+    return cc.name
+
+def ensure_group(conn, cc):
+    '''Make sure cc's placement group exists, returning its name, or None
+    if the cluster doesn't use one.'''
+    if not cc.placement_strategy: return None
+    name = group_name(cc)
+    existing = [group for group in conn.get_all_placement_groups() if group.name == name]
+    if existing:
+        if existing[0].strategy != cc.placement_strategy:
+            raise Exception("Placement group %s already exists with strategy %s" % (name, existing[0].strategy))
+        return name
+    conn.create_placement_group(name, strategy=cc.placement_strategy)
+    return name
+
+def delete_group(conn, cc):
+    '''Delete cc's placement group. This only works once all its
+    instances have terminated.'''
+    if not cc.placement_strategy: return True
+    name = group_name(cc)
+    if not [group for group in conn.get_all_placement_groups() if group.name == name]: return True
+    try:
+        return conn.delete_placement_group(name)
+    except Exception as e:
+        print "Couldn't delete placement group %s (%s), it may still have running instances" % (name, str(e))
+        return False
+
+
+def format_table(ranking):
+    '''Format a zone ranking as a table for text output.'''
+    if not ranking: return ''
+    lines = ['%-16s %10s %12s' % ('zone', 'price', 'fulfillment')]
+    for entry in ranking:
+        lines.append('%-16s %10s %11.1f%%' % (
+                entry['zone'], '-' if entry['price'] is None else '%.4f' % (entry['price']), entry['fulfillment'] * 100))
+    lines.append('(fulfillment at a bid of %.4f)' % (ranking[0]['bid']))
+    return '\n'.join(lines)
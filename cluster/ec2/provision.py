@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# Push provisioning: applies the same configuration as the sirikata,
+# sirikata_local_cdn and redis puppet classes directly over ssh,
+# without waiting for puppet agents to poll the master. Each node gets
+# a single generated script made of idempotent steps, and all nodes are
+# handled in parallel. The script reports facts about the node
+# (installed packages, hashes of managed files) which we cache in the
+# cluster state so later pushes can leave out steps that are already
+# satisfied.
+
+import cluster.util.config as config
+import cluster.util.data as data
+import cluster.util.arguments as arguments
+import cluster.util.results as results
+import cluster.util.parallel as parallel
+import cluster.util.trace as trace
+import nodes
+import redisconf
+import base64, hashlib, os, pipes, re, subprocess, time
+
+# Packages each role needs, matching the puppet classes
+RolePackages = {
+    'sirikata' : ['ntp', 'bzip2', 'curl', 'libgsl0ldbl', 'libssl0.9.8'],
+    'cdn' : ['apache2'],
+    'redis' : ['redis-server'],
+    }
+
+ArchiveName = 'sirikata.tar.bz2'
+
+def archive_url(kwargs):
+    '''Get the URL Sirikata archives are downloaded from, either from
+    --archive-url or the puppet site configuration.'''
+    url = config.kwarg_or_default('archive-url', kwargs)
+    if url is None and data.exists('puppet', 'manifests', 'config.pp'):
+        match = re.search(r'''\$sirikata_archive_url\s*=\s*['"]([^'"]*)['"]''', data.load('puppet', 'manifests', 'config.pp'))
+        if match: url = match.group(1)
+    return url
+
+def render_template(template, values):
+    '''Fill in the simple <%= var %> substitutions used by our puppet templates.'''
+    return re.sub(r'<%=\s*@?(\w+)\s*%>', lambda m: str(values[m.group(1)]), template)
+
+def node_roles(cc, node_id):
+    '''Get the roles for a node from its puppet node type.'''
+    nodetype = cc.state.get('node-types', {}).get(nodes.pacemaker_id(cc.state['instance_props'][node_id]), 'default')
+    roles = ['sirikata', 'cdn']
+    if nodetype in redisconf.NodeTypes: roles.append('redis')
+    return roles, nodetype
+
+
+def package_step(packages):
+    quoted = ' '.join([pipes.quote(p) for p in packages])
+    return [
+        'missing=""',
+        'for p in %s; do dpkg -s $p >/dev/null 2>&1 || missing="$missing $p"; done' % (quoted),
+        'if [ -n "$missing" ]; then',
+        '  export DEBIAN_FRONTEND=noninteractive',
+        '  apt-get -q update',
+        '  apt-get -q -y install $missing',
+        '  echo "@@changed packages$missing"',
+        'fi',
+        ]
+
+def file_step(path, content, owner='root', mode='0644', on_change=None):
+    tmp = '/tmp/sirikata-provision.$$'
+    lines = [
+        'echo %s | base64 -d > %s' % (base64.b64encode(content), tmp),
+        'if ! cmp -s %s %s; then' % (tmp, pipes.quote(path)),
+        '  install -D -o %s -g %s -m %s %s %s' % (owner, owner, mode, tmp, pipes.quote(path)),
+        '  echo "@@changed file %s"' % (path),
+        ]
+    if on_change: lines.append('  ' + on_change)
+    lines += [
+        'fi',
+        'rm -f %s' % (tmp),
+        ]
+    return lines
+
+def service_running_step(service):
+    return [
+        'if ! service %s status >/dev/null 2>&1; then service %s start; echo "@@changed service %s"; fi' % (service, service, service),
+        ]
+
+def build_script(cc, node_id, facts, url):
+    '''Generate the provisioning script for a node.'''
+    roles, nodetype = node_roles(cc, node_id)
+    props = cc.state['instance_props'][node_id]
+    lines = ['set -e']
+    managed_files = []
+
+    packages = [p for role in roles for p in RolePackages[role]]
+    missing = [p for p in packages if p not in facts.get('packages', [])]
+    if missing: lines += package_step(missing)
+
+    def managed_file(path, content, **kwargs):
+        managed_files.append(path)
+        if facts.get('files', {}).get(path) == hashlib.sha1(content).hexdigest(): return
+        lines.extend(file_step(path, content, **kwargs))
+
+    if 'sirikata' in roles:
+        lines += service_running_step('ntp')
+        lines.append('install -d -o ubuntu -g ubuntu /home/ubuntu/sirikata /home/ubuntu/ready')
+        # Always checked on the node since sync sirikata removes old
+        # archives to force a new download
+        if url is not None:
+            lines += [
+                'if [ ! -f /home/ubuntu/%s ]; then' % (ArchiveName),
+                '  su ubuntu -c %s' % (pipes.quote('cd /home/ubuntu && curl -sf -o %s %s' % (ArchiveName, pipes.quote(url + ArchiveName)))),
+                '  su ubuntu -c %s' % (pipes.quote('cd /home/ubuntu/sirikata && tar -xf ../%s' % (ArchiveName))),
+                '  echo "@@changed sirikata"',
+                'fi',
+                'su ubuntu -c "touch /home/ubuntu/ready/sirikata"',
+                ]
+
+    if 'cdn' in roles:
+        lines += [
+            'install -d -o ubuntu -g ubuntu /mnt/models',
+            'ln -sfn /mnt/models /home/ubuntu/models',
+            'rm -f /etc/apache2/sites-enabled/default /etc/apache2/sites-enabled/000-default /etc/apache2/sites-enabled/default-ssl',
+            'ln -sfn /etc/apache2/sites-available/cdn /etc/apache2/sites-enabled/cdn',
+            ]
+        vhost = render_template(data.load('puppet', 'modules', 'sirikata_local_cdn', 'templates', 'cdn-apache-vhost'),
+                                { 'ec2_public_hostname' : props['hostname'] })
+        managed_file('/etc/apache2/sites-available/cdn', vhost, on_change='service apache2 reload || service apache2 restart')
+        lines += service_running_step('apache2')
+
+    if 'redis' in roles:
+        settings = redisconf.settings(redisconf.NodeTypes[nodetype], cc.instance_type,
+                                      master=cc.state.get('redis-masters', {}).get(nodes.pacemaker_id(props)))
+        managed_file('/etc/redis/redis.conf', redisconf.render(settings), on_change='service redis-server restart')
+        lines += service_running_step('redis-server')
+
+    # Report facts for the next run
+    lines += [
+        'for p in %s; do if dpkg -s $p >/dev/null 2>&1; then echo "@@package $p"; fi; done' % (' '.join(packages)),
+        'for f in %s; do if [ -f $f ]; then echo "@@file $f $(sha1sum < $f | cut -d\' \' -f1)"; fi; done' % (' '.join(managed_files)),
+        ]
+    return '\n'.join(lines) + '\n'
+
+def push_node(cc, node_id, facts, url, pemfile):
+    '''Provision one node. Returns (retcode, changed steps, new facts).'''
+    script = build_script(cc, node_id, facts, url)
+    cmd = nodes.node_ssh_args(cc, node_id, pemfile) + ['sudo', '/bin/bash', '-s']
+    with trace.span('provision push', node=node_id):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, err = proc.communicate(script)
+
+    changed = []
+    new_facts = { 'packages' : [], 'files' : {} }
+    for line in out.splitlines():
+        if not line.startswith('@@'):
+            print line
+            continue
+        parts = line[2:].split(' ', 1)
+        if parts[0] == 'changed': changed.append(parts[1])
+        elif parts[0] == 'package': new_facts['packages'].append(parts[1])
+        elif parts[0] == 'file':
+            path, sha1 = parts[1].rsplit(' ', 1)
+            new_facts['files'][path] = sha1
+    return proc.returncode, changed, new_facts
+
+
+def push(*args, **kwargs):
+    """provision push cluster_name_or_config [--archive-url=http://example.com/sirikata/] [--parallel=N] [--refresh-facts] [--pem=/path/to/key.pem]
+
+    Configure nodes directly over ssh instead of waiting for their
+    puppet agents: installs the same packages, files and services as
+    the sirikata, sirikata_local_cdn and redis puppet classes, based
+    on each node's node type, on all nodes in parallel. Steps are
+    idempotent, so this can be re-run at any time, and facts about
+    each node are cached so later runs skip work that's already done.
+    Use --refresh-facts to ignore the cache.
+
+    The Sirikata archive is downloaded from --archive-url, defaulting
+    to $sirikata_archive_url from the puppet site configuration.
+    """
+
+    name_or_config = arguments.parse_or_die(push, [object], *args)
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+    refresh = bool(config.kwarg_or_default('refresh-facts', kwargs, default=False))
+    url = archive_url(kwargs)
+
+    name, cc = nodes.name_and_config(name_or_config)
+    if 'instances' not in cc.state:
+        print "It doesn't look like you've booted the cluster yet..."
+        return 1
+    if url is None:
+        print "No Sirikata archive URL found, Sirikata binaries won't be installed. Specify one with --archive-url."
+
+    cached_facts = cc.state.get('provision-facts', {})
+    if refresh: cached_facts = {}
+
+    result = results.Result('provision push')
+    new_facts = {}
+    def provision(node_id):
+        start = time.time()
+        retcode, changed, facts = push_node(cc, node_id, cached_facts.get(node_id, {}), url, pemfile)
+        duration = time.time() - start
+        if retcode == 0:
+            new_facts[node_id] = facts
+            print "Node %s ready in %.1f seconds (%d changes)" % (node_id, duration, len(changed))
+        else:
+            print "Provisioning node %s failed" % (node_id)
+        result.add_node(node_id, retcode, duration=duration, data={ 'changed' : changed })
+    parallel.run(provision, cc.state['instances'], parallelism=parallelism)
+
+    if 'provision-facts' not in cc.state: cc.state['provision-facts'] = {}
+    cc.state['provision-facts'].update(new_facts)
+    cc.save()
+
+    print "Provisioned %d nodes in %.1f seconds" % (len(cc.state['instances']), result.duration)
+    return result.finish()
@@ -3,18 +3,109 @@
 import cluster.util.config as config
 import cluster.util.data as data
 import cluster.util.arguments as arguments
+import cluster.util.results as results
+import cluster.util.trace as trace
 import nodes
-import os.path, subprocess, sys
+import hashlib, os, os.path, pipes, stat, subprocess, sys, tempfile, time
 
 # This is gross, but addresses the run-time circular dependency
 # between cluster.py and puppet.py
 setattr(nodes, 'puppet', sys.modules[__name__])
 
+# Node configuration is kept in one fragment per cluster under
+# manifests/clusters so clusters sharing a puppet master don't
+# overwrite each other's node types. nodes.pp just imports them.
+
+def save_if_changed(content, *args):
+    '''Save data if it differs from what's already there, replacing
+    the file atomically so concurrent commands for other clusters never
+    see partial content. Returns whether the file changed.'''
+    if data.exists(*args) and data.load(*args) == content: return False
+    dirpath = os.path.dirname(data.path(*args))
+    if not os.path.exists(dirpath): os.makedirs(dirpath)
+    fd, tmp_path = tempfile.mkstemp(dir=dirpath, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(content)
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, data.path(*args))
+    return True
+
 def generate_default_node_config():
-    """Generates a default empty node configuration (all nodes as default class) if a node config doesn't exist yet."""
+    """Generates the top-level node configuration, importing each cluster's node configuration."""
+
+    clusters_path = data.path('puppet', 'manifests', 'clusters')
+    fragments = []
+    if os.path.exists(clusters_path):
+        fragments = sorted([fname for fname in os.listdir(clusters_path) if fname.endswith('.pp')])
+    save_if_changed(''.join(['import "clusters/%s"\n' % (fname) for fname in fragments]), 'puppet', 'manifests', 'nodes.pp')
+
+def save_cluster_node_config(name, node_config):
+    """Save the node configuration for one cluster, removing it if it is empty. Returns whether anything changed."""
+
+    fragment = ('puppet', 'manifests', 'clusters', name + '.pp')
+    if node_config:
+        changed = save_if_changed(node_config, *fragment)
+    else:
+        changed = data.exists(*fragment)
+        if changed: os.remove(data.path(*fragment))
+    generate_default_node_config()
+    return changed
+
+def file_hash(path):
+    '''SHA1 of a file's contents, or None if it can't be read.'''
+    try:
+        with open(path, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except IOError:
+        return None
 
-    if not data.exists('puppet', 'manifests', 'nodes.pp'):
-        data.save('', 'puppet', 'manifests', 'nodes.pp')
+# Changes to these require a full restart of the puppetmaster. Anything
+# else (manifests, modules) is picked up by a reload.
+MasterConfigFiles = ['puppet.conf', 'auth.conf', 'fileserver.conf', 'autosign.conf']
+
+# sync_master records the files it copied here, relative to the
+# master's configuration directory, so files removed locally can be
+# removed from the master without touching files that were never ours.
+SyncedListName = '.sirikata-cluster-synced'
+
+def sync_master(puppet_base_path):
+    '''Copy puppet data to the master's configuration directory,
+    skipping files whose content and mode are already up to date, and
+    remove files a previous sync copied that no longer exist locally.
+    Returns the list of (relative) paths that were copied or removed.'''
+    puppet_local_data_path = data.path('puppet')
+    local = {}
+    for dirpath, dirnames, filenames in os.walk(puppet_local_data_path):
+        for fname in filenames:
+            src = os.path.join(dirpath, fname)
+            local[os.path.relpath(src, puppet_local_data_path)] = stat.S_IMODE(os.stat(src).st_mode)
+    changed = []
+    for rel, mode in sorted(local.items()):
+        dest = os.path.join(puppet_base_path, rel)
+        if file_hash(os.path.join(puppet_local_data_path, rel)) != file_hash(dest) or \
+                stat.S_IMODE(os.stat(dest).st_mode) != mode:
+            changed.append(rel)
+    synced_list_path = os.path.join(puppet_base_path, SyncedListName)
+    previous = []
+    if os.path.exists(synced_list_path):
+        with open(synced_list_path, 'r') as fp: previous = fp.read().split('\n')
+    removed = sorted([rel for rel in previous if rel and rel not in local])
+    if not changed and not removed and set(previous) >= set(local): return changed
+
+    commands = ['install -D -m %o %s %s' % (local[rel], pipes.quote(os.path.join(puppet_local_data_path, rel)), pipes.quote(os.path.join(puppet_base_path, rel))) for rel in changed]
+    commands += ['rm -f %s' % (pipes.quote(os.path.join(puppet_base_path, rel))) for rel in removed]
+    fd, tmp_path = tempfile.mkstemp(prefix='sirikata-puppet-synced-')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write('\n'.join(sorted(local.keys())) + '\n')
+    commands.append('install -D -m 0644 %s %s' % (pipes.quote(tmp_path), pipes.quote(synced_list_path)))
+    if changed: print "Copying %d changed files %s -> %s" % (len(changed), puppet_local_data_path, puppet_base_path)
+    if removed: print "Removing %d files from %s that no longer exist in %s" % (len(removed), puppet_base_path, puppet_local_data_path)
+    try:
+        with trace.span('puppet sync master'):
+            subprocess.call(['sudo', '/bin/bash', '-c', ' && '.join(commands)])
+    finally:
+        os.remove(tmp_path)
+    return changed + removed
 
 def master_config(*args, **kwargs):
     """puppet master config [--path=/etc/puppet/] [--yes]
@@ -73,9 +164,7 @@ def master_config(*args, **kwargs):
     generate_default_node_config()
 
     # We need to add/replace data. Here we don't ask the user, we just copy all the data into place
-    puppet_local_data_path = data.path('puppet')
-    print "Copying data %s -> %s" % (puppet_local_data_path, puppet_base_path)
-    subprocess.call(['sudo', '/bin/bash', '-c', 'cp -r %s/* %s/' % (puppet_local_data_path, puppet_base_path)])
+    sync_master(puppet_base_path)
 
     # And restart the puppet master
     print "Restarting puppetmaster"
@@ -106,3 +195,65 @@ def update(*args, **kwargs):
 
     master_config('--yes')
     slaves_restart(name_or_config, pem=pemfile)
+
+
+def reload_master(changed):
+    '''Get the puppetmaster to pick up changed files, only restarting
+    it if its own configuration changed.'''
+    if not changed: return
+    if any([rel in MasterConfigFiles for rel in changed]):
+        print "Restarting puppetmaster"
+        subprocess.call(['sudo', 'service', 'puppetmaster', 'restart'])
+    else:
+        print "Reloading puppetmaster"
+        subprocess.call(['sudo', 'service', 'puppetmaster', 'reload'])
+
+def run_agent(cc, node, pemfile, retries=30):
+    '''Run the puppet agent once in the foreground on a node and wait
+    for it to finish. Returns (retcode, duration), where retcode is
+    0 even if changes were applied. If the agent daemon is in the
+    middle of a run, waits for it and then runs again.'''
+    cmd = nodes.node_ssh_args(cc, node, pemfile) + ['sudo', 'puppet', 'agent', '--onetime', '--no-daemonize', '--verbose', '--detailed-exitcodes']
+    start = time.time()
+    for attempt in range(retries):
+        with trace.span('puppet agent run', node=cc.get_node_name(node)):
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out, err = proc.communicate()
+        sys.stdout.write(out)
+        if 'already in progress' not in out: break
+        time.sleep(2)
+    # With --detailed-exitcodes, 2 means changes were applied
+    retcode = proc.returncode
+    if retcode == 2: retcode = 0
+    return (retcode, time.time() - start)
+
+def update_node(*args, **kwargs):
+    """puppet node update cluster_name_or_config node [--path=/etc/puppet/] [--pem=/path/to/key.pem]
+
+    Incremental version of puppet update for when only one node's
+    configuration changed: copies only the changed files to the
+    puppet master, reloads it (restarting only if its own
+    configuration changed) and runs the puppet agent once on the given
+    node, waiting for it to converge.
+    """
+
+    name_or_config, node = arguments.parse_or_die(update_node, [object, object], *args)
+    puppet_base_path = config.kwarg_or_get('path', kwargs, 'PUPPET_PATH', default='/etc/puppet')
+    pemfile = os.path.expanduser(config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE'))
+
+    name, cc = nodes.name_and_config(name_or_config)
+    result = results.Result('puppet node update')
+
+    generate_default_node_config()
+    changed = sync_master(puppet_base_path)
+    reload_master(changed)
+
+    node_name = cc.get_node_name(node)
+    print "Running puppet on %s" % (node_name)
+    retcode, duration = run_agent(cc, node, pemfile)
+    if retcode == 0:
+        print "Node %s converged in %.1f seconds" % (node_name, duration)
+    else:
+        print "Puppet run on %s failed after %.1f seconds" % (node_name, duration)
+    result.add_node(node_name, retcode, duration=duration, data={ 'changed_files' : changed })
+    return result.finish()
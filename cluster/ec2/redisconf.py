@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# Redis deployment profiles for nodes set to one of the sirikata_redis
+# node types. The stock Debian config snapshots to disk (save 900 1,
+# etc.), and the fork for each snapshot causes latency spikes under
+# object host write load, so instead we generate settings for one of
+# a few profiles, with maxmemory sized to the instance type. Leaving
+# out the save lines isn't enough, Redis then falls back to its
+# compiled in snapshot schedule, so every profile sets save "" to turn
+# RDB snapshots off. The settings are written into the generated
+# nodes.pp and rendered by the redis puppet module's template.
+
+# Memory available on each instance type, in MB
+InstanceMemoryMB = {
+    't1.micro' : 613,
+    'm1.small' : 1740,
+    'm1.medium' : 3840,
+    'm1.large' : 7680,
+    'm1.xlarge' : 15360,
+    'm2.xlarge' : 17510,
+    'm2.2xlarge' : 35020,
+    'm2.4xlarge' : 70041,
+    'm3.xlarge' : 15360,
+    'm3.2xlarge' : 30720,
+    'c1.medium' : 1740,
+    'c1.xlarge' : 7168,
+    'cc1.4xlarge' : 23040,
+    'cc2.8xlarge' : 61952,
+    'cr1.8xlarge' : 249856,
+    'hi1.4xlarge' : 61952,
+    'hs1.8xlarge' : 119808,
+    }
+# Used if we don't recognize the instance type
+DefaultMemoryMB = 1740
+
+# Settings shared by all profiles. Must match the paths used by the
+# Ubuntu redis-server package.
+BaseSettings = {
+    'daemonize' : 'yes',
+    'pidfile' : '/var/run/redis/redis-server.pid',
+    'port' : 6379,
+    'bind' : '0.0.0.0',
+    'timeout' : 0,
+    'loglevel' : 'notice',
+    'logfile' : '/var/log/redis/redis-server.log',
+    'databases' : 16,
+    'dir' : '/var/lib/redis',
+    'dbfilename' : 'dump.rdb',
+    'rdbcompression' : 'yes',
+    # No RDB snapshots, see above
+    'save' : '""',
+    'activerehashing' : 'yes',
+    }
+
+# memory_fraction is the share of the instance's memory given to
+# maxmemory. Sirikata runs on the same nodes, and persistent profiles
+# need headroom for copy-on-write during AOF rewrites.
+Profiles = {
+    'memory' : {
+        'description' : 'In-memory only, no persistence',
+        'memory_fraction' : 0.6,
+        'settings' : {
+            'appendonly' : 'no',
+            'maxmemory-policy' : 'volatile-lru',
+            },
+        },
+    'aof' : {
+        'description' : 'Append-only file, fsync every second',
+        'memory_fraction' : 0.45,
+        'settings' : {
+            'appendonly' : 'yes',
+            'appendfsync' : 'everysec',
+            'no-appendfsync-on-rewrite' : 'yes',
+            'auto-aof-rewrite-percentage' : 100,
+            'auto-aof-rewrite-min-size' : '64mb',
+            'maxmemory-policy' : 'noeviction',
+            },
+        },
+    'replica' : {
+        'description' : 'Read replica of another Redis node, no persistence',
+        'memory_fraction' : 0.6,
+        'settings' : {
+            'appendonly' : 'no',
+            'slave-serve-stale-data' : 'yes',
+            # Replicas must hold everything the master has
+            'maxmemory-policy' : 'noeviction',
+            },
+        },
+    }
+
+# Puppet node types -> profile
+NodeTypes = {
+    'sirikata_redis' : 'memory',
+    'sirikata_redis_aof' : 'aof',
+    'sirikata_redis_replica' : 'replica',
+    }
+
+def maxmemory(instance_type, fraction):
+    '''Get a maxmemory setting (in MB) for the instance type.'''
+    total = InstanceMemoryMB.get(instance_type, DefaultMemoryMB)
+    return '%dmb' % (int(total * fraction))
+
+def settings(profile, instance_type, master=None):
+    '''Get the full set of Redis settings for a profile on the given
+    instance type. master is the address of the master Redis node and
+    is required for the replica profile.'''
+    if profile not in Profiles:
+        raise Exception("Unknown Redis profile '%s'" % (profile))
+    prof = Profiles[profile]
+    result = dict(BaseSettings)
+    result.update(prof['settings'])
+    result['maxmemory'] = maxmemory(instance_type, prof['memory_fraction'])
+    if profile == 'replica':
+        if master is None:
+            raise Exception("The replica profile requires a master")
+        result['slaveof'] = '%s %d' % (master, BaseSettings['port'])
+    return result
+
+def render(settings):
+    '''Render settings as a redis.conf, the same way the redis puppet
+    module's template does.'''
+    return ''.join(['%s %s\n' % (key, settings[key]) for key in sorted(settings.keys())])
+
+def puppet_node(pacemakerid, nodetype, instance_type, master=None):
+    '''Generate the nodes.pp entry for a node of one of the Redis node types.'''
+    vals = settings(NodeTypes[nodetype], instance_type, master=master)
+    settings_str = ',\n'.join(["      '%s' => '%s'" % (key, vals[key]) for key in sorted(vals.keys())])
+    return "node '%s' inherits default {\n  class { 'redis':\n    settings => {\n%s\n    }\n  }\n}\n" % (pacemakerid, settings_str)
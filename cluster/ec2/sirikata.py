@@ -24,6 +24,12 @@ def sync_sirikata(*args, **kwargs):
     # Note pemfile is different from other places since it's only required with notify-puppets.
     pemfile = config.kwarg_or_get('pem', kwargs, 'SIRIKATA_CLUSTER_PEMFILE', default=None)
 
+    # EC2 nodes don't keep versions side by side (puppet owns the
+    # Sirikata directory), so there are no version IDs to sync
+    if not os.path.exists(installed_path):
+        print "Couldn't find %s; ec2 sync sirikata needs a Sirikata install or archive, version IDs aren't supported on EC2" % (installed_path)
+        return 1
+
     # Generate the archive if given a directory)
     gen_file = installed_path
     if os.path.isdir(installed_path):
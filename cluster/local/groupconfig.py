@@ -0,0 +1,81 @@
+from cluster.util.nodegroup import NodeGroupConfig
+import getpass, os.path, random
+
+class LocalGroupConfig(NodeGroupConfig):
+    '''A cluster of virtual nodes on the local machine. Each node gets
+    its own directories under base_path, its own range of ports and
+    its own set of CPUs, so a full deployment can be tested on one
+    host without any ssh overhead.'''
+
+    TypeName = 'local'
+    Attributes = ['name', 'typename', 'size', 'state',
+                  'nodes', # List of node properties
+                  'base_path', # Directory holding all the nodes' directories
+                  ]
+
+    def __init__(self, name, **kwargs):
+        # If we've got any non-name params, ensure we have the expected set
+        if kwargs:
+            assert('nodes' in kwargs and \
+                       'base_path' in kwargs)
+            nkwargs = dict(kwargs)
+            nkwargs['size'] = len(kwargs['nodes'])
+            super(LocalGroupConfig, self).__init__(name, typename=self.TypeName, **nkwargs)
+        else:
+            super(LocalGroupConfig, self).__init__(name, **kwargs)
+
+
+    def get_node(cc, node_name):
+        '''Returns a node's info based on its index or id. The special
+        value 'any' will get a random (uniformly) node.
+        '''
+
+        if node_name == 'any':
+            return random.choice(cc.nodes)
+
+        if isinstance(node_name, dict):
+            assert('id' in node_name)
+            return node_name
+
+        try:
+            idx = int(node_name)
+            return cc.nodes[idx]
+        except:
+            pass
+        for inst in cc.nodes:
+            if inst['id'] == node_name:
+                return inst
+        raise Exception("Couldn't find node '" + node_name + "'")
+
+
+
+    def user(self, node=None):
+        return getpass.getuser()
+
+    def hostname(self, node=None):
+        return 'localhost'
+
+    def sirikata_path(self, node=None):
+        if node is None: return os.path.join(self.base_path, 'sirikata')
+        return node['sirikata_path']
+
+    def default_working_path(self, node=None):
+        if node is None: return self.base_path
+        return node['default_working_path']
+
+    def workspace_path(self, node=None):
+        if node is None: return self.base_path
+        return node['workspace_path']
+
+    def capabilities(self, node=None):
+        assert(node is not None and "You must specify a node to look up capabilities.")
+        if 'capabilities' in node: return node['capabilities']
+        return []
+
+    def ports(self, node):
+        '''The (first, last) ports this node's services should use.'''
+        return tuple(node['ports'])
+
+    def cpus(self, node):
+        '''The CPUs (as a taskset list) this node's services run on.'''
+        return node['cpus']
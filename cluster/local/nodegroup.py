@@ -0,0 +1,84 @@
+import nodes
+import cluster.util
+import cluster.util.results as results
+import cluster.util.dag as dag
+from groupconfig import LocalGroupConfig
+
+class NodeGroup(cluster.util.NodeGroup):
+    # Raw command handlers, exported to the sirikata-cluster.py tool.
+    handlers = [
+        ('local create', nodes.create),
+        ('local members info', nodes.members_info),
+        ('local node exec', nodes.node_exec),
+        ('local exec', nodes.exec_all),
+        ('local sync sirikata', nodes.sync_sirikata),
+        ('local sync files', nodes.sync_files),
+        ('local gather', nodes.gather),
+        ('local logs follow', nodes.logs_follow),
+        ('local add service', nodes.add_service),
+        ('local services up', nodes.services_up),
+        ('local service status', nodes.service_status),
+        ('local services rolling-restart', nodes.services_rolling_restart),
+        ('local remove service', nodes.remove_service),
+        ('local destroy', nodes.destroy),
+        ('local facts refresh', nodes.facts_refresh),
+        ('local facts show', nodes.facts_show),
+        ('local network probe', nodes.network_probe),
+        ('local versions install', nodes.versions_install),
+        ('local versions activate', nodes.versions_activate),
+        ('local versions list', nodes.versions_list),
+        ('local versions gc', nodes.versions_gc),
+        ]
+
+    ConfigClass = LocalGroupConfig
+
+    def __init__(self, name):
+        super(NodeGroup, self).__init__(name=name)
+
+
+    def boot(self, **kwargs):
+        # Nothing to do, the nodes' directories are created with the cluster
+        return results.Result('local boot', retcode=0).finish()
+
+    def nodes(self, **kwargs):
+        return nodes.members_info_data(self.config)
+
+    def sync_sirikata(self, path, **kwargs):
+        return results.wrap('local sync sirikata', nodes.sync_sirikata(self.config, path))
+
+    def sync_files(self, target, src, dest, **kwargs):
+        return results.wrap('local sync files', nodes.sync_files(self.config, target, src, dest, **kwargs))
+
+    def gather(self, remote_path, local_dir, **kwargs):
+        return results.wrap('local gather', nodes.gather(self.config, remote_path, local_dir, **kwargs))
+
+    def log_streams(self, service_names=None, lines=10, pattern=None, **kwargs):
+        return nodes.log_streams(self.config, service_names, lines=lines, pattern=pattern)
+
+    def add_service(self, name, target, command, user=None, cwd=None, **kwargs):
+        nkwargs = dict(kwargs)
+        if user is not None: nkwargs['user'] = user
+        if cwd is not None: nkwargs['cwd'] = cwd
+        return results.wrap('local add service', nodes.add_service(self.config, name, target, *command, **nkwargs))
+
+    def start_services(self, specs, parallelism=None, timeout=300, **kwargs):
+        return results.wrap('local services up', nodes.start_services(self.config, dag.validate(specs), parallelism=parallelism, timeout=timeout, **kwargs))
+
+    def probe(self, checks, **kwargs):
+        return nodes.probe_services(self.config, checks, **kwargs)
+
+    def service_status(self, *names, **kwargs):
+        return results.wrap('local service status', nodes.service_status(self.config, *names, **kwargs))
+
+    def restart_service(self, name, version=None, **kwargs):
+        return nodes.restart_service(self.config, name, version=version, **kwargs)
+
+    def remove_service(self, name, **kwargs):
+        return results.wrap('local remove service', nodes.remove_service(self.config, name))
+
+    def facts(self, node=None, ttl=None, **kwargs):
+        return nodes.node_facts(self.config, node, ttl=ttl, **kwargs)
+
+    def terminate(self, **kwargs):
+        # Nothing to do, virtual nodes don't need to be shut down
+        return results.Result('local terminate', retcode=0).finish()
@@ -0,0 +1,765 @@
+#!/usr/bin/env python
+
+from groupconfig import LocalGroupConfig
+import cluster.util.config as config
+import cluster.util.arguments as arguments
+import cluster.util.sirikata as util_sirikata
+import cluster.util.trace as trace
+import cluster.util.results as results
+import cluster.util.parallel as parallel
+import cluster.util.transfer as transfer
+import cluster.util.logs as logs
+import cluster.util.dag as dag
+import cluster.util.resources as resources
+import cluster.util.facts as facts
+import cluster.util.network as network
+import cluster.util.journal as journal
+import cluster.util.versions as versions
+import cluster.util.services as services
+import json, multiprocessing, os, shutil, subprocess, time
+
+def name_and_config(name_or_config):
+    '''Get a name and config given either a name or a config.'''
+    if isinstance(name_or_config, LocalGroupConfig):
+        return (name_or_config.name, name_or_config)
+    else:
+        return (name_or_config, LocalGroupConfig(name_or_config))
+
+def partition_cpus(ncpus, size, cpus_per_node=None):
+    '''Split CPUs 0..ncpus-1 into size disjoint sets, returned as
+    taskset-style lists. If there aren't enough CPUs, sets wrap around
+    and nodes end up sharing CPUs.'''
+    if cpus_per_node is None: cpus_per_node = max(1, ncpus // size)
+    sets = []
+    for idx in range(size):
+        first = (idx * cpus_per_node) % ncpus
+        cpus = [(first + x) % ncpus for x in range(cpus_per_node)]
+        sets.append(','.join([str(c) for c in cpus]))
+    return sets
+
+def node_env(cc, node):
+    '''Environment for commands run on a node, describing the node's
+    resources to the services running there.'''
+    env = dict(os.environ)
+    first_port, last_port = cc.ports(node)
+    env['SIRIKATA_NODE_ID'] = node['id']
+    env['SIRIKATA_PORT_MIN'] = str(first_port)
+    env['SIRIKATA_PORT_MAX'] = str(last_port)
+    return env
+
+def node_run(cc, node, cmd, **kwargs):
+    '''Run a command "on" a node: pinned to its CPUs, in its working
+    directory and with its environment.'''
+    full_cmd = ['taskset', '-c', cc.cpus(node)] + list(cmd)
+    with trace.span('node run', node=node['id'], cmd=' '.join(full_cmd)):
+        return subprocess.call(full_cmd, cwd=kwargs.get('cwd', cc.default_working_path(node)), env=node_env(cc, node))
+
+
+
+def create(*args, **kwargs):
+    """local create name size /path/to/base/dir [--port-base=6000] [--ports-per-node=100] [--cpus-per-node=N] [--shared-sirikata]
+
+    Create a cluster of size virtual nodes on this machine. Each node
+    gets its own sirikata, working and scratch directories under
+    /path/to/base/dir/node-N, a disjoint range of ports starting at
+    port-base and a disjoint set of CPUs that its services are pinned
+    to (by default the available CPUs are divided evenly). With
+    --shared-sirikata all nodes use a single copy of the Sirikata
+    binaries in /path/to/base/dir/sirikata.
+    """
+
+    name, size, base_path = arguments.parse_or_die(create, [str, int, str], *args)
+    port_base = int(config.kwarg_or_default('port-base', kwargs, default=6000))
+    ports_per_node = int(config.kwarg_or_default('ports-per-node', kwargs, default=100))
+    cpus_per_node = config.kwarg_or_default('cpus-per-node', kwargs, default=None)
+    if cpus_per_node is not None: cpus_per_node = int(cpus_per_node)
+    shared_sirikata = bool(config.kwarg_or_default('shared-sirikata', kwargs, default=False))
+
+    base_path = os.path.abspath(base_path)
+    ncpus = multiprocessing.cpu_count()
+    if size * (cpus_per_node or 1) > ncpus:
+        print "Warning: only %d CPUs available, nodes will share CPUs" % (ncpus)
+    cpu_sets = partition_cpus(ncpus, size, cpus_per_node)
+
+    nodes = []
+    for idx in range(size):
+        node_path = os.path.join(base_path, 'node-%d' % (idx))
+        node = {
+            'id' : 'node-%d' % (idx),
+            'dns_name' : 'localhost',
+            'sirikata_path' : os.path.join(base_path, 'sirikata') if shared_sirikata else os.path.join(node_path, 'sirikata'),
+            'default_working_path' : os.path.join(node_path, 'work'),
+            'workspace_path' : os.path.join(node_path, 'scratch'),
+            'ports' : [port_base + idx * ports_per_node, port_base + (idx + 1) * ports_per_node - 1],
+            'cpus' : cpu_sets[idx],
+            }
+        for key in ['sirikata_path', 'default_working_path', 'workspace_path']:
+            if not os.path.exists(node[key]): os.makedirs(node[key])
+        nodes.append(node)
+
+    cc = LocalGroupConfig(name, nodes=nodes, base_path=base_path)
+    cc.save()
+
+    return 0
+
+
+
+def members_info_data(*args, **kwargs):
+    """local members info cluster_name_or_config
+
+    Get a list of members and their properties, in json.
+    """
+
+    name_or_config = arguments.parse_or_die(members_info, [object], *args)
+    name, cc = name_and_config(name_or_config)
+
+    return cc.nodes
+
+def members_info(*args, **kwargs):
+    """local members info cluster_name_or_config
+
+    Get a list of members and their properties, in json.
+    """
+
+    instances = members_info_data(*args, **kwargs)
+    if results.get_format() == 'text':
+        print json.dumps(instances, indent=4)
+    return results.Result('local members info', retcode=0, data=instances)
+
+
+
+def node_exec(*args, **kwargs):
+    """local node exec cluster_name_or_config index_or_name_or_node command to run
+
+    Run a command as if on one of the virtual nodes: in its working
+    directory, pinned to its CPUs, and with SIRIKATA_NODE_ID,
+    SIRIKATA_PORT_MIN and SIRIKATA_PORT_MAX set.
+    """
+
+    name_or_config, idx_or_name_or_node, remote_cmd = arguments.parse_or_die(node_exec, [object, object], rest=True, *args)
+    if not remote_cmd:
+        print "You need to add a command to execute on the node."
+        return 1
+
+    name, cc = name_and_config(name_or_config)
+
+    node = cc.get_node(idx_or_name_or_node)
+    return node_run(cc, node, remote_cmd)
+
+
+def exec_all(*args, **kwargs):
+    """local exec cluster_name_or_config [--parallel=1] command to run
+
+    Run a command on every virtual node in the cluster (see local node
+    exec). By default nodes are handled one at a time; use
+    --parallel=N to run on up to N nodes at once.
+    """
+
+    name_or_config, remote_cmd = arguments.parse_or_die(exec_all, [object], rest=True, *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=1))
+    if not remote_cmd:
+        print "You need to add a command to execute across all the nodes."
+        return 1
+
+    name, cc = name_and_config(name_or_config)
+
+    result = results.Result('local exec')
+    def run_on_node(node):
+        start = time.time()
+        retcode = node_run(cc, node, remote_cmd)
+        result.add_node(node['id'], retcode, duration=time.time()-start)
+    parallel.run(run_on_node, cc.nodes, parallelism=parallelism)
+    return result.finish()
+
+
+def sync_sirikata(*args, **kwargs):
+    """local sync sirikata cluster_name_or_config /path/to/installed/sirikata/or/tbz2 [--resume]
+
+    Install Sirikata binaries for the virtual nodes, extracting the
+    archive directly into each node's sirikata directory (once if
+    nodes share a directory). With --resume, directories the same
+    archive was already extracted into by an earlier, partly failed
+    sync are skipped.
+    """
+
+    name_or_config, path = arguments.parse_or_die(sync_sirikata, [object, str], *args)
+    resume = bool(config.kwarg_or_default('resume', kwargs, default=False))
+
+    name, cc = name_and_config(name_or_config)
+    # Extracting through the link would change an installed version
+    # under its ID
+    linked = [node['id'] for node in cc.nodes if cc.state.get('versions', {}).get(node['id'], {}).get('active')]
+    if linked:
+        print "Nodes %s run installed versions, use versions install instead" % (', '.join(linked))
+        return 1
+
+    # If they specify a directory, package it and replace the path with the package
+    if os.path.isdir(path):
+        retcode = util_sirikata.package(path)
+        if retcode != 0: return retcode
+        path = os.path.join(path, 'sirikata.tar.bz2')
+    path = os.path.abspath(path)
+    archive_size = os.path.getsize(path)
+
+    # Nodes may share a sirikata directory, only extract once into each
+    by_path = {}
+    for node in cc.nodes:
+        by_path.setdefault(cc.sirikata_path(node), []).append(node)
+
+    result = results.Result('local sync sirikata')
+    progress = journal.Journal(cc, 'sync sirikata', resume=resume, key=journal.file_key(path))
+    def extract(sirikata_path):
+        nodes = by_path[sirikata_path]
+        if all([progress.done(node['id'], 'extract') for node in nodes]):
+            for node in nodes: progress.skip(result, node['id'], 'extract')
+            return
+        start = time.time()
+        with trace.span('extract archive', node=nodes[0]['id']):
+            retcode = subprocess.call(['tar', '-xf', path], cwd=sirikata_path)
+        if retcode != 0:
+            print "Failed to extract archive into %s" % (sirikata_path)
+        for node in nodes:
+            progress.mark(node['id'], 'extract', retcode == 0, error='extracting archive failed')
+            result.add_node(node['id'], retcode, duration=time.time()-start, bytes=archive_size if node is nodes[0] else 0,
+                            error='extracting archive failed' if retcode != 0 else None)
+    parallel.run(extract, by_path.keys())
+
+    # The Sirikata version has changed
+    facts.forget(cc, [node['id'] for node in cc.nodes])
+    return progress.finish(result.finish())
+
+
+def sync_files(*args, **kwargs):
+    """local sync files cluster_name_or_config all|idx_or_name_or_node[,idx_or_name_or_node...] local_or_remote:/path local_or_remote:/path [--parallel=N]
+
+    Copy files or directories between the local host and a virtual
+    node, a list of nodes or all nodes. Relative remote: paths are
+    relative to each node's working directory.
+    """
+
+    name_or_config, idx_or_name_or_node, src_path, dest_path = arguments.parse_or_die(sync_files, [object, object, str, str], *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+
+    name, cc = name_and_config(name_or_config)
+
+    targets = transfer.split_targets(idx_or_name_or_node)
+    if targets is None:
+        node_list = cc.nodes
+    else:
+        node_list = [cc.get_node(target) for target in targets]
+
+    result = results.Result('local sync files')
+    def copy(node):
+        # Get correct values out for names
+        paths = [os.path.join(cc.default_working_path(node), p.replace('remote:', '')) if p.startswith('remote:') else p.replace('local:', '') for p in [src_path, dest_path]]
+        start = time.time()
+        with trace.span('sync files', node=node['id']):
+            retcode = subprocess.call(['cp', '-a'] + paths)
+        result.add_node(node['id'], retcode, duration=time.time()-start)
+    parallel.run(copy, node_list, parallelism=parallelism)
+    return result.finish()
+
+def gather(*args, **kwargs):
+    """local gather cluster_name_or_config /remote/path /local/dir [--incremental] [--parallel=N]
+
+    Copy a file or directory from every virtual node into
+    /local/dir/<node id>/, e.g. to collect logs, traces and stats after
+    an experiment. Relative paths are relative to each node's working
+    directory. With --incremental, only data appended to files since
+    the last gather is copied.
+    """
+
+    name_or_config, remote_path, local_dir = arguments.parse_or_die(gather, [object, str, str], *args)
+    incremental = bool(config.kwarg_or_default('incremental', kwargs, default=False))
+    # Nothing goes over the network, so don't spend CPU compressing
+    options = transfer.Options(kwargs)
+
+    name, cc = name_and_config(name_or_config)
+
+    sources = [ (node['id'], os.path.join(cc.default_working_path(node), remote_path)) for node in cc.nodes ]
+    return transfer.gather('local gather', sources, local_dir, options, incremental=incremental)
+
+def log_streams(cc, service_names=None, lines=10, pattern=None):
+    '''Get a logs.Stream for each virtual node running the services.'''
+    return [logs.Stream(node_id, ['/bin/sh', '-c'], logfiles, lines=lines, pattern=pattern)
+            for node_id, logfiles in sorted(logs.service_logfiles(cc.state.get('services', {}), service_names).items())]
+
+def logs_follow(*args, **kwargs):
+    """local logs follow cluster_name_or_config [service_id...] [--filter=REGEX] [--lines=10] [--lag=1.0]
+
+    Stream the logs of the cluster's services (or just the listed
+    ones) live, merged into a single stream ordered by time. Only
+    lines matching --filter (a Perl regex) are shown. --lines sets how
+    many existing lines of each log to start with. Services need a
+    recorded log file, see add service.
+    """
+
+    name_or_config, service_names = arguments.parse_or_die(logs_follow, [object], rest=True, *args)
+    lines, pattern, lag = logs.options(kwargs)
+
+    name, cc = name_and_config(name_or_config)
+    return logs.follow(log_streams(cc, service_names, lines=lines, pattern=pattern), lag=lag)
+
+def add_service(*args, **kwargs):
+    """local add service cluster_name_or_config service_id target_node|any|near:service[,service...] [--user=user] [--cwd=/path/to/execute] [--log-file=/path/to/log] [--probe=SPEC] [--wait-ready[=SECONDS]] [--ports=name=PORT,...] [--cpus=N|--cpuset=LIST] [--memory=SIZE] [--nice=N] [--ionice=CLASS[:N]] [--] command to run
+
+    Add a service to run on one of the virtual nodes. The service
+    needs to be assigned a unique id (a string) and takes the form of a
+    command (which should be able to be shutdown via signals). If the
+    command requires parameters of the form --setting=value, make sure
+    you add -- before the command so they aren't used as arguments to
+    this command. You should also be sure that the command's binary is
+    specified as a full path.
+
+    Services run as the current user, so --user, if given, has to be
+    that user. cwd sets the working directory for the service
+
+    A target of near:service[,service...] picks the node with the
+    lowest round trip time to the nodes running those services, as
+    measured by network probe, for services that talk to them a lot.
+
+    The service is pinned to the node's CPUs. Any appearance of
+    PIDFILE in your command arguments will be replaced with the path to
+    the PID file selected, LOGFILE with a log file path (recorded so
+    logs follow can stream it, or give your own with --log-file) and
+    PORTMIN and PORTMAX with the node's port range.
+
+    Each PORT is replaced with a free port from the node's range that
+    no other service on the node has, and PORT:name with the same port
+    everywhere it appears (including in --probe, e.g.
+    --probe=tcp:PORT:name). PRIVATE_IP is replaced with 127.0.0.1 and
+    NODE_INDEX with the node's index. Allocated ports are saved with
+    the service and freed when it is removed. --ports=name=PORT,...
+    uses the given ports for those names instead of allocating them.
+
+    --probe=SPEC saves a probe with the service, one of tcp:PORT,
+    http:PORT/path, cmd:COMMAND, log:REGEX or pidfile (see
+    cluster/util/probes.py), which service status also checks.
+    --wait-ready[=SECONDS] waits (default: up to 60 seconds) until the
+    service's process is alive and its probe passes, recording how
+    long startup took, and fails if it doesn't become ready in time.
+
+    --cpus=N, --cpuset=LIST, --memory=SIZE, --nice=N and
+    --ionice=CLASS[:N] limit the resources the service can use (see
+    cluster/util/resources.py). --cpus allocates N cores that no other
+    service on the node has, preferring cores from one NUMA node.
+    """
+
+    name_or_config, service_name, target_node, service_cmd = arguments.parse_or_die(add_service, [object, str, str], rest=True, *args)
+    cname, cc = name_and_config(name_or_config)
+    return services.add(ServiceBackend('local', cc, **kwargs), service_name, target_node, service_cmd, **kwargs)
+
+def run_script(cc, node_id, script):
+    '''Run a shell script on a virtual node and return (retcode, output).'''
+    node = cc.get_node(node_id)
+    with trace.span('run script', node=node_id):
+        proc = subprocess.Popen(['/bin/bash', '-s'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cc.default_working_path(node), env=node_env(cc, node))
+        out, err = proc.communicate(script)
+    return proc.returncode, out
+
+def node_topology(cc, node_id, **kwargs):
+    '''Get the virtual node's cores and their NUMA nodes, as { cpu : numa node }.'''
+    node = cc.get_node(node_id)
+    retcode, out = run_script(cc, node_id, resources.TopologyScript)
+    topology = resources.parse_topology(out)
+    cpus = resources.parse_cpuset(cc.cpus(node))
+    return dict([(cpu, topology.get(cpu, 0)) for cpu in cpus])
+
+def stop_service(cc, node, pidfile, cleanup=None):
+    '''Stop the service with the given pid file, sending TERM and then
+    KILL if it doesn't exit, and then run the cleanup script, if any.
+    It isn't an error if the service is already gone, since it probably
+    crashed. Returns the exit code for stopping the service.'''
+    retcode = subprocess.call(['start-stop-daemon', '--stop',
+                               '--retry', 'TERM/6/KILL/5',
+                               '--pidfile', pidfile,
+                               # oknodo allows a successful return if the
+                               # process couldn't actually be found, meaning
+                               # it probably crashed
+                               '--oknodo'])
+    if retcode == 0 and cleanup is not None:
+        run_script(cc, node['id'], cleanup)
+    return retcode
+
+class ServiceBackend(services.Backend):
+    '''Runs services on the virtual nodes, pinned to their CPUs and
+    using their port ranges.'''
+
+    def node_ids(self):
+        return [node['id'] for node in self.cc.nodes]
+
+    def node_id(self, node):
+        return self.cc.get_node(node)['id']
+
+    def node_index(self, node_id):
+        return self.cc.nodes.index(self.cc.get_node(node_id))
+
+    def private_ip(self, node_id):
+        return '127.0.0.1'
+
+    def workspace(self, node_id):
+        return self.cc.workspace_path(self.cc.get_node(node_id))
+
+    def default_cwd(self, node_id):
+        return self.cc.default_working_path(self.cc.get_node(node_id))
+
+    def service_user(self, node_id, user):
+        # Services always run as the current user
+        if user is not None and user != self.cc.user():
+            raise Exception("Services on local clusters run as %s, not %s" % (self.cc.user(), user))
+        return None
+
+    def port_range(self, node_id):
+        return tuple(self.cc.ports(self.cc.get_node(node_id)))
+
+    def substitute(self, node_id, arg):
+        first_port, last_port = self.cc.ports(self.cc.get_node(node_id))
+        return arg.replace('PORTMIN', str(first_port)).replace('PORTMAX', str(last_port))
+
+    def default_cpuset(self, node_id):
+        # Without a core allocation, stay within the node's cores
+        return self.cc.cpus(self.cc.get_node(node_id))
+
+    def launch_data(self, node_id):
+        return { 'cpus' : self.cc.cpus(self.cc.get_node(node_id)) }
+
+    def sirikata_path(self, node_id):
+        return self.cc.sirikata_path(self.cc.get_node(node_id))
+
+    def version_store(self, node_id):
+        return version_store_path(self.cc)
+
+    def run_script(self, node_id, script):
+        return run_script(self.cc, node_id, script)
+
+    def start_service(self, node_id, daemon_cmd, cwd):
+        return node_run(self.cc, self.cc.get_node(node_id), daemon_cmd, cwd=cwd)
+
+    def stop_service(self, node_id, pidfile, cleanup=None):
+        return stop_service(self.cc, self.cc.get_node(node_id), pidfile, cleanup=cleanup)
+
+    def topology(self, node_id):
+        return node_topology(self.cc, node_id)
+
+def probe_services(cc, checks, **kwargs):
+    '''Evaluate readiness probes for services, given as a list of
+    (service name, probe), with one script per node. Returns
+    { service name : passed }.'''
+    return services.probe(ServiceBackend('local', cc, **kwargs), checks)
+
+def start_services(cc, specs, parallelism=None, timeout=300, **kwargs):
+    '''Start services described by specs (see cluster.util.dag) in
+    dependency order.'''
+    return services.start(ServiceBackend('local', cc, **kwargs), specs, parallelism=parallelism, timeout=timeout, **kwargs)
+
+def services_up(*args, **kwargs):
+    """local services up cluster_name_or_config services.json [--parallel=N] [--timeout=300]
+
+    Start the services described in services.json, a list of
+    services with a name, target, command, the services they depend_on
+    and a readiness probe (tcp:PORT, pidfile or log:REGEX). Each
+    service is started as soon as all of its dependencies pass their
+    probes, so independent services start in parallel. --parallel
+    limits how many services are started at once and --timeout how
+    long to wait for a service to become ready. Reports when each
+    service became ready, the critical path and the total time.
+    """
+
+    name_or_config, spec_path = arguments.parse_or_die(services_up, [object, str], *args)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+    timeout = float(config.kwarg_or_default('timeout', kwargs, default=300))
+    nkwargs = dict([(k, v) for k, v in kwargs.items() if k not in ['parallel', 'timeout']])
+
+    name, cc = name_and_config(name_or_config)
+    return start_services(cc, dag.load(spec_path), parallelism=parallelism, timeout=timeout, **nkwargs)
+
+def service_status(*args, **kwargs):
+    """local service status cluster_name_or_config service_id|all [service_id...]
+
+    Check the status of services from the cluster. A service is
+    healthy if its process is alive and the probe saved with it, if
+    any, passes. Returns 0 if all the services are healthy, non-zero
+    otherwise. Checks for services on the same node are batched into a
+    single script.
+    """
+
+    name_or_config, service_name, more_names = arguments.parse_or_die(service_status, [object, str], rest=True, *args)
+
+    cname, cc = name_and_config(name_or_config)
+    return services.status(ServiceBackend('local', cc, **kwargs), service_name, more_names)
+
+def restart_service(cc, service_name, version=None, **kwargs):
+    '''Stop a service and start it again with the command and options
+    it was added with, on the same ports and cores. With version, the
+    command is pointed at the Sirikata installed in that directory
+    instead of the node's usual one (see cluster.util.rolling).
+    Returns True on success.'''
+    return services.restart(ServiceBackend('local', cc, **kwargs), service_name, version=version, **kwargs)
+
+def services_rolling_restart(*args, **kwargs):
+    """local services rolling-restart cluster_name_or_config service_id|all [service_id...] [--batch-size=1] [--max-failure-rate=0] [--timeout=60] [--version=[node:]/path/to/sirikata,...]
+
+    Restart services a batch at a time, e.g. to move them onto new
+    binaries after sync sirikata without taking them all down at once.
+    Each service is stopped and started again with the command and
+    options it was added with, on the same ports and cores, and the
+    next batch starts once every service in the batch is alive and
+    passes its probe (or --timeout seconds pass). Once more than
+    --max-failure-rate of the restarts so far have failed (by default,
+    any of them), the remaining services are left running as they are.
+
+    --version moves services to a different Sirikata install: paths in
+    their commands under the node's Sirikata path are pointed into the
+    given directory instead, or into an installed version if given its
+    ID (see versions install). node:/path selects the version for one
+    node. Reports each batch's downtime and the total time taken.
+    """
+
+    name_or_config, service_name, more_names = arguments.parse_or_die(services_rolling_restart, [object, str], rest=True, *args)
+
+    cname, cc = name_and_config(name_or_config)
+    return services.rolling_restart(ServiceBackend('local', cc, **kwargs), service_name, more_names, **kwargs)
+
+
+def remove_service(*args, **kwargs):
+    """local remove service cluster_name_or_config service_id
+
+    Remove a service from the cluster.
+    """
+
+    name_or_config, service_name = arguments.parse_or_die(remove_service, [object, str], *args)
+
+    cname, cc = name_and_config(name_or_config)
+    return services.remove(ServiceBackend('local', cc, **kwargs), service_name)
+
+
+
+def collect_facts(cc, node_id, **kwargs):
+    '''Run the facts script on a node, returning (retcode, output).'''
+    node = cc.get_node(node_id)
+    retcode, out = run_script(cc, node_id, facts.script(cc.sirikata_path(node=node), cc.workspace_path(node)))
+    # A virtual node only gets its own share of the machine's cores
+    return retcode, out + 'cores=%d\n' % (len(resources.parse_cpuset(cc.cpus(node))))
+
+def node_facts(cc, node=None, ttl=None, **kwargs):
+    '''Get a node's facts, or { node id : facts } for all nodes if node
+    is None, from the cache in the cluster state. Facts that are
+    missing or older than ttl seconds are collected first, from all the
+    nodes that need it at once.'''
+    node_ids = [n['id'] for n in cc.nodes] if node is None else [cc.get_node(node)['id']]
+    if ttl is None: ttl = facts.DefaultTTL
+    all_facts = facts.get('local facts', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), ttl=ttl)
+    if node is None: return all_facts
+    return all_facts.get(node_ids[0])
+
+def facts_refresh(*args, **kwargs):
+    """local facts refresh cluster_name_or_config [node...] [--max-age=SECONDS] [--parallel=N]
+
+    Collect facts about nodes (cores, memory, free disk, kernel and
+    installed Sirikata version) from all nodes, or the given ones, in
+    one parallel sweep, and cache them in the cluster state for
+    placement and validation. With --max-age, nodes whose cached facts
+    are newer than that are skipped.
+    """
+
+    name_or_config, targets = arguments.parse_or_die(facts_refresh, [object], rest=True, *args)
+    max_age = config.kwarg_or_default('max-age', kwargs, default=None)
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [cc.get_node(target)['id'] for target in targets] if targets else [n['id'] for n in cc.nodes]
+    if max_age is not None:
+        node_ids = [node_id for node_id in node_ids if not facts.fresh(cc.state.get('facts', {}).get(node_id), float(max_age))]
+    result = facts.refresh('local facts refresh', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), parallelism=parallelism)
+    if results.get_format() == 'text':
+        print facts.format_table(dict([(node_id, cc.state['facts'][node_id]) for node_id in node_ids if node_id in cc.state.get('facts', {})]))
+    return result
+
+def facts_show(*args, **kwargs):
+    """local facts show cluster_name_or_config [node...] [--ttl=SECONDS]
+
+    Show the cached facts about nodes, collecting them first for nodes
+    without facts or whose facts are older than --ttl seconds (default
+    an hour).
+    """
+
+    name_or_config, targets = arguments.parse_or_die(facts_show, [object], rest=True, *args)
+    ttl = float(config.kwarg_or_default('ttl', kwargs, default=facts.DefaultTTL))
+
+    name, cc = name_and_config(name_or_config)
+
+    node_ids = [cc.get_node(target)['id'] for target in targets] if targets else [n['id'] for n in cc.nodes]
+    all_facts = facts.get('local facts show', cc, node_ids, lambda node_id: collect_facts(cc, node_id, **kwargs), ttl=ttl)
+    if results.get_format() == 'text':
+        print facts.format_table(all_facts)
+    return results.Result('local facts show', retcode=0 if len(all_facts) == len(node_ids) else 1, data=all_facts)
+
+
+def network_probe(*args, **kwargs):
+    """local network probe cluster_name_or_config [--port=PORT] [--bytes=N] [--count=N]
+
+    Measure the round trip time and TCP throughput between every pair
+    of nodes and save them in the cluster state, for placing services
+    with near:SERVICE. Pairs are measured in rounds, each node in at
+    most one pair per round, so measurements don't interfere. --port
+    is the port measurements use on each node; by default it's the
+    highest port in the node's range that no service has and nothing
+    listens on. --bytes is the size of the bulk transfer and
+    --count the number of round trips timed per pair.
+    """
+
+    name_or_config = arguments.parse_or_die(network_probe, [object], *args)
+    port = config.kwarg_or_default('port', kwargs, default=None)
+    nbytes = int(config.kwarg_or_default('bytes', kwargs, default=network.DefaultBytes))
+    count = int(config.kwarg_or_default('count', kwargs, default=network.DefaultCount))
+
+    name, cc = name_and_config(name_or_config)
+    free_port = services.probe_ports(ServiceBackend('local', cc, **kwargs))
+
+    result = network.probe('local network probe', [node['id'] for node in cc.nodes],
+                           lambda node_id, script: run_script(cc, node_id, script),
+                           lambda node_id: '127.0.0.1',
+                           lambda node_id: int(port) if port is not None else free_port(node_id),
+                           count=count, nbytes=nbytes)
+    cc.state['network'] = result.data
+    cc.save()
+    if results.get_format() == 'text':
+        print network.format_table(result.data, 'rtt_ms')
+        print network.format_table(result.data, 'bandwidth_mbps')
+    return result
+
+
+def version_store_path(cc):
+    # Virtual nodes are all on this machine, so they share one store
+    return versions.store_path(cc.base_path)
+
+def version_store(cc, by_link=False, **kwargs):
+    '''The version store of cc's nodes, see cluster.util.versions. The
+    nodes share a store, so operations on it run once. With by_link,
+    they run once per Sirikata path instead, e.g. to activate a
+    version.'''
+    parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+    groups = {}
+    if by_link:
+        by_path = {}
+        for node in cc.nodes:
+            by_path.setdefault(cc.sirikata_path(node), []).append(node['id'])
+        for node_ids in by_path.values(): groups[node_ids[0]] = node_ids
+    else:
+        groups[cc.nodes[0]['id']] = [node['id'] for node in cc.nodes]
+    return versions.Store(cc,
+                          lambda node_id, script: run_script(cc, node_id, script),
+                          lambda node_id: version_store_path(cc),
+                          lambda node_id: cc.sirikata_path(cc.get_node(node_id)),
+                          groups=groups, parallelism=parallelism)
+
+def versions_install(*args, **kwargs):
+    """local versions install cluster_name_or_config /path/to/installed/sirikata/or/tbz2 [--activate] [--budget=MB]
+
+    Install a Sirikata build for the virtual nodes next to the ones
+    already there, in sirikata-versions/ID under the cluster's base
+    directory, where ID is a hash of the archive. Does nothing if it's
+    already installed. --activate switches all the nodes to it, and
+    --budget then removes least recently used versions until the store
+    fits in that many MB.
+    """
+
+    name_or_config, path = arguments.parse_or_die(versions_install, [object, str], *args)
+    activate = bool(config.kwarg_or_default('activate', kwargs, default=False))
+    budget = config.kwarg_or_default('budget', kwargs, default=None)
+
+    name, cc = name_and_config(name_or_config)
+
+    if os.path.isdir(path):
+        retcode = util_sirikata.package(path)
+        if retcode != 0: return retcode
+        path = os.path.join(path, 'sirikata.tar.bz2')
+    path = os.path.abspath(path)
+
+    store = version_store(cc, **kwargs)
+    result = store.install('local versions install', store.groups.keys(), path)
+    version = result.data['version']
+    print "Installed version %s" % (version)
+    if result != 0 or not activate: return result
+    result = versions_activate(cc, version, **kwargs)
+    if result != 0 or budget is None: return result
+    return store.gc('local versions gc', store.groups.keys(), int(float(budget) * 1024**2))
+
+def versions_activate(*args, **kwargs):
+    """local versions activate cluster_name_or_config version [--parallel=N]
+
+    Switch every virtual node to an installed Sirikata version by
+    pointing the node's sirikata directory at it (once if nodes share
+    a directory). The switch is a single rename, so nothing sees a
+    half-updated install. Running services keep the binaries they
+    started with until they're restarted, e.g. with services
+    rolling-restart. Nodes' sirikata directories have to be empty,
+    not hold binaries from sync sirikata.
+    """
+
+    name_or_config, version = arguments.parse_or_die(versions_activate, [object, str], *args)
+
+    name, cc = name_and_config(name_or_config)
+
+    store = version_store(cc, by_link=True, **kwargs)
+    return store.activate('local versions activate', store.groups.keys(), version)
+
+def versions_list(*args, **kwargs):
+    """local versions list cluster_name_or_config
+
+    List the Sirikata versions installed for the virtual nodes, with
+    their size and when they were last installed or activated. Each
+    node's active version is marked with a *.
+    """
+
+    name_or_config = arguments.parse_or_die(versions_list, [object], *args)
+
+    name, cc = name_and_config(name_or_config)
+
+    store = version_store(cc, by_link=True, **kwargs)
+    result = store.refresh('local versions list', store.groups.keys())
+    if results.get_format() == 'text':
+        print versions.format_table(cc.state, [node['id'] for node in cc.nodes])
+    return result
+
+def versions_gc(*args, **kwargs):
+    """local versions gc cluster_name_or_config --budget=MB
+
+    Remove Sirikata versions, least recently used first, until the
+    store fits in --budget MB. Versions that are active on any node or
+    that services were started with are kept, even if that leaves the
+    store over budget.
+    """
+
+    name_or_config = arguments.parse_or_die(versions_gc, [object], *args)
+    budget = config.kwarg_or_default('budget', kwargs, default=None)
+    if budget is None:
+        print "Specify the disk budget with --budget=MB"
+        return 1
+
+    name, cc = name_and_config(name_or_config)
+
+    store = version_store(cc, **kwargs)
+    return store.gc('local versions gc', store.groups.keys(), int(float(budget) * 1024**2))
+
+
+def destroy(*args, **kwargs):
+    """local destroy name_or_config [--delete-files]
+
+    Destroy the cluster's record. With --delete-files, also remove the
+    nodes' directories.
+    """
+
+    name_or_config = arguments.parse_or_die(destroy, [object], *args)
+    delete_files = bool(config.kwarg_or_default('delete-files', kwargs, default=False))
+
+    name, cc = name_and_config(name_or_config)
+
+    if cc.state.get('services'):
+        print "There are still services running on this cluster, remove them first."
+        return 1
+    if delete_files:
+        shutil.rmtree(cc.base_path, ignore_errors=True)
+    cc.delete()
+    return 0
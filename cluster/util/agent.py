@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+# Client for the node agent (cluster/data/agent/sirikata-agent.py).
+# Once the agent is installed on a cluster's nodes (agent install, or
+# the sirikata puppet class for EC2), commands that would otherwise
+# spawn an ssh process per remote command instead send JSON RPCs to
+# the agent. Each node gets a single long-lived ssh process forwarding
+# a local unix socket to the agent's socket; every RPC then only costs
+# a new channel on that connection, takes its arguments as a list
+# (no shell escaping) and can batch several operations.
+#
+# Backends record the agent's socket path for each node in
+# state['agent'] and fall back to plain ssh for nodes without one, when
+# the forward can't be set up, or when the agent stops answering in
+# the middle of a command.
+
+import trace
+import data
+import atexit, json, os, shutil, socket, subprocess, tempfile, threading, time
+
+# Where the agent lives on nodes, relative to the node's workspace path
+ScriptName = 'sirikata-agent.py'
+SocketName = 'sirikata-agent.sock'
+
+def script_path():
+    '''The agent script, to be copied to nodes.'''
+    return data.path('agent', ScriptName)
+
+def start_command(workspace):
+    '''Shell words for starting the agent on a node, from the copy in
+    its workspace. This is a no-op if it's already running.'''
+    return ['python', os.path.join(workspace, ScriptName), '--daemon', '--socket=' + os.path.join(workspace, SocketName)]
+
+def stop_command(workspace):
+    return ['python', os.path.join(workspace, ScriptName), '--stop', '--socket=' + os.path.join(workspace, SocketName)]
+
+
+class AgentError(Exception):
+    pass
+
+class Connection(object):
+    '''An ssh-forwarded connection to one node's agent. ssh_args is the
+    ssh command line used to reach the node, up to but not including
+    the remote command.'''
+
+    def __init__(self, node, ssh_args, remote_socket):
+        self.node = node
+        self.ssh_args = list(ssh_args)
+        self.remote_socket = remote_socket
+        self.local_dir = tempfile.mkdtemp(prefix='sirikata-agent-')
+        self.local_socket = os.path.join(self.local_dir, 'agent.sock')
+        self.proc = None
+        self.next_id = 0
+        self.id_lock = threading.Lock()
+
+    def open(self, timeout=15):
+        '''Start the forward and check the agent answers. Raises
+        AgentError if it doesn't.'''
+        cmd = self.ssh_args[:1] + ['-N', '-o', 'ExitOnForwardFailure yes', '-L', self.local_socket + ':' + self.remote_socket] + self.ssh_args[1:]
+        with trace.span('agent connect', node=self.node):
+            self.proc = subprocess.Popen(cmd)
+            deadline = time.time() + timeout
+            while not os.path.exists(self.local_socket):
+                if self.proc.poll() is not None or time.time() > deadline:
+                    self.close()
+                    raise AgentError("Couldn't forward the agent socket for %s" % (self.node))
+                time.sleep(0.02)
+            # The forward can come up without the agent answering, e.g.
+            # if it isn't running, and then ssh has to go too
+            try:
+                self.call([ { 'op' : 'ping' } ])
+            except (AgentError, ValueError, socket.error) as e:
+                self.close()
+                if isinstance(e, AgentError): raise
+                raise AgentError("The agent on %s didn't answer: %s" % (self.node, str(e)))
+
+    def _connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.local_socket)
+        except socket.error as e:
+            s.close()
+            raise AgentError("Couldn't reach the agent on %s: %s" % (self.node, str(e)))
+        return s
+
+    def _request(self, calls, parallel=False):
+        with self.id_lock:
+            self.next_id += 1
+            req_id = self.next_id
+        s = self._connect()
+        try:
+            s.sendall(json.dumps({ 'id' : req_id, 'calls' : calls, 'parallel' : parallel }) + '\n')
+        except socket.error as e:
+            s.close()
+            raise AgentError("Lost the connection to the agent on %s: %s" % (self.node, str(e)))
+        return s, s.makefile('rb')
+
+    def _response(self, fp):
+        try:
+            line = fp.readline()
+        except socket.error as e:
+            raise AgentError("Lost the connection to the agent on %s: %s" % (self.node, str(e)))
+        if not line: raise AgentError("The agent on %s closed the connection" % (self.node))
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise AgentError("Bad response from the agent on %s" % (self.node))
+
+    def call(self, calls, parallel=False):
+        '''Run a batch of calls (dicts with an 'op' and its arguments),
+        returning their results in order.'''
+        with trace.span('agent call', node=self.node, cmd=','.join([c['op'] for c in calls])):
+            s, fp = self._request(calls, parallel=parallel)
+            try:
+                response = self._response(fp)
+            finally:
+                fp.close()
+                s.close()
+        if 'results' not in response: raise AgentError(response.get('error', 'bad response from the agent on %s' % (self.node)))
+        return response['results']
+
+    def run(self, argv, cwd=None, input=None, op='run'):
+        '''Run a command, returning (retcode, stdout, stderr).'''
+        call = { 'op' : op, 'argv' : list(argv) }
+        if cwd is not None: call['cwd'] = cwd
+        if input is not None: call['input'] = input
+        result = self.call([call])[0]
+        if not result['ok']: return (127, '', result['error'].encode('utf-8') + '\n')
+        return (result['retcode'], result['stdout'].encode('utf-8'), result['stderr'].encode('utf-8'))
+
+    def start_service(self, argv, cwd=None):
+        '''Run a command that daemonizes, e.g. start-stop-daemon --start,
+        returning (retcode, stdout, stderr).'''
+        return self.run(argv, cwd=cwd, op='start_service')
+
+    def stream(self, path, out, offset=0):
+        '''Copy a file from the node to the file object out, returning
+        the number of bytes copied.'''
+        with trace.span('agent stream', node=self.node, cmd=path):
+            s, fp = self._request([ { 'op' : 'stream_file', 'path' : path, 'offset' : offset } ])
+            try:
+                while True:
+                    msg = self._response(fp)
+                    if 'bytes' in msg and 'results' not in msg:
+                        # Raw file data follows the header
+                        remaining = msg['bytes']
+                        while remaining > 0:
+                            data = fp.read(min(remaining, 1024*1024))
+                            if not data: raise AgentError("The agent on %s closed the connection" % (self.node))
+                            out.write(data)
+                            remaining -= len(data)
+                        continue
+                    result = msg['results'][0]
+                    if not result['ok']: raise AgentError(result['error'])
+                    return result['bytes']
+            finally:
+                fp.close()
+                s.close()
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+
+
+# Connections are kept for the life of the process, one per node
+_lock = threading.Lock()
+_node_locks = {}
+_connections = {}
+
+def connection(key, node, ssh_args, remote_socket):
+    '''Get an open connection to a node's agent, or None if it can't be
+    reached, in which case callers should fall back to ssh. key
+    identifies the cluster and node, e.g. (cluster name, node id).'''
+    # Connect to different nodes concurrently, but only once per node
+    with _lock:
+        node_lock = _node_locks.setdefault(key, threading.Lock())
+    with node_lock:
+        if key not in _connections:
+            conn = Connection(node, ssh_args, remote_socket)
+            try:
+                conn.open()
+            except AgentError as e:
+                print "%s, falling back to ssh" % (str(e))
+                conn = None
+            _connections[key] = conn
+        return _connections[key]
+
+def forget(key):
+    with _lock:
+        conn = _connections.pop(key, None)
+    if conn is not None: conn.close()
+
+def lost(key, error):
+    '''Drop the connection to an agent that failed mid-command, so the
+    caller can retry over ssh.'''
+    print "%s, falling back to ssh" % (str(error))
+    forget(key)
+
+def close_all():
+    with _lock:
+        conns = [conn for conn in _connections.values() if conn is not None]
+        _connections.clear()
+    for conn in conns: conn.close()
+
+atexit.register(close_all)
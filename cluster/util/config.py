@@ -12,7 +12,8 @@ _config_names = [
     'INSTANCE_TYPE', # instance type, e.g. t1.micro
     'SECURITY_GROUP', # EC2 security group, affects firewall settings
 
-    'SIRIKATA_CLUSTER_PEMFILE' # pemfile key for ssh'ing into nodes
+    'SIRIKATA_CLUSTER_PEMFILE', # pemfile key for ssh'ing into nodes
+    'SIRIKATA_EC2_API_RATE', # EC2 API requests per second, see ec2/client.py
 ]
 _required_config_names = [
 ]
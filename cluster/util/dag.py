@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# Dependency-ordered service startup. Services are declared with the
+# services they depend on and a readiness probe; each service is
+# started as soon as everything it depends on is ready, so independent
+# services start in parallel across nodes. A services file is JSON,
+# either a list of services or { "services" : [...] }, e.g.
+#
+#   [
+#     { "name" : "redis", "target" : "any", "probe" : "tcp:6379",
+#       "command" : ["/usr/bin/redis-server", "/etc/redis/redis.conf"] },
+#     { "name" : "space", "target" : "any", "depends_on" : ["redis"],
+#       "probe" : "log:Listening",
+#       "command" : ["/home/ubuntu/sirikata/bin/space", "--pid-file=PIDFILE"] }
+#   ]
+#
+# Other keys (user, cwd, log-file, force-daemonize, ...) are passed on
+# to add service.
+
+import results
+import trace
+import json, Queue, threading, time
+
+SpecKeys = ['name', 'target', 'command', 'depends_on', 'probe']
+
+def load(path):
+    '''Load and validate service specifications from a JSON file.'''
+    with open(path, 'r') as fp:
+        specs = json.load(fp)
+    if isinstance(specs, dict): specs = specs['services']
+    return validate(specs)
+
+def validate(specs):
+    '''Check names are unique, dependencies exist and there are no
+    cycles. Returns the specs with defaults filled in.'''
+    by_name = {}
+    for spec in specs:
+        spec = dict(spec)
+        if 'name' not in spec or 'command' not in spec:
+            raise Exception("Services need at least a name and a command: %s" % (json.dumps(spec)))
+        if spec['name'] in by_name: raise Exception("Duplicate service '%s'" % (spec['name']))
+        if isinstance(spec['command'], basestring): spec['command'] = spec['command'].split()
+        spec['command'] = [str(x) for x in spec['command']]
+        spec.setdefault('target', 'any')
+        spec.setdefault('depends_on', [])
+        spec.setdefault('probe', None)
+        by_name[spec['name']] = spec
+    for spec in by_name.values():
+        # near:SERVICE targets need those services placed first
+        if isinstance(spec['target'], basestring) and spec['target'].startswith('near:'):
+            near = [name for name in spec['target'][len('near:'):].split(',') if name in by_name]
+            spec['depends_on'] = list(spec['depends_on']) + [name for name in near if name not in spec['depends_on']]
+    for spec in by_name.values():
+        for dep in spec['depends_on']:
+            if dep not in by_name: raise Exception("Service '%s' depends on unknown service '%s'" % (spec['name'], dep))
+    order(by_name)
+    return [by_name[spec['name']] for spec in specs]
+
+def order(by_name):
+    '''Topologically sort the services, raising an exception on cycles.'''
+    done, visiting, result = set(), set(), []
+    def visit(name, path):
+        if name in done: return
+        if name in visiting: raise Exception("Dependency cycle: %s" % (' -> '.join(path + [name])))
+        visiting.add(name)
+        for dep in by_name[name]['depends_on']: visit(dep, path + [name])
+        visiting.remove(name)
+        done.add(name)
+        result.append(name)
+    for name in sorted(by_name.keys()): visit(name, [])
+    return result
+
+def spec_kwargs(spec):
+    '''The extra add service options given in a spec.'''
+    return dict([(str(k), v) for k, v in spec.items() if k not in SpecKeys])
+
+
+class Timing(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = None # When we began starting it
+        self.launched = None # When start returned
+        self.ready = None # When the probe passed
+        self.error = None
+
+
+def schedule(specs, start, probe, parallelism=None, timeout=300, poll=0.5):
+    '''Start services in dependency order. start(spec) starts one
+    service, returning True on success, and is called from worker
+    threads. probe(list of (name, probe)) checks readiness of started
+    services in one batch and returns { name : passed }. Returns a
+    dict of Timing objects, relative to the beginning of the run.'''
+
+    by_name = dict([(spec['name'], spec) for spec in specs])
+    timings = dict([(name, Timing(name)) for name in by_name])
+    base = time.time()
+    now = lambda: time.time() - base
+
+    pending = set(by_name.keys()) # Not yet started
+    starting = set() # start() in progress
+    waiting = set() # Started, waiting for the probe
+    finished = Queue.Queue()
+    parent = trace.current()
+
+    def launch(name):
+        ok, error = False, None
+        try:
+            with trace.attach(parent):
+                with trace.span('start service', cmd=name):
+                    ok = start(by_name[name])
+        except Exception as e:
+            error = str(e)
+        finished.put( (name, ok, error) )
+
+    def ready(name):
+        return timings[name].ready is not None
+
+    def failed(name):
+        return timings[name].error is not None
+
+    while pending or starting or waiting:
+        # Anything depending on a failed service can't be started
+        for name in sorted(pending):
+            bad = [dep for dep in by_name[name]['depends_on'] if failed(dep)]
+            if bad:
+                timings[name].error = 'dependency %s failed' % (bad[0])
+                pending.remove(name)
+
+        # Start everything whose dependencies are ready
+        for name in sorted(pending):
+            if parallelism and len(starting) >= parallelism: break
+            if all([ready(dep) for dep in by_name[name]['depends_on']]):
+                pending.remove(name)
+                starting.add(name)
+                timings[name].started = now()
+                t = threading.Thread(target=launch, args=(name,))
+                t.daemon = True
+                t.start()
+
+        if not starting and not waiting:
+            # Anything still pending depends on a failed service and is
+            # dropped on the next pass
+            continue
+
+        # Collect finished starts, waiting at most one poll interval
+        try:
+            name, ok, error = finished.get(timeout=poll)
+            while True:
+                starting.remove(name)
+                timings[name].launched = now()
+                if not ok:
+                    timings[name].error = error or 'failed to start'
+                elif by_name[name]['probe'] is None:
+                    timings[name].ready = timings[name].launched
+                else:
+                    waiting.add(name)
+                name, ok, error = finished.get_nowait()
+        except Queue.Empty:
+            pass
+
+        if waiting:
+            with trace.span('probe', cmd=','.join(sorted(waiting))):
+                passed = probe([ (name, by_name[name]['probe']) for name in sorted(waiting) ])
+            for name in sorted(waiting):
+                if passed.get(name):
+                    timings[name].ready = now()
+                    waiting.remove(name)
+                elif now() - timings[name].launched > timeout:
+                    timings[name].error = 'not ready after %d seconds' % (timeout)
+                    waiting.remove(name)
+
+    return timings
+
+def critical_path(specs, timings):
+    '''The chain of services that determined the total bring-up time:
+    starting from the service that became ready last, repeatedly
+    follow the dependency that became ready last.'''
+    by_name = dict([(spec['name'], spec) for spec in specs])
+    ready = [t for t in timings.values() if t.ready is not None]
+    if not ready: return []
+    name = max(ready, key=lambda t: t.ready).name
+    path = [name]
+    while by_name[name]['depends_on']:
+        name = max(by_name[name]['depends_on'], key=lambda dep: timings[dep].ready)
+        path.insert(0, name)
+    return path
+
+def bring_up(op, specs, start, probe, node_of=None, parallelism=None, timeout=300):
+    '''Run schedule() and report the outcome for each service, the
+    critical path and the total time. node_of(name) gives the node a
+    service was placed on, for the result.'''
+
+    result = results.Result(op)
+    timings = schedule(specs, start, probe, parallelism=parallelism, timeout=timeout)
+
+    for spec in specs:
+        t = timings[spec['name']]
+        data = { 'service' : spec['name'], 'started' : t.started, 'ready' : t.ready }
+        node = node_of(spec['name']) if node_of is not None else None
+        if t.error is None:
+            print "%s ready at +%.1fs (started at +%.1fs)" % (spec['name'], t.ready, t.started)
+            result.add_node(node, 0, duration=t.ready - t.started, data=data)
+        else:
+            print "%s failed: %s" % (spec['name'], t.error)
+            result.add_node(node, 1, error=t.error, data=data)
+
+    path = critical_path(specs, timings)
+    if path:
+        print "Critical path: " + ' -> '.join(['%s (%.1fs)' % (name, timings[name].ready - timings[name].started) for name in path])
+    result.finish()
+    print "Brought up %d of %d services in %.1f seconds" % (len([t for t in timings.values() if t.error is None]), len(specs), result.duration)
+    result.data = { 'critical_path' : path }
+    return result
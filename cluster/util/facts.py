@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Cached facts about nodes: cores, memory, free disk in the workspace,
+# kernel and the installed Sirikata version. facts refresh collects
+# them from all nodes in one parallel sweep (one script per node) and
+# saves them in state['facts'] with the time they were collected, so
+# placement and validation can use them without another round trip.
+# Facts older than a TTL (an hour by default) are considered stale and
+# are collected again the next time they're asked for.
+
+import results
+import parallel
+import trace
+import pipes, threading, time
+
+DefaultTTL = 3600
+
+# Facts that are numbers; everything else is kept as a string
+IntegerFacts = ['cores', 'memory', 'memory_available', 'disk_total', 'disk_free']
+
+# Prints key=value lines. Expects $sirikata and $workspace to be set.
+# Without a VERSION file, the Sirikata version is a fingerprint of the
+# installed files' names, sizes and times, which match across nodes
+# that extracted the same archive. When the Sirikata path is a link
+# into the version store (see cluster.util.versions), the version is
+# the store's ID for it.
+FactsScript = '''echo "hostname=$(hostname)"
+echo "cores=$(nproc 2>/dev/null || grep -c ^processor /proc/cpuinfo)"
+awk '/^MemTotal:/ { print "memory=" $2 * 1024 } /^MemAvailable:/ { print "memory_available=" $2 * 1024 }' /proc/meminfo
+df -Pk "$workspace" 2>/dev/null | awk 'NR == 2 { print "disk_total=" $2 * 1024; print "disk_free=" $4 * 1024 }'
+echo "kernel=$(uname -r)"
+if [ -L "$sirikata" ] && [ "$(basename "$(dirname "$(readlink "$sirikata")")")" = sirikata-versions ]; then
+  echo "sirikata_version=$(basename "$(readlink "$sirikata")")"
+elif [ -f "$sirikata/VERSION" ]; then
+  echo "sirikata_version=$(head -n 1 "$sirikata/VERSION")"
+elif [ -d "$sirikata/bin" ]; then
+  echo "sirikata_version=$(cd "$sirikata" && find bin lib -type f -printf '%P %s %T@\\n' 2>/dev/null | sort | md5sum | cut -c1-12)"
+fi
+'''
+
+def script(sirikata_path, workspace_path):
+    '''The script collecting a node's facts.'''
+    return 'sirikata=%s\nworkspace=%s\n' % (pipes.quote(sirikata_path), pipes.quote(workspace_path)) + FactsScript
+
+def parse(output):
+    '''Parse FactsScript output into a dict. Later lines override
+    earlier ones.'''
+    facts = {}
+    for line in output.splitlines():
+        if line.find('=') == -1: continue
+        key, value = line.split('=', 1)
+        key, value = key.strip(), value.strip()
+        if key in IntegerFacts:
+            try:
+                value = int(float(value))
+            except ValueError:
+                continue
+        facts[key] = value
+    return facts
+
+def fresh(entry, ttl=DefaultTTL, now=None):
+    '''Whether a cached entry was collected within ttl seconds.'''
+    if entry is None: return False
+    if now is None: now = time.time()
+    return now - entry.get('collected', 0) <= ttl
+
+def cached(cc, node_ids=None, ttl=DefaultTTL):
+    '''The cached facts that are still fresh, as { node id : facts },
+    without contacting any nodes.'''
+    all_facts = cc.state.get('facts', {})
+    if node_ids is None: node_ids = all_facts.keys()
+    now = time.time()
+    return dict([(node_id, all_facts[node_id]) for node_id in node_ids if fresh(all_facts.get(node_id), ttl, now)])
+
+
+def refresh(op, cc, node_ids, collect, parallelism=None):
+    '''Collect facts from node_ids concurrently and save them in the
+    cluster state. collect(node_id) runs the facts script on the node
+    and returns (retcode, output). Returns a Result with each node's
+    facts as its data.'''
+    result = results.Result(op)
+    collected = {}
+    lock = threading.Lock()
+    def refresh_node(node_id):
+        start = time.time()
+        with trace.span('collect facts', node=node_id):
+            retcode, output = collect(node_id)
+        facts = parse(output or '')
+        if retcode != 0 or not facts:
+            result.add_node(node_id, retcode or 1, duration=time.time()-start, error="couldn't collect facts")
+            return
+        facts['collected'] = time.time()
+        with lock:
+            collected[node_id] = facts
+        result.add_node(node_id, 0, duration=time.time()-start, data=facts)
+    parallel.run(refresh_node, node_ids, parallelism=parallelism)
+
+    if collected:
+        cc.state.setdefault('facts', {}).update(collected)
+        cc.save()
+    return result.finish()
+
+def get(op, cc, node_ids, collect, ttl=DefaultTTL, parallelism=None):
+    '''Get facts for node_ids as { node id : facts }, collecting them,
+    in one sweep, only for nodes whose cached facts are missing or
+    stale. Nodes that can't be reached are left out.'''
+    stale = [node_id for node_id in node_ids if not fresh(cc.state.get('facts', {}).get(node_id), ttl)]
+    if stale: refresh(op, cc, stale, collect, parallelism=parallelism)
+    all_facts = cc.state.get('facts', {})
+    return dict([(node_id, all_facts[node_id]) for node_id in node_ids if node_id in all_facts])
+
+def forget(cc, node_ids=None):
+    '''Drop cached facts, e.g. after nodes are replaced or changed.'''
+    if 'facts' not in cc.state: return
+    if node_ids is None:
+        del cc.state['facts']
+    else:
+        for node_id in node_ids: cc.state['facts'].pop(node_id, None)
+
+
+def format_table(all_facts, now=None):
+    '''Format facts as a table for text output.'''
+    if now is None: now = time.time()
+    def size(value):
+        if value is None: return '-'
+        return '%.1fG' % (float(value) / 1024**3)
+    lines = ['%-24s %5s %8s %8s %9s %-20s %-14s %s' % ('node', 'cores', 'memory', 'mem free', 'disk free', 'kernel', 'sirikata', 'age')]
+    for node_id, facts in sorted(all_facts.items()):
+        lines.append('%-24s %5s %8s %8s %9s %-20s %-14s %ds' % (
+                node_id, facts.get('cores', '-'), size(facts.get('memory')), size(facts.get('memory_available')),
+                size(facts.get('disk_free')), facts.get('kernel', '-'), facts.get('sirikata_version', '-'),
+                now - facts.get('collected', now)))
+    return '\n'.join(lines)
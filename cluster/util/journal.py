@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Progress journals for operations that run a series of steps on every
+# node, like booting nodes or syncing Sirikata. As each node finishes
+# (or fails) a step it's recorded in state['journal'][operation], so
+# if the operation is interrupted or some nodes fail, running it again
+# with --resume skips the steps nodes already completed and only
+# retries the failed and pending ones.
+#
+# A journal is tied to the inputs of the operation by a key (e.g. a
+# hash of the archive being synced): resuming with different inputs
+# starts from the beginning. Once every node has completed, the journal
+# is removed.
+
+import hashlib, time
+
+def file_key(path):
+    '''A key identifying a file's contents.'''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024*1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class Journal(object):
+    '''Tracks the progress of operation on cc's nodes. With resume, picks
+    up the journal left by an earlier run with the same key.'''
+
+    def __init__(self, cc, operation, resume=False, key=None):
+        self.cc = cc
+        self.operation = operation
+        journals = cc.state.setdefault('journal', {})
+        existing = journals.get(operation)
+        self.resuming = bool(resume and existing is not None and existing.get('key') == key)
+        if self.resuming:
+            self.entry = existing
+            print "Resuming %s started at %s" % (operation, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(existing['started'])))
+        else:
+            if resume:
+                if existing is None:
+                    print "No interrupted %s to resume, starting from the beginning" % (operation)
+                else:
+                    print "The interrupted %s used different inputs, starting from the beginning" % (operation)
+            self.entry = journals[operation] = { 'key' : key, 'started' : time.time(), 'nodes' : {} }
+        cc.save()
+
+    def status(self, node_id, step):
+        '''The recorded status of a step on a node: 'done', 'failed' or
+        None if it hasn't run.'''
+        return self.entry['nodes'].get(node_id, {}).get(step, {}).get('status')
+
+    def done(self, node_id, step):
+        '''Whether the step can be skipped for this node because an earlier
+        run completed it.'''
+        return self.resuming and self.status(node_id, step) == 'done'
+
+    def todo(self, node_ids, step):
+        '''The nodes in node_ids that still need to run step.'''
+        remaining = [node_id for node_id in node_ids if not self.done(node_id, step)]
+        if len(remaining) != len(node_ids):
+            print "Skipping %s on %d of %d nodes, already done" % (step, len(node_ids) - len(remaining), len(node_ids))
+        return remaining
+
+    def mark(self, node_id, step, ok, error=None):
+        '''Record the outcome of a step on a node and save it.'''
+        record = { 'status' : 'done' if ok else 'failed', 'at' : time.time() }
+        if not ok and error: record['error'] = error
+        # Nodes are marked from worker threads
+        with self.cc.lock:
+            self.entry['nodes'].setdefault(node_id, {})[step] = record
+            self.cc.save()
+
+    def skip(self, result, node_id, step):
+        '''Add a node that's being skipped to result as a success.'''
+        result.add_node(node_id, 0, data={ 'step' : step, 'resumed' : True })
+
+    def finish(self, result):
+        '''Drop the journal if result is a success, otherwise keep it for
+        --resume. Returns result.'''
+        if result == 0:
+            with self.cc.lock:
+                self.cc.state['journal'].pop(self.operation, None)
+                if not self.cc.state['journal']: del self.cc.state['journal']
+        else:
+            failed = len([nr for nr in result.nodes if nr.retcode != 0])
+            print "%s didn't complete on %d node%s, run it again with --resume to retry only those" % (
+                self.operation[0].upper() + self.operation[1:], failed, '' if failed == 1 else 's')
+        self.cc.save()
+        return result
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Live, merged log streaming. Each node gets a single streaming
+# channel (an ssh session running tail) covering the log files of all
+# the services on it. Lines are filtered and timestamped on the node,
+# so only matching lines cross the network, and then merged locally by
+# timestamp into one ordered stream.
+#
+# Streams never end, so the merge can't wait to see every node's next
+# line before printing. Instead a line is printed once every stream has
+# something buffered, or once it is older than the allowed lag, on the
+# assumption that node clocks are kept close by ntp. Each stream's
+# buffer is bounded; when it fills up, the reader stops reading and ssh
+# flow control pushes back on the node.
+
+import trace
+import config
+import pipes, Queue, subprocess, sys, threading, time
+
+# Timestamps each line with the node's clock, tracks which file it
+# came from using tail's '==> file <==' headers and applies the filter.
+# The pattern is passed as the only argument so it doesn't need
+# escaping for perl.
+_tagger = r'''BEGIN { $| = 1; $re = shift @ARGV; }
+if (/^==> (.*) <==$/) { $file = $1; next; }
+next if /^$/;
+next if length($re) && !/$re/o;
+printf("%.6f\t%s\t%s", time(), $file, $_);'''
+
+def remote_command(logfiles, lines=10, pattern=None):
+    '''The shell command to run on a node to stream the given log files.'''
+    tail = ['tail', '-n', str(lines), '-F'] + list(logfiles)
+    # Force tail to print headers even for a single file so the tagger
+    # always knows which file a line belongs to
+    if len(logfiles) == 1: tail.insert(1, '-v')
+    tagger = ['perl', '-MTime::HiRes=time', '-ne', _tagger, pattern or '']
+    return ' '.join([pipes.quote(x) for x in tail]) + ' 2>/dev/null | ' + ' '.join([pipes.quote(x) for x in tagger])
+
+
+def service_logfiles(services, names=None):
+    '''Group the log files of services (a cluster's state['services'])
+    by node, returning { node : { logfile : service } }. names limits
+    this to some of the services.'''
+    if not names: names = sorted(services.keys())
+    by_node = {}
+    for name in names:
+        if name not in services:
+            raise Exception("Couldn't find record of service '%s'" % (name))
+        if 'logfile' not in services[name]:
+            print "Service %s has no recorded log file, skipping it" % (name)
+            continue
+        by_node.setdefault(services[name]['node'], {})[services[name]['logfile']] = name
+    return by_node
+
+def options(kwargs):
+    '''Get (lines, pattern, lag) from --lines, --filter and --lag.'''
+    return (int(config.kwarg_or_default('lines', kwargs, default=10)),
+            config.kwarg_or_default('filter', kwargs, default=None),
+            float(config.kwarg_or_default('lag', kwargs, default=1.0)))
+
+
+class Stream(object):
+    '''One node's log channel. cmd is the command line that runs a
+    shell command on the node, e.g. an ssh command line, to which the
+    remote command is appended. logfiles maps each log file path to
+    the service that writes it.'''
+
+    _Closed = object()
+
+    def __init__(self, node, cmd, logfiles, lines=10, pattern=None, buffer=1000):
+        self.node = node
+        self.logfiles = logfiles
+        self.cmd = list(cmd) + [remote_command(sorted(logfiles.keys()), lines=lines, pattern=pattern)]
+        self.queue = Queue.Queue(maxsize=buffer)
+        self.proc = None
+        self.closed = False
+        self.head = None
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        for line in iter(self.proc.stdout.readline, ''):
+            parts = line.rstrip('\n').split('\t', 2)
+            if len(parts) != 3: continue
+            try:
+                ts = float(parts[0])
+            except ValueError:
+                continue
+            # Blocks when the buffer is full
+            self.queue.put( (ts, self.node, self.logfiles.get(parts[1], parts[1]), parts[2]) )
+        self.proc.wait()
+        self.queue.put(self._Closed)
+
+    def fill(self):
+        '''Make sure the next line is in self.head if one is available
+        without blocking. Returns False once the stream has ended.'''
+        if self.head is not None or self.closed: return not self.closed
+        try:
+            item = self.queue.get_nowait()
+        except Queue.Empty:
+            return True
+        if item is self._Closed:
+            self.closed = True
+            return False
+        self.head = item
+        return True
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
+def format_line(item):
+    ts, node, service, text = item
+    return '%s.%03d %s %s: %s' % (time.strftime('%H:%M:%S', time.localtime(ts)), int((ts % 1) * 1000), node, service, text)
+
+def merge(streams, lag=1.0, out=None, poll=0.05):
+    '''Print lines from all streams ordered by timestamp until all
+    streams end (or Ctrl-C). Returns the number of lines printed.'''
+    if out is None: out = sys.stdout
+    printed = 0
+    live = list(streams)
+    while live:
+        live = [s for s in live if s.fill() or s.head is not None]
+        if not live: break
+        waiting = [s for s in live if s.head is None]
+        pending = [ (s.head[0], idx) for idx, s in enumerate(live) if s.head is not None ]
+        if not pending:
+            time.sleep(poll)
+            continue
+        ts, idx = min(pending)
+        # A stream with nothing buffered might still produce an earlier
+        # line, unless this one is already older than the allowed lag
+        if waiting and ts > time.time() - lag:
+            time.sleep(poll)
+            continue
+        stream = live[idx]
+        out.write(format_line(stream.head) + '\n')
+        out.flush()
+        stream.head = None
+        printed += 1
+    return printed
+
+def follow(streams, lag=1.0):
+    '''Start all streams and print their merged output until they all
+    end or the user interrupts.'''
+    if not streams:
+        print "No service log files to follow."
+        return 1
+    with trace.span('logs follow'):
+        for stream in streams: stream.start()
+        try:
+            merge(streams, lag=lag)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for stream in streams: stream.stop()
+    return 0
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Measuring the network between nodes. network probe measures the
+# round trip time and TCP throughput between every pair of nodes and
+# saves the matrix in state['network'], so services that talk to each
+# other a lot can be placed on nodes that are close together:
+#
+#   near:SERVICE[,SERVICE...]   the node with the lowest total RTT to
+#                               the nodes running these services
+#
+# Pairs are measured in rounds in which each node is in at most one
+# pair, so concurrent measurements don't share a node's link and skew
+# each other. Both ends use Python over TCP (no ping or iperf needed,
+# and ICMP is often blocked): one node listens on a port the other
+# nodes can reach, the other times a series of one byte round trips
+# and then a bulk transfer.
+
+import results
+import parallel
+import trace
+import pipes, time
+
+DefaultCount = 10
+DefaultBytes = 16 * 1024 * 1024
+DefaultTimeout = 30
+
+_python = 'PY=$(command -v python3 || command -v python)\n'
+
+# Echoes count single bytes, then reads until the sender is done and
+# acknowledges. Arguments: port, count, timeout.
+_listener = '''import socket, sys
+s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.settimeout(float(sys.argv[3]))
+s.bind(("", int(sys.argv[1])))
+s.listen(1)
+c, addr = s.accept()
+c.settimeout(float(sys.argv[3]))
+c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+for i in range(int(sys.argv[2])): c.sendall(c.recv(1))
+while c.recv(1048576): pass
+c.sendall(b"x")
+c.close()
+'''
+
+# Arguments: address, port, count, bytes, timeout. Prints rtt_ms (the
+# median) and bandwidth_mbps.
+_sender = '''import socket, sys, time
+address, port, count, size, timeout = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), float(sys.argv[5])
+deadline = time.time() + timeout
+while True:
+    try:
+        s = socket.create_connection((address, port), timeout)
+        break
+    except socket.error:
+        # The listener may not be up yet
+        if time.time() > deadline: raise
+        time.sleep(0.1)
+s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+rtts = []
+for i in range(count):
+    start = time.time()
+    s.sendall(b"p")
+    s.recv(1)
+    rtts.append(time.time() - start)
+rtts.sort()
+print("rtt_ms=%.3f" % (rtts[len(rtts) // 2] * 1000))
+buf = b"\\0" * 65536
+sent = 0
+start = time.time()
+while sent < size:
+    s.sendall(buf)
+    sent += len(buf)
+s.shutdown(socket.SHUT_WR)
+s.recv(1)
+print("bandwidth_mbps=%.1f" % (sent * 8 / 1e6 / (time.time() - start)))
+'''
+
+def listen_script(port, count=DefaultCount, timeout=DefaultTimeout):
+    '''Start a listener in the background, returning immediately.'''
+    return _python + 'nohup $PY -c %s %d %d %d >/dev/null 2>&1 &\n' % (pipes.quote(_listener), port, count, timeout)
+
+def send_script(address, port, count=DefaultCount, nbytes=DefaultBytes, timeout=DefaultTimeout):
+    return _python + '$PY -c %s %s %d %d %d %d\n' % (pipes.quote(_sender), pipes.quote(address), port, count, nbytes, timeout)
+
+def parse(output):
+    '''Parse send_script output into { 'rtt_ms', 'bandwidth_mbps' }.'''
+    measured = {}
+    for line in output.splitlines():
+        if line.find('=') == -1: continue
+        key, value = line.strip().split('=', 1)
+        if key in ['rtt_ms', 'bandwidth_mbps']:
+            measured[key] = float(value)
+    return measured
+
+
+def rounds(node_ids):
+    '''Split all pairs of nodes into rounds in which each node appears
+    at most once (a round-robin tournament schedule).'''
+    ids = list(node_ids)
+    if len(ids) % 2: ids.append(None)
+    schedule = []
+    for idx in range(len(ids) - 1):
+        pairs = [(ids[i], ids[len(ids) - 1 - i]) for i in range(len(ids) // 2)]
+        schedule.append([(a, b) for a, b in pairs if a is not None and b is not None])
+        # Keep the first node fixed and rotate the rest
+        ids = [ids[0], ids[-1]] + ids[1:-1]
+    return schedule
+
+def probe(op, node_ids, run, address, port, count=DefaultCount, nbytes=DefaultBytes, timeout=DefaultTimeout):
+    '''Measure every pair of node_ids. run(node_id, script) runs a
+    script on a node and returns (retcode, output), address(node_id)
+    is the address other nodes reach it at and port(node_id) a port
+    they can connect to on it. Returns a Result whose data is the
+    matrix to save in state['network'].'''
+    result = results.Result(op)
+    matrix = { 'measured' : time.time(), 'rtt_ms' : {}, 'bandwidth_mbps' : {} }
+
+    def probe_pair(pair):
+        a, b = pair
+        start = time.time()
+        with trace.span('network probe', node=a, cmd=b):
+            retcode, out = run(b, listen_script(port(b), count=count, timeout=timeout))
+            if retcode == 0:
+                retcode, out = run(a, send_script(address(b), port(b), count=count, nbytes=nbytes, timeout=timeout))
+        measured = parse(out or '')
+        if retcode != 0 or len(measured) != 2:
+            print "Couldn't measure %s <-> %s" % (a, b)
+            result.add_node(a, retcode or 1, duration=time.time()-start, error="couldn't measure link to %s" % (b), data={ 'peer' : b })
+            return
+        for key in ['rtt_ms', 'bandwidth_mbps']:
+            # Links are treated as symmetric
+            matrix[key].setdefault(a, {})[b] = measured[key]
+            matrix[key].setdefault(b, {})[a] = measured[key]
+        data = dict(measured)
+        data['peer'] = b
+        result.add_node(a, 0, duration=time.time()-start, data=data)
+
+    for pairs in rounds(node_ids):
+        parallel.run(probe_pair, pairs)
+
+    result.data = matrix
+    return result.finish()
+
+
+def rtt(matrix, a, b):
+    '''The RTT between two nodes, 0 for a node to itself and None if
+    it wasn't measured.'''
+    if a == b: return 0.0
+    return matrix.get('rtt_ms', {}).get(a, {}).get(b)
+
+def nearest(matrix, anchors, candidates, load=None):
+    '''Choose the candidate with the lowest total RTT to the anchor
+    nodes, breaking ties by load (a function giving a node's number of
+    services). The anchors themselves are only chosen if there is no
+    other measured candidate.'''
+    if load is None: load = lambda node_id: 0
+    def cost(node_id):
+        rtts = [rtt(matrix, node_id, anchor) for anchor in anchors]
+        if None in rtts: return None
+        return sum(rtts)
+    costs = dict([(node_id, cost(node_id)) for node_id in candidates])
+    others = [node_id for node_id in candidates if node_id not in anchors and costs[node_id] is not None]
+    choices = others or [node_id for node_id in candidates if costs[node_id] is not None]
+    if not choices: raise Exception("No network measurements for the candidate nodes, run network probe first")
+    return min(choices, key=lambda node_id: (costs[node_id], load(node_id), node_id))
+
+def is_near(target):
+    return isinstance(target, basestring) and target.startswith('near:')
+
+def place(state, target, candidates):
+    '''Resolve a near:SERVICE[,SERVICE...] target to a node id using
+    the saved matrix and the service records in state.'''
+    if 'network' not in state:
+        raise Exception("No network measurements for this cluster, run network probe first")
+    services = state.get('services', {})
+    anchors = []
+    for name in target[len('near:'):].split(','):
+        if not name: continue
+        if name not in services: raise Exception("Couldn't find service '%s' to place near" % (name))
+        anchors.append(services[name]['node'])
+    if not anchors: raise Exception("near: needs at least one service name")
+    load = lambda node_id: len([s for s in services.values() if s['node'] == node_id])
+    return nearest(state['network'], anchors, candidates, load=load)
+
+
+def format_table(matrix, key='rtt_ms'):
+    '''Format one of the matrices as a table for text output.'''
+    values = matrix.get(key, {})
+    node_ids = sorted(set(values.keys()))
+    lines = ['%-20s ' % (key) + ' '.join(['%12s' % (node_id[:12]) for node_id in node_ids])]
+    for a in node_ids:
+        cells = []
+        for b in node_ids:
+            value = values.get(a, {}).get(b)
+            cells.append('%12s' % ('-' if a == b or value is None else ('%.2f' % value)))
+        lines.append('%-20s ' % (a[:20]) + ' '.join(cells))
+    return '\n'.join(lines)
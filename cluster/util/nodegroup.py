@@ -1,4 +1,5 @@
-import os, json
+import os, json, threading
+import trace
 
 class NodeGroupConfig(object):
     '''
@@ -13,20 +14,34 @@ class NodeGroupConfig(object):
     config and should be set as attributes on the class during
     loading/initialization for convenience'''
 
+    OptionalAttributes = {}
+    '''Like Attributes, but with defaults used when they aren't passed
+    in or are missing from a saved config, e.g. because they were added
+    after it was created'''
+
     def __init__(self, name, **kwargs):
         '''Specify either a name only, which loads from a file, or *all* the parameters'''
+        # Per-node operations may run on worker threads. They hold lock
+        # while changing state and saving it, so save never sees state
+        # that's being changed.
+        self.lock = threading.RLock()
         if not kwargs: # if one other value isn't defined, must have file
-            values = json.load(open(self._filename(name), 'r'))
+            with trace.span('config load', cmd=self._filename(name)):
+                values = json.load(open(self._filename(name), 'r'))
             self.name = name
             for attrname in self.Attributes:
                 if attrname == 'name': continue
                 setattr(self, attrname, values[attrname])
+            for attrname, default in self.OptionalAttributes.items():
+                setattr(self, attrname, values.get(attrname, default))
         else:
             self.name = name
             for attrname in self.Attributes:
                 assert((attrname == 'name' or attrname == 'state') or attrname in kwargs)
                 if (attrname == 'name' or attrname == 'state'): continue
                 setattr(self, attrname, kwargs[attrname])
+            for attrname, default in self.OptionalAttributes.items():
+                setattr(self, attrname, kwargs.get(attrname, default))
             # Everything else is temporary/mutable state that we just
             # want to keep track of for future operations
             self.state = {}
@@ -35,8 +50,12 @@ class NodeGroupConfig(object):
         return '.cluster-config-' + (newname or self.name) + '.json'
 
     def save(self):
-        data = dict([(name, getattr(self, name)) for name in self.Attributes])
-        json.dump(data, open(self._filename(), 'w'), indent=4)
+        # Other threads may be changing state, see lock
+        with self.lock:
+            data = dict([(name, getattr(self, name)) for name in self.Attributes + self.OptionalAttributes.keys()])
+            with trace.span('config save', cmd=self._filename()):
+                with open(self._filename(), 'w') as fp:
+                    json.dump(data, fp, indent=4)
 
     def delete(self):
         os.remove(self._filename())
@@ -79,6 +98,10 @@ class NodeGroup(object):
     '''
     Base class for groups of nodes considered a cluster. Defines the
     base functionality for clusters.
+
+    Operations return a cluster.util.results.Result, which is true if
+    the operation succeeded and carries per-node outcomes, timings,
+    bytes transferred and errors.
     '''
 
     ConfigClass = NodeGroupConfig
@@ -139,23 +162,58 @@ class NodeGroup(object):
 
     def sync_files(self, target, src, dest, **kwargs):
         '''Sync regular files or directories with a node on the
-        cluster. Parameters are specifications of files to sync,
-        e.g. 'remote:/path/to/file' and 'local:/path/to/dir'.'''
+        cluster, or with all nodes if target is 'all'. Parameters are
+        specifications of files to sync, e.g. 'remote:/path/to/file'
+        and 'local:/path/to/dir'.'''
         raise Exception("NodeGroup.sync_files isn't properly defined")
 
+    def gather(self, remote_path, local_dir, **kwargs):
+        '''Pull remote_path from every node into local_dir/<node id>/.'''
+        raise Exception("NodeGroup.gather isn't properly defined")
+
+    def log_streams(self, service_names=None, lines=10, pattern=None, **kwargs):
+        '''Get cluster.util.logs.Stream objects for following the logs
+        of the given services (default: all services with log files).'''
+        raise Exception("NodeGroup.log_streams isn't properly defined")
+
     def add_service(self, name, target, command, user, cwd, **kwargs):
         '''Add a service, running the given command, to this node group.'''
 
         raise Exception("NodeGroup.add_service isn't properly defined")
 
-    def service_status(self, name, **kwargs):
-        '''Remove a service from this node group.'''
-        raise Exception("NodeGroup.service_stats isn't properly defined")
+    def start_services(self, specs, parallelism=None, timeout=300, **kwargs):
+        '''Start several services in dependency order. specs is a list
+        of dicts with a name, target, command, depends_on (a list of
+        service names) and a readiness probe; see cluster.util.dag.'''
+        raise Exception("NodeGroup.start_services isn't properly defined")
+
+    def probe(self, checks, **kwargs):
+        '''Evaluate readiness probes, a list of (service name, probe),
+        returning { service name : passed }. See cluster.util.probes.'''
+        raise Exception("NodeGroup.probe isn't properly defined")
+
+    def service_status(self, *names, **kwargs):
+        '''Check that services in this node group are alive and pass
+        their probes. names can also be just 'all'.'''
+        raise Exception("NodeGroup.service_status isn't properly defined")
+
+    def restart_service(self, name, version=None, **kwargs):
+        '''Stop a service and start it again the way it was added,
+        optionally from another Sirikata install (version). Returns
+        True on success. See cluster.util.rolling.'''
+        raise Exception("NodeGroup.restart_service isn't properly defined")
 
     def remove_service(self, name, **kwargs):
         '''Remove a service from this node group.'''
         raise Exception("NodeGroup.remove_service isn't properly defined")
 
+    def facts(self, node=None, ttl=None, **kwargs):
+        '''Get facts about a node (cores, memory, free disk, kernel and
+        Sirikata version), or { node id : facts } for all nodes if node
+        is None. Cached facts are used unless they are older than ttl
+        seconds. See cluster.util.facts.'''
+        raise Exception("NodeGroup.facts isn't properly defined")
+
     def terminate(self, **kwargs):
         '''If necessary, terminate the nodes in this node group.'''
         raise Exception("NodeGroup.boot isn't properly defined")
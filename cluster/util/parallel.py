@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Simple thread-based fan-out for running per-node operations
+# concurrently. Most of the work is waiting on ssh/rsync subprocesses,
+# so threads are plenty.
+
+import trace
+import threading, Queue, sys
+
+def run(fn, items, parallelism=None, callback=None):
+    '''Call fn(item) for each item using up to parallelism threads
+    (default: one per item) and return the results in the same order
+    as items. If callback is given it is invoked as callback(item,
+    result) as soon as each item finishes, from the worker thread, so
+    results can be streamed before everything completes. If any call
+    raises, the first exception is re-raised after all workers have
+    finished.'''
+
+    items = list(items)
+    if not items: return []
+    if parallelism is None or parallelism <= 0: parallelism = len(items)
+    parallelism = min(parallelism, len(items))
+
+    results = [None] * len(items)
+    errors = []
+    parent = trace.current()
+    work = Queue.Queue()
+    for idx, item in enumerate(items):
+        work.put( (idx, item) )
+
+    def worker():
+        while True:
+            try:
+                idx, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                with trace.attach(parent):
+                    results[idx] = fn(item)
+                if callback is not None: callback(item, results[idx])
+            except:
+                errors.append(sys.exc_info())
+
+    if parallelism == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for x in range(parallelism)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # Join with a timeout so Ctrl-C still reaches the main thread
+            while t.is_alive(): t.join(0.1)
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Per-node port allocation for services, so many services can share a
+# node without hard-coding ports. add service replaces these
+# placeholders in the command's arguments (and --probe):
+#
+#   PORT        a free port; each appearance gets a different port
+#   PORT:name   a free port, the same one for every appearance of
+#               PORT:name, e.g. to use it in both --listen and --probe
+#   PRIVATE_IP  the node's private IP address
+#   NODE_INDEX  the node's index in the cluster
+#
+# Ports come from the range the security group opens for Sirikata (or
+# a local node's own range) and skip ports used by other services on
+# the node or that something on the node is already listening on.
+# They're saved in the service's record in state['services'], so
+# removing the service frees them. add service's --ports=name=PORT,...
+# pins named ports instead, e.g. to restart a service on the same
+# ports.
+
+import re, threading
+
+# The ports opened to Sirikata by the security group
+PortRange = (6000, 10000)
+
+_placeholder = re.compile(r'\bPORT(?::(\w+))?\b')
+
+def _names(args):
+    '''Name each PORT placeholder in each of args: PORT:name is name
+    and each bare PORT gets a new name, port0, port1, ...'''
+    result, unnamed = [], 0
+    for arg in args:
+        names = []
+        for match in _placeholder.finditer(arg):
+            if match.group(1):
+                names.append(match.group(1))
+            else:
+                names.append('port%d' % (unnamed))
+                unnamed += 1
+        result.append(names)
+    return result
+
+def requested(args):
+    '''The names of the ports args ask for, in order of first appearance.'''
+    names = []
+    for arg_names in _names(args):
+        names += [name for name in arg_names if name not in names]
+    return names
+
+def substitute(args, ports, private_ip, node_index):
+    '''Replace the placeholders in args given the allocated ports, {
+    name : port }.'''
+    result = []
+    for arg, names in zip(args, _names(args)):
+        it = iter(names)
+        arg = _placeholder.sub(lambda match: str(ports[it.next()]), arg)
+        result.append(arg.replace('PRIVATE_IP', private_ip).replace('NODE_INDEX', str(node_index)))
+    return result
+
+
+# Prints the kernel's TCP and UDP socket tables
+ListeningScript = 'cat /proc/net/tcp /proc/net/tcp6 /proc/net/udp /proc/net/udp6 2>/dev/null\n'
+
+def parse_listening(output):
+    '''Get the ports bound on a node from ListeningScript output: TCP
+    sockets in the LISTEN state and all UDP sockets.'''
+    ports = set()
+    kind = None
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 4: continue
+        if fields[0] == 'sl':
+            # Header line; UDP tables are the only ones with ref counts
+            kind = 'udp' if 'ref' in fields else 'tcp'
+            continue
+        if fields[1].find(':') == -1: continue
+        if kind == 'tcp' and fields[3] != '0A': continue
+        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+    return ports
+
+def parse_fixed(value):
+    '''Parse --ports=name=PORT,... into { name : port }.'''
+    if not value: return {}
+    fixed = {}
+    for part in str(value).split(','):
+        if not part: continue
+        if part.find('=') == -1: raise Exception("Ports should be given as name=PORT, got '%s'" % (part))
+        name, port = part.split('=', 1)
+        fixed[name] = int(port)
+    return fixed
+
+def format_fixed(ports):
+    return ','.join(['%s=%d' % (name, port) for name, port in sorted(ports.items())])
+
+def used_ports(services, node):
+    '''The ports allocated to services on a node.'''
+    used = set()
+    for service in services.values():
+        if service['node'] == node: used.update(service.get('ports', {}).values())
+    return used
+
+def allocate(port_range, used, names):
+    '''Choose a free port for each of names, lowest first.'''
+    first, last = port_range
+    ports = {}
+    port = first
+    for name in names:
+        while port <= last and port in used: port += 1
+        if port > last:
+            raise Exception("Only %d free ports in %d-%d, %d requested" % (len(ports), first, last, len(names)))
+        ports[name] = port
+        port += 1
+    return ports
+
+
+# As for cores in resources.py, ports handed out to services that are
+# still starting aren't in the service records yet, so they're tracked
+# here to keep concurrent add service calls from sharing them.
+_lock = threading.Lock()
+_pending = {}
+
+def reserve(key, services, node, port_range, names, listening=(), fixed=None):
+    '''Allocate ports for names on node, avoiding the ports in
+    listening. Names in fixed get the port given there. They count as
+    used until release() is called. key identifies the cluster and
+    node, e.g. (cluster name, node id).'''
+    fixed = dict([(name, port) for name, port in (fixed or {}).items() if name in names])
+    with _lock:
+        used = used_ports(services, node)
+        used.update(listening)
+        used.update(fixed.values())
+        for ports in _pending.get(key, []): used.update(ports.values())
+        ports = allocate(port_range, used, [name for name in names if name not in fixed])
+        ports.update(fixed)
+        _pending.setdefault(key, []).append(ports)
+    return ports
+
+def release(key, ports):
+    if not ports: return
+    with _lock:
+        if ports in _pending.get(key, []): _pending[key].remove(ports)
+
+def probe_port(key, services, node, port_range, listening):
+    '''A port on node for a short-lived listener, e.g. network probe's:
+    the highest one in port_range that isn't allocated to a service,
+    reserved for one that's starting or in listening. allocate() hands
+    out the lowest first, so the two rarely meet.'''
+    with _lock:
+        used = used_ports(services, node)
+        used.update(listening)
+        for ports in _pending.get(key, []): used.update(ports.values())
+    first, last = port_range
+    for port in range(last, first - 1, -1):
+        if port not in used: return port
+    raise Exception("No free ports in %d-%d" % (first, last))
+
+def assign(key, services, node, port_range, args, listening, private_ip, node_index, fixed=None):
+    '''Allocate the ports args ask for, other than those in fixed, and
+    substitute all the placeholders. listening() should return the
+    ports in use on the node and is only called if ports need to be
+    allocated. Returns (args, { name : port }); the ports stay reserved
+    until release().'''
+    names = requested(args)
+    ports = {}
+    if names:
+        needed = [name for name in names if name not in (fixed or {})]
+        ports = reserve(key, services, node, port_range, names, listening() if needed else (), fixed=fixed)
+    return substitute(args, ports, private_ip, node_index), ports
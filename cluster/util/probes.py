@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Readiness probes for services. A probe is given as a short string,
+# e.g. in a services file or on the command line:
+#
+#   tcp:PORT or tcp:HOST:PORT   something accepts connections on the port
+#   pidfile                     the process in the service's PID file is alive
+#   log:REGEX                   the process is alive and its log has a
+#                               line matching REGEX (an extended regex)
+#   http:[HOST:]PORT[/PATH]     a GET request succeeds (2xx or 3xx)
+#   cmd:COMMAND                 a shell command exits with status 0
+#
+# Probes given to add service are saved with the service record and
+# also used by service status, in addition to checking the process is
+# alive, so a server that is running but wedged or hasn't bound its
+# port yet doesn't count as healthy.
+#
+# Probes are evaluated on the nodes: all the checks for one node are
+# combined into a single shell script so checking many services costs
+# one round trip per node.
+
+import parallel
+import pipes, time
+
+def parse(spec):
+    '''Parse a probe specification into a dict, or return None if spec
+    is empty. Dicts (already parsed probes) are returned unchanged.'''
+    if not spec: return None
+    if isinstance(spec, dict): return spec
+    kind, sep, arg = spec.partition(':')
+    if kind == 'tcp':
+        if arg.find(':') != -1:
+            host, port = arg.rsplit(':', 1)
+        else:
+            host, port = ('127.0.0.1', arg)
+        return { 'type' : 'tcp', 'host' : host, 'port' : int(port) }
+    elif kind == 'pidfile':
+        return { 'type' : 'pidfile' }
+    elif kind == 'log':
+        if not arg: raise Exception("log probes need a pattern, e.g. log:Listening")
+        return { 'type' : 'log', 'pattern' : arg }
+    elif kind == 'http':
+        hostport, slash, path = arg.partition('/')
+        if hostport.find(':') != -1:
+            host, port = hostport.rsplit(':', 1)
+        else:
+            host, port = ('127.0.0.1', hostport)
+        return { 'type' : 'http', 'host' : host, 'port' : int(port), 'path' : '/' + path }
+    elif kind == 'cmd':
+        if not arg: raise Exception("cmd probes need a command, e.g. cmd:/usr/bin/redis-cli ping")
+        return { 'type' : 'cmd', 'command' : arg }
+    raise Exception("Unknown probe '%s'" % (spec))
+
+def describe(probe):
+    if probe['type'] == 'tcp': return 'tcp:%s:%d' % (probe['host'], probe['port'])
+    if probe['type'] == 'log': return 'log:' + probe['pattern']
+    if probe['type'] == 'http': return 'http:%s:%d%s' % (probe['host'], probe['port'], probe['path'])
+    if probe['type'] == 'cmd': return 'cmd:' + probe['command']
+    if probe['type'] == 'all': return '+'.join([describe(p) for p in probe['probes']])
+    return probe['type']
+
+def liveness(service):
+    '''The probe used to check a running service: its process is alive
+    and its own probe, if it has one, passes.'''
+    if service.get('probe') is None: return { 'type' : 'pidfile' }
+    return { 'type' : 'all', 'probes' : [ { 'type' : 'pidfile' }, parse(service['probe']) ] }
+
+def _pid_alive(service):
+    if 'pidfile' not in service: return 'false'
+    pidfile = pipes.quote(service['pidfile'])
+    return '[ -f %s ] && [ -d /proc/$(grep -o "[0-9]*" %s | head -n 1) ]' % (pidfile, pidfile)
+
+def condition(probe, service):
+    '''A shell condition that succeeds if probe passes for a service,
+    given the service's record.'''
+    if probe['type'] == 'tcp':
+        return 'timeout 2 bash -c %s 2>/dev/null' % (pipes.quote('exec 3<>/dev/tcp/%s/%d' % (probe['host'], probe['port'])))
+    elif probe['type'] == 'pidfile':
+        return _pid_alive(service)
+    elif probe['type'] == 'log':
+        if 'logfile' not in service: return 'false'
+        return '%s && grep -qsE -- %s %s' % (_pid_alive(service), pipes.quote(probe['pattern']), pipes.quote(service['logfile']))
+    elif probe['type'] == 'http':
+        url = 'http://%s:%d%s' % (probe['host'], probe['port'], probe['path'])
+        return 'curl -sf -o /dev/null --max-time 2 %s' % (pipes.quote(url))
+    elif probe['type'] == 'cmd':
+        return '( timeout 10 /bin/sh -c %s ) >/dev/null 2>&1' % (pipes.quote(probe['command']))
+    elif probe['type'] == 'all':
+        return ' && '.join(['{ %s; }' % (condition(p, service)) for p in probe['probes']])
+    raise Exception("Unknown probe type '%s'" % (probe['type']))
+
+def check_script(checks):
+    '''Generate a script checking several (key, probe, service record)
+    entries on one node. It prints '@@probe N 1' or '@@probe N 0' for
+    the Nth entry; keys (service names) are left out of the script so
+    they never need quoting.'''
+    lines = []
+    for idx, (key, probe, service) in enumerate(checks):
+        lines.append('if %s; then echo "@@probe %d 1"; else echo "@@probe %d 0"; fi' % (condition(probe, service), idx, idx))
+    return '\n'.join(lines) + '\n'
+
+def parse_output(output, keys):
+    '''Parse check_script output into { key : passed }, where keys are
+    the keys of the checks the script was generated from, in order.'''
+    passed = {}
+    for line in output.splitlines():
+        if not line.startswith('@@probe '): continue
+        parts = line.split()
+        if len(parts) != 3 or not parts[1].isdigit() or int(parts[1]) >= len(keys): continue
+        passed[keys[int(parts[1])]] = (parts[2] == '1')
+    return passed
+
+def wait(check, timeout, poll=0.5):
+    '''Call check() until it returns True or timeout seconds pass.
+    Returns the time taken, or None on timeout.'''
+    start = time.time()
+    while True:
+        if check(): return time.time() - start
+        if time.time() - start > timeout: return None
+        time.sleep(poll)
+
+def run(services, checks, run_script):
+    '''Evaluate checks, a list of (service name, probe), for services
+    recorded in services (a cluster's state['services']). A probe of
+    None checks the service's liveness (see liveness()). Checks are
+    grouped by node and run_script(node, script) is called once per
+    node, concurrently, and should return the script's output. Returns
+    { service name : passed }.'''
+    by_node = {}
+    for name, probe in checks:
+        service = services[name]
+        probe = parse(probe) if probe is not None else liveness(service)
+        by_node.setdefault(service['node'], []).append( (name, probe, service) )
+
+    passed = dict([(name, False) for name, probe in checks])
+    def check_node(node):
+        output = run_script(node, check_script(by_node[node]))
+        passed.update(parse_output(output or '', [key for key, probe, service in by_node[node]]))
+    parallel.run(check_node, sorted(by_node.keys()))
+    return passed
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# Per-service resource limits. add service accepts
+#
+#   --cpus=N              N cores, allocated so they don't overlap with
+#                         other services' cores on the node and, if
+#                         possible, all from one NUMA node
+#   --cpuset=0-3,8        an explicit set of cores
+#   --memory=2G           a memory limit, enforced with a cgroup
+#   --nice=N              CPU scheduling priority (nice level)
+#   --ionice=CLASS[:N]    IO scheduling class (realtime, best-effort or
+#                         idle) and priority, as for ionice
+#
+# Limits are applied on the node by the shell that launches
+# start-stop-daemon: it joins the service's cgroup and execs
+# start-stop-daemon under taskset, numactl, ionice and nice, so the
+# daemonized service inherits all of them. The cores and cgroup are
+# saved in the service's record in state['services'].
+
+import pipes, re, threading
+
+IONiceClasses = { 'realtime' : 1, 'best-effort' : 2, 'idle' : 3 }
+
+_memory_units = { '' : 1, 'k' : 1024, 'm' : 1024**2, 'g' : 1024**3 }
+
+def parse_memory(value):
+    '''Parse a memory size like 512M or 2G into bytes.'''
+    match = re.match(r'^(\d+)([kmg]?)b?$', str(value).strip().lower())
+    if not match: raise Exception("Couldn't parse memory size '%s'" % (value))
+    return int(match.group(1)) * _memory_units[match.group(2)]
+
+def parse_cpuset(value):
+    '''Parse a cpuset like 0-3,8 into a sorted list of core numbers.'''
+    cpus = set()
+    for part in str(value).split(','):
+        part = part.strip()
+        if not part: continue
+        if part.find('-') != -1:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+def format_cpuset(cpus):
+    '''Format core numbers compactly, e.g. [0,1,2,3,8] -> 0-3,8.'''
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join([('%d' % first) if first == last else ('%d-%d' % (first, last)) for first, last in ranges])
+
+def parse(kwargs):
+    '''Get the resource spec requested in add service's kwargs, or
+    None if there isn't one.'''
+    spec = {}
+    if 'cpus' in kwargs and 'cpuset' in kwargs:
+        raise Exception("Specify either --cpus or --cpuset, not both")
+    if 'cpus' in kwargs: spec['cores'] = int(kwargs['cpus'])
+    if 'cpuset' in kwargs: spec['cpuset'] = format_cpuset(parse_cpuset(kwargs['cpuset']))
+    if 'memory' in kwargs: spec['memory'] = parse_memory(kwargs['memory'])
+    if 'nice' in kwargs: spec['nice'] = int(kwargs['nice'])
+    if 'ionice' in kwargs:
+        ioclass, sep, level = str(kwargs['ionice']).partition(':')
+        if ioclass not in IONiceClasses:
+            raise Exception("Unknown IO scheduling class '%s', expected one of %s" % (ioclass, ', '.join(sorted(IONiceClasses.keys()))))
+        spec['ionice'] = { 'class' : ioclass }
+        if level: spec['ionice']['level'] = int(level)
+    return spec or None
+
+
+# Script printing 'cpu,numa node' for each core
+TopologyScript = '''if command -v lscpu >/dev/null 2>&1; then
+  lscpu -p=CPU,NODE | grep -v '^#'
+else
+  n=$(nproc --all); i=0; while [ $i -lt $n ]; do echo "$i,0"; i=$((i+1)); done
+fi
+'''
+
+def parse_topology(output):
+    '''Parse TopologyScript output into { cpu : numa node }.'''
+    topology = {}
+    for line in output.splitlines():
+        parts = line.strip().split(',')
+        if len(parts) < 2 or not parts[0].isdigit(): continue
+        topology[int(parts[0])] = int(parts[1]) if parts[1].isdigit() else 0
+    return topology
+
+def used_cpus(services, node):
+    '''The cores allocated to services on a node.'''
+    used = set()
+    for service in services.values():
+        if service['node'] == node and 'cpuset' in service:
+            used.update(parse_cpuset(service['cpuset']))
+    return used
+
+def allocate(topology, used, count):
+    '''Choose count free cores. If one NUMA node has enough free cores,
+    they all come from the one with the fewest free cores that fits,
+    leaving larger NUMA nodes for larger services. Otherwise cores are
+    taken from the NUMA nodes with the most free cores first.'''
+    free = {}
+    for cpu, numa in topology.items():
+        if cpu not in used: free.setdefault(numa, []).append(cpu)
+    total = sum([len(cpus) for cpus in free.values()])
+    if total < count:
+        raise Exception("Only %d free cores available, %d requested" % (total, count))
+
+    fits = [numa for numa in free if len(free[numa]) >= count]
+    if fits:
+        numa = min(fits, key=lambda n: (len(free[n]), n))
+        return sorted(free[numa])[:count]
+    chosen = []
+    for numa in sorted(free.keys(), key=lambda n: (-len(free[n]), n)):
+        chosen += sorted(free[numa])[:count - len(chosen)]
+        if len(chosen) == count: break
+    return sorted(chosen)
+
+def numa_node(topology, cpus):
+    '''The NUMA node holding all of cpus, or None if they span several.'''
+    nodes = set([topology.get(cpu, 0) for cpu in cpus])
+    if len(nodes) == 1: return nodes.pop()
+    return None
+
+
+# Allocations are computed from the service records, which are only
+# written once a service has started. Cores handed out to services
+# that are still starting are tracked here so concurrent add service
+# calls (e.g. from services up) don't get the same cores.
+_lock = threading.Lock()
+_pending = {}
+
+def reserve(key, services, node, topology, spec):
+    '''Resolve spec's cores for a service on node, returning the
+    cpuset string, or None if the spec doesn't restrict cores. The
+    cores count as used until release() is called. key identifies the
+    cluster and node, e.g. (cluster name, node id).'''
+    if 'cpuset' in spec: return spec['cpuset']
+    if 'cores' not in spec: return None
+    with _lock:
+        used = used_cpus(services, node)
+        for cpus in _pending.get(key, []): used.update(cpus)
+        cpus = allocate(topology, used, spec['cores'])
+        _pending.setdefault(key, []).append(cpus)
+    return format_cpuset(cpus)
+
+def release(key, cpuset):
+    if cpuset is None: return
+    cpus = parse_cpuset(cpuset)
+    with _lock:
+        if cpus in _pending.get(key, []): _pending[key].remove(cpus)
+
+
+def cgroup_path(service_name):
+    return 'sirikata/' + service_name
+
+def launch_script(service_name, spec, cpuset, numa, cmd):
+    '''A shell script that applies the resource limits and then execs
+    cmd (start-stop-daemon) so the service inherits them.'''
+    lines = ['set -e']
+    if 'memory' in spec:
+        cg = cgroup_path(service_name)
+        lines += [
+            'if [ -f /sys/fs/cgroup/cgroup.controllers ]; then',
+            '  echo +memory | sudo tee /sys/fs/cgroup/cgroup.subtree_control >/dev/null',
+            '  sudo mkdir -p /sys/fs/cgroup/sirikata',
+            '  echo +memory | sudo tee /sys/fs/cgroup/sirikata/cgroup.subtree_control >/dev/null',
+            '  cg=/sys/fs/cgroup/%s; limit=memory.max' % (cg),
+            'else',
+            '  cg=/sys/fs/cgroup/memory/%s; limit=memory.limit_in_bytes' % (cg),
+            'fi',
+            'sudo mkdir -p $cg',
+            'echo %d | sudo tee $cg/$limit >/dev/null' % (spec['memory']),
+            'echo $$ | sudo tee $cg/cgroup.procs >/dev/null',
+            ]
+    prefix = []
+    if cpuset is not None: prefix += ['taskset', '-c', cpuset]
+    if 'ionice' in spec:
+        prefix += ['ionice', '-c', str(IONiceClasses[spec['ionice']['class']])]
+        if 'level' in spec['ionice']: prefix += ['-n', str(spec['ionice']['level'])]
+    if 'nice' in spec: prefix += ['nice', '-n', str(spec['nice'])]
+    numactl = ''
+    if numa is not None:
+        # Prefer memory local to the cores, if numactl is available
+        lines.append('numactl=""; if command -v numactl >/dev/null 2>&1; then numactl="numactl --preferred=%d"; fi' % (numa))
+        numactl = '$numactl '
+    lines.append('exec ' + numactl + ' '.join([pipes.quote(x) for x in prefix + list(cmd)]))
+    return '\n'.join(lines) + '\n'
+
+def cleanup_script(service_name):
+    '''Remove a service's cgroup once the service has stopped.'''
+    cg = cgroup_path(service_name)
+    return 'sudo rmdir /sys/fs/cgroup/%s /sys/fs/cgroup/memory/%s 2>/dev/null; true\n' % (cg, cg)
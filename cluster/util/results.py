@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# Structured results for handlers. A Result collects per-node outcomes
+# (return code, timing, bytes transferred, errors) so callers of the
+# NodeGroup API and automation using --format=json/ndjson can see what
+# happened without scraping output.
+#
+# For compatibility with code that treats handler return values as
+# exit codes, a Result compares equal to its return code (so
+# 'retcode != 0' keeps working) and converts with int(). Its truth
+# value is success, matching the booleans NodeGroup used to return.
+
+import json, os, sys, threading, time
+
+Formats = ['text', 'json', 'ndjson']
+
+_format = 'text'
+_out = sys.stdout
+_out_lock = threading.Lock()
+
+def set_format(fmt):
+    '''Select the output format. In the structured formats, free-form
+    output (print statements and output of subprocesses like ssh) is
+    redirected to stderr so stdout only contains JSON.'''
+    global _format, _out
+    if fmt not in Formats:
+        raise Exception("Unknown output format '%s', expected one of %s" % (fmt, ', '.join(Formats)))
+    _format = fmt
+    if fmt != 'text':
+        sys.stdout.flush()
+        # Keep a private copy of the real stdout, then point fd 1 at
+        # stderr so child processes inherit the redirection too
+        _out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+def get_format():
+    return _format
+
+def emit(record):
+    '''Write a single record immediately in ndjson mode.'''
+    if _format != 'ndjson': return
+    with _out_lock:
+        _out.write(json.dumps(record) + '\n')
+        _out.flush()
+
+def report(result):
+    '''Write the final result for a command in the structured formats.'''
+    if _format == 'text': return
+    record = result.to_dict()
+    with _out_lock:
+        if _format == 'ndjson':
+            record['type'] = 'result'
+            _out.write(json.dumps(record) + '\n')
+        else:
+            _out.write(json.dumps(record, indent=4) + '\n')
+        _out.flush()
+
+
+
+class NodeResult(object):
+    '''Outcome of one operation on one node.'''
+
+    def __init__(self, node, retcode=0, duration=None, bytes=None, error=None, data=None):
+        self.node = node
+        self.retcode = retcode
+        self.duration = duration
+        self.bytes = bytes
+        self.error = error
+        self.data = data
+
+    @property
+    def ok(self):
+        return self.retcode == 0
+
+    def to_dict(self):
+        d = { 'node' : self.node, 'retcode' : int(self.retcode), 'ok' : self.ok }
+        for name in ['duration', 'bytes', 'error', 'data']:
+            if getattr(self, name) is not None: d[name] = getattr(self, name)
+        return d
+
+
+class Result(object):
+    '''Outcome of a handler, possibly spanning many nodes.'''
+
+    def __init__(self, op, retcode=None, data=None):
+        self.op = op
+        self.nodes = []
+        self.errors = []
+        self.data = data
+        self.start = time.time()
+        self.end = None
+        self._retcode = retcode
+        self._lock = threading.Lock()
+
+    def add_node(self, node, retcode=0, duration=None, bytes=None, error=None, data=None):
+        '''Record (and in ndjson mode, immediately stream) the outcome
+        for one node. Safe to call from worker threads.'''
+        if isinstance(retcode, Result): retcode = retcode.retcode
+        if retcode is None: retcode = 0
+        nr = NodeResult(node, retcode, duration=duration, bytes=bytes, error=error, data=data)
+        with self._lock:
+            self.nodes.append(nr)
+        record = nr.to_dict()
+        record['type'] = 'node'
+        record['op'] = self.op
+        emit(record)
+        return nr
+
+    def error(self, msg):
+        with self._lock:
+            self.errors.append(msg)
+
+    def finish(self, retcode=None):
+        if retcode is not None: self._retcode = int(retcode)
+        self.end = time.time()
+        return self
+
+    @property
+    def retcode(self):
+        if self._retcode is not None: return self._retcode
+        failed = [nr.retcode for nr in self.nodes if nr.retcode != 0]
+        if failed: return failed[0]
+        if self.errors: return 1
+        return 0
+
+    @property
+    def ok(self):
+        return self.retcode == 0
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    @property
+    def bytes(self):
+        return sum([nr.bytes for nr in self.nodes if nr.bytes is not None])
+
+    def failed_nodes(self):
+        return [nr.node for nr in self.nodes if not nr.ok]
+
+    def to_dict(self):
+        d = {
+            'op' : self.op,
+            'retcode' : int(self.retcode),
+            'ok' : self.ok,
+            'duration' : self.duration,
+            'nodes' : [nr.to_dict() for nr in self.nodes],
+            'errors' : list(self.errors),
+            }
+        if self.bytes: d['bytes'] = self.bytes
+        if self.data is not None: d['data'] = self.data
+        return d
+
+    # Compatibility with plain integer return codes
+    def __int__(self):
+        return int(self.retcode)
+
+    def __eq__(self, other):
+        if isinstance(other, Result): return self is other
+        return self.retcode == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return id(self)
+
+    def __nonzero__(self):
+        return self.ok
+
+    def __repr__(self):
+        return '<Result %s retcode=%d nodes=%d>' % (self.op, self.retcode, len(self.nodes))
+
+
+def wrap(op, value):
+    '''Turn whatever a handler returned (a Result, a return code or
+    None) into a finished Result.'''
+    if isinstance(value, Result):
+        if value.end is None: value.finish()
+        return value
+    if value is None: value = 0
+    return Result(op, retcode=int(value)).finish()
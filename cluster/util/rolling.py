@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Rolling restarts. Services are restarted a batch at a time: each
+# service in the batch is stopped and started again with the command
+# and options it was added with (keeping its ports and cores), and the
+# next batch only starts once the whole batch is alive and passes its
+# probes. If too many restarts fail the rest of the services are left
+# alone, still running the old binaries.
+#
+# A restart can also move services to another copy of Sirikata: with a
+# version (a directory holding an installed Sirikata), paths in a
+# service's command under the node's Sirikata path are rewritten to
+# point into that directory instead. Versions can be chosen per node,
+# e.g. to canary a new build on one node.
+
+import results
+import parallel
+import trace
+import config
+import re, threading, time
+
+# add service options that need to be given again to restart a service
+LaunchOptions = ['force-daemonize', 'log-file', 'probe', 'cpus', 'cpuset', 'memory', 'nice', 'ionice']
+
+def launch_options(kwargs):
+    '''The options from add service's kwargs to save with a service so
+    it can be restarted the same way.'''
+    return dict([(k, v) for k, v in kwargs.items() if k in LaunchOptions])
+
+def parse_versions(value):
+    '''Parse --version=[node:]PATH[,node:PATH...] into { node : path },
+    where the node None gives the version for all other nodes.'''
+    versions = {}
+    if not value: return versions
+    for part in str(value).split(','):
+        if not part: continue
+        if part.find(':') != -1:
+            node, path = part.split(':', 1)
+            versions[node] = path
+        else:
+            versions[None] = part
+    return versions
+
+def version_for(versions, node):
+    return versions.get(node, versions.get(None))
+
+def rewrite(command, old_root, new_root):
+    '''Point paths in command under old_root, either whole arguments or
+    option values (--opt=/path), into new_root instead.'''
+    old_root = old_root.rstrip('/')
+    pattern = re.compile(r'(^|=)' + re.escape(old_root) + r'(?=/|$)')
+    return [pattern.sub(lambda match: match.group(1) + new_root.rstrip('/'), arg) for arg in command]
+
+def options(kwargs):
+    '''Get (batch size, max failure rate, timeout, versions) from
+    --batch-size, --max-failure-rate, --timeout and --version.'''
+    return (int(config.kwarg_or_default('batch-size', kwargs, default=1)),
+            float(config.kwarg_or_default('max-failure-rate', kwargs, default=0.0)),
+            float(config.kwarg_or_default('timeout', kwargs, default=60)),
+            parse_versions(config.kwarg_or_default('version', kwargs, default=None)))
+
+OptionKeys = ['batch-size', 'max-failure-rate', 'timeout', 'version']
+
+
+def run(op, names, restart, probe, node_of, batch_size=1, max_failure_rate=0.0, timeout=60, poll=0.5):
+    '''Restart services a batch at a time. restart(name) stops and
+    starts one service, returning True on success, and is called
+    concurrently for the services in a batch. probe(names) checks the
+    liveness of several services in one go and returns { name : passed
+    }. node_of(name) gives the node a service runs on. Stops once the
+    fraction of failed restarts exceeds max_failure_rate.'''
+
+    result = results.Result(op)
+    batch_size = max(1, batch_size)
+    batches = [names[idx:idx+batch_size] for idx in range(0, len(names), batch_size)]
+    done, failed = 0, 0
+    print_lock = threading.Lock()
+
+    for batch_idx, batch in enumerate(batches):
+        stopped, errors = {}, {}
+        batch_start = time.time()
+
+        def restart_one(name):
+            stopped[name] = time.time()
+            try:
+                with trace.span('restart service', cmd=name):
+                    ok = restart(name)
+            except Exception as e:
+                ok, errors[name] = False, str(e)
+            if not ok:
+                errors.setdefault(name, 'failed to restart')
+                with print_lock:
+                    print "Restarting %s failed: %s" % (name, errors[name])
+
+        with trace.span('restart batch', cmd=','.join(batch)):
+            parallel.run(restart_one, batch)
+
+            # Wait for the batch to come back
+            downtime = {}
+            waiting = [name for name in batch if name not in errors]
+            while waiting:
+                with trace.span('probe', cmd=','.join(waiting)):
+                    passed = probe(waiting)
+                now = time.time()
+                for name in list(waiting):
+                    if passed.get(name):
+                        downtime[name] = now - stopped[name]
+                        waiting.remove(name)
+                    elif now - batch_start > timeout:
+                        errors[name] = 'not ready after %d seconds' % (timeout)
+                        print "%s wasn't ready after %d seconds" % (name, timeout)
+                        waiting.remove(name)
+                if waiting: time.sleep(poll)
+
+        for name in batch:
+            data = { 'service' : name, 'batch' : batch_idx }
+            if name in errors:
+                result.add_node(node_of(name), 1, error=errors[name], data=data)
+            else:
+                data['downtime'] = downtime[name]
+                result.add_node(node_of(name), 0, duration=downtime[name], data=data)
+        done += len(batch)
+        failed += len([name for name in batch if name in errors])
+        print "Batch %d/%d (%s): %d restarted, max downtime %.1fs" % (
+            batch_idx + 1, len(batches), ', '.join(batch), len(batch) - len([name for name in batch if name in errors]),
+            max(downtime.values() or [0]))
+
+        if float(failed) / done > max_failure_rate and batch_idx + 1 < len(batches):
+            remaining = [name for later in batches[batch_idx+1:] for name in later]
+            result.error("Aborted after %d of %d restarts failed, leaving %s running" % (failed, done, ', '.join(remaining)))
+            print "Aborting: %d of %d restarts failed, above the allowed %d%%. Not restarting %s." % (
+                failed, done, int(max_failure_rate * 100), ', '.join(remaining))
+            break
+
+    result.finish()
+    downtimes = [nr.data['downtime'] for nr in result.nodes if nr.retcode == 0]
+    print "Restarted %d of %d services in %.1f seconds, max downtime %.1fs" % (
+        len(downtimes), len(names), result.duration, max(downtimes or [0]))
+    result.data = { 'batches' : len(batches), 'max_downtime' : max(downtimes or [0]) }
+    return result
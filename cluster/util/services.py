@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+# Adding, checking, restarting and removing services works the same
+# way on every backend: services run under start-stop-daemon with a pid
+# file in the node's workspace, get ports and cores allocated on their
+# node and are recorded in state['services']. Only how commands reach
+# a node and a few of the node's properties differ, so each backend's
+# nodes.py supplies those with a Backend subclass and its handlers
+# call the functions here.
+
+import config
+import results
+import probes
+import dag
+import resources
+import ports
+import rolling
+import network
+import versions
+import os, time
+
+class Backend(object):
+    '''The backend specific parts of running services on cc's nodes.
+    name is the backend's name, used to name operations, and kwargs the
+    options of the command being run. Nodes are referred to by id, see
+    node_id.'''
+
+    def __init__(self, name, cc, **kwargs):
+        self.name = name
+        self.cc = cc
+        self.kwargs = kwargs
+
+    def op(self, op):
+        return '%s %s' % (self.name, op)
+
+    def node_ids(self):
+        '''The ids of all the nodes, for placing services.'''
+        raise Exception("Backend.node_ids isn't properly defined")
+
+    def node_id(self, node):
+        '''Get a node's id from any of its names, or any.'''
+        raise Exception("Backend.node_id isn't properly defined")
+
+    def node_index(self, node_id):
+        raise Exception("Backend.node_index isn't properly defined")
+
+    def private_ip(self, node_id):
+        '''The address other nodes reach the node on, for PRIVATE_IP.'''
+        raise Exception("Backend.private_ip isn't properly defined")
+
+    def workspace(self, node_id):
+        '''Where pid and log files go.'''
+        raise Exception("Backend.workspace isn't properly defined")
+
+    def default_cwd(self, node_id):
+        raise Exception("Backend.default_cwd isn't properly defined")
+
+    def default_user(self, node_id):
+        raise Exception("Backend.default_user isn't properly defined")
+
+    def service_user(self, node_id, user):
+        '''The user to run a service as, given the requested one (or
+        None). Returns None to run as the user running the command, or
+        raises an Exception if user can't be used.'''
+        if user is None: user = self.default_user(node_id)
+        return user
+
+    def port_range(self, node_id):
+        '''The ports services on the node may be allocated.'''
+        return ports.PortRange
+
+    def substitute(self, node_id, arg):
+        '''Fill in backend specific placeholders in a command argument.'''
+        return arg
+
+    def default_cpuset(self, node_id):
+        '''Cores to confine services with resource limits but no core
+        allocation to, or None for any core.'''
+        return None
+
+    def launch_data(self, node_id):
+        '''Extra data reported for a newly added service.'''
+        return {}
+
+    def sirikata_path(self, node_id):
+        raise Exception("Backend.sirikata_path isn't properly defined")
+
+    def version_store(self, node_id):
+        '''The node's version store (see cluster.util.versions), or None
+        if versions can't be installed on it.'''
+        return None
+
+    def run_script(self, node_id, script):
+        '''Run a shell script on a node and return (retcode, output).'''
+        raise Exception("Backend.run_script isn't properly defined")
+
+    def start_service(self, node_id, daemon_cmd, cwd):
+        '''Run the start-stop-daemon command for a service, returning its
+        exit code.'''
+        raise Exception("Backend.start_service isn't properly defined")
+
+    def stop_service(self, node_id, pidfile, cleanup=None):
+        '''Stop the service with the given pid file and then, if that
+        worked, run the cleanup script, if any. Returns the exit code for
+        stopping the service.'''
+        raise Exception("Backend.stop_service isn't properly defined")
+
+    def topology(self, node_id):
+        '''Get the node's cores and their NUMA nodes, as { cpu : numa node }.'''
+        raise Exception("Backend.topology isn't properly defined")
+
+
+def pidfile_path(backend, node_id, service_name):
+    return os.path.join(backend.workspace(node_id), 'sirikata_%s.pid' % (service_name))
+
+def existing(cc):
+    '''A copy of the service records, for looking through while other
+    threads may be adding services (see NodeGroupConfig.lock).'''
+    with cc.lock:
+        return dict(cc.state.get('services', {}))
+
+def probe(backend, checks):
+    '''Evaluate readiness probes for services, given as a list of
+    (service name, probe), with one script per node. Returns
+    { service name : passed }.'''
+    return probes.run(existing(backend.cc), checks, lambda node_id, script: backend.run_script(node_id, script)[1])
+
+def probe_ports(backend):
+    '''A port(node_id) function for network.probe that picks a port on
+    each node once, one that isn't given to a service and that nothing
+    listens on (see ports.probe_port).'''
+    chosen = {}
+    def port(node_id):
+        if node_id not in chosen:
+            listening = ports.parse_listening(backend.run_script(node_id, ports.ListeningScript)[1] or '')
+            chosen[node_id] = ports.probe_port((backend.cc.name, node_id), existing(backend.cc), node_id,
+                                               backend.port_range(node_id), listening)
+        return chosen[node_id]
+    return port
+
+def add(backend, service_name, target_node, service_cmd, **kwargs):
+    '''Start service_cmd on target_node (any of a node's names, any or
+    near:service,...) and record it as service_name. Returns a Result,
+    or 1 if the request is invalid.'''
+    cc = backend.cc
+
+    user = config.kwarg_or_default('user', kwargs, default=None)
+    cwd = config.kwarg_or_default('cwd', kwargs, default=None)
+    force_daemonize = bool(config.kwarg_or_default('force-daemonize', kwargs, default=False))
+    probe_spec = config.kwarg_or_default('probe', kwargs, default=None)
+    wait_ready = config.kwarg_or_default('wait-ready', kwargs, default=None)
+    limits = resources.parse(kwargs)
+    fixed_ports = ports.parse_fixed(config.kwarg_or_default('ports', kwargs, default=None))
+
+    if not len(service_cmd):
+        print "You need to specify a command for the service"
+        return 1
+
+    with cc.lock:
+        if 'services' not in cc.state: cc.state['services'] = {}
+        if service_name in cc.state['services']:
+            print "The requested service already exists."
+            return 1
+
+    if not os.path.isabs(service_cmd[0]):
+        print "The path to the service's binary isn't absolute (%s)" % service_cmd[0]
+        return 1
+
+    result = results.Result(backend.op('add service'))
+    start = time.time()
+    if network.is_near(target_node):
+        try:
+            with cc.lock:
+                target_node = network.place(cc.state, target_node, backend.node_ids())
+        except Exception as e:
+            print str(e)
+            return 1
+    node_id = backend.node_id(target_node)
+    # Can now get default values that depend on the node
+    try:
+        user = backend.service_user(node_id, user)
+    except Exception as e:
+        print str(e)
+        return 1
+    if cwd is None: cwd = backend.default_cwd(node_id)
+
+    service_binary = service_cmd[0]
+
+    pidfile = pidfile_path(backend, node_id, service_name)
+    # Record the log file, if any, so logs follow can find it
+    logfile = config.kwarg_or_default('log-file', kwargs, default=None)
+    if logfile is None and [arg for arg in service_cmd[1:] if arg.find('LOGFILE') != -1]:
+        logfile = os.path.join(backend.workspace(node_id), 'sirikata_%s.log' % (service_name))
+
+    daemon_cmd = ['start-stop-daemon', '--start',
+                  '--pidfile', pidfile]
+    if user is not None:
+        daemon_cmd += ['--user', user]
+    daemon_cmd += ['--chdir', cwd]
+    if force_daemonize:
+        daemon_cmd += ['--background', '--make-pidfile']
+
+    # Allocate ports and fill in node-specific placeholders, including
+    # in the probe so it can check an allocated port
+    node_key = (cc.name, node_id)
+    try:
+        service_args, service_ports = ports.assign(node_key, existing(cc), node_id, backend.port_range(node_id),
+                                                   list(service_cmd[1:]) + [probe_spec or ''],
+                                                   lambda: ports.parse_listening(backend.run_script(node_id, ports.ListeningScript)[1]),
+                                                   backend.private_ip(node_id), backend.node_index(node_id), fixed=fixed_ports)
+    except Exception as e:
+        print "Couldn't allocate ports: %s" % (str(e))
+        result.add_node(node_id, 1, duration=time.time()-start, error=str(e))
+        return result.finish()
+    probe_check = probes.parse(service_args.pop())
+
+    daemon_cmd += ['--exec', service_binary,
+                   '--'] + [backend.substitute(node_id, arg.replace('PIDFILE', pidfile).replace('LOGFILE', logfile or '')) for arg in service_args]
+    cpuset = None
+    if limits is not None:
+        # Apply resource limits on the node, then launch under them
+        topology = backend.topology(node_id)
+        try:
+            cpuset = resources.reserve(node_key, existing(cc), node_id, topology, limits)
+        except Exception as e:
+            ports.release(node_key, service_ports)
+            print "Couldn't allocate cores: %s" % (str(e))
+            result.add_node(node_id, 1, duration=time.time()-start, error=str(e))
+            return result.finish()
+        launch_cpuset = cpuset if cpuset is not None else backend.default_cpuset(node_id)
+        numa = resources.numa_node(topology, resources.parse_cpuset(launch_cpuset)) if launch_cpuset is not None else None
+        script = resources.launch_script(service_name, limits, launch_cpuset, numa, daemon_cmd)
+        retcode = backend.run_script(node_id, script)[0]
+    else:
+        retcode = backend.start_service(node_id, daemon_cmd, cwd)
+    if retcode != 0:
+        resources.release(node_key, cpuset)
+        ports.release(node_key, service_ports)
+        print "Failed to add cluster service"
+        result.add_node(node_id, retcode, duration=time.time()-start, error='failed to start service')
+        return result.finish()
+
+    # Save a record of this service so we can find it again when we need to stop it.
+    record = {
+        'node' : node_id,
+        'binary' : service_binary,
+        'pidfile' : pidfile,
+        }
+    if logfile is not None: record['logfile'] = logfile
+    if probe_check is not None: record['probe'] = probe_check
+    if limits is not None:
+        record['resources'] = limits
+        if cpuset is not None: record['cpuset'] = cpuset
+    if service_ports: record['ports'] = service_ports
+    # Enough to start the service again, e.g. for a rolling restart
+    record['command'] = list(service_cmd)
+    record['cwd'] = cwd
+    if user is not None: record['user'] = user
+    record['options'] = rolling.launch_options(kwargs)
+    with cc.lock:
+        sirikata_version = versions.running(cc.state, node_id, service_cmd)
+        if sirikata_version is not None: record['sirikata_version'] = sirikata_version
+        cc.state['services'][service_name] = record
+        cc.save()
+    resources.release(node_key, cpuset)
+    ports.release(node_key, service_ports)
+
+    data = { 'service' : service_name, 'pidfile' : pidfile }
+    data.update(backend.launch_data(node_id))
+    if service_ports:
+        print "Allocated ports: " + ', '.join(['%s=%d' % (port_name, port) for port_name, port in sorted(service_ports.items())])
+        data['ports'] = service_ports
+    if wait_ready:
+        timeout = 60 if wait_ready is True else float(wait_ready)
+        check = probes.liveness(record)
+        latency = probes.wait(lambda: probe(backend, [ (service_name, check) ])[service_name], timeout)
+        if latency is None:
+            print "Service %s wasn't ready after %d seconds" % (service_name, timeout)
+            result.add_node(node_id, 1, duration=time.time()-start, error='not ready after %d seconds' % (timeout), data=data)
+            return result.finish()
+        with cc.lock:
+            record['startup_latency'] = latency
+            cc.save()
+        data['startup_latency'] = latency
+
+    result.add_node(node_id, retcode, duration=time.time()-start, data=data)
+    return result.finish()
+
+def remove(backend, service_name):
+    '''Stop a service and drop its record. Returns a Result, or 1 if
+    there's no such service.'''
+    cc = backend.cc
+
+    if service_name not in cc.state.get('services', {}):
+        print "Couldn't find record of service '%s'" % (service_name)
+        return 1
+
+    service = cc.state['services'][service_name]
+    node_id = service['node']
+    pidfile = service.get('pidfile') or pidfile_path(backend, node_id, service_name)
+
+    result = results.Result(backend.op('remove service'))
+    start = time.time()
+    # The cgroup can only be removed once the service is gone
+    cleanup = None
+    if 'memory' in service.get('resources', {}):
+        cleanup = resources.cleanup_script(service_name)
+    retcode = backend.stop_service(node_id, pidfile, cleanup=cleanup)
+
+    if retcode != 0:
+        print "Failed to remove service."
+        result.add_node(node_id, retcode, duration=time.time()-start, error='failed to stop service', data={ 'service' : service_name })
+        return result.finish()
+
+    # Destroy the record of the service.
+    with cc.lock:
+        del cc.state['services'][service_name]
+        cc.save()
+
+    result.add_node(node_id, retcode, duration=time.time()-start, data={ 'service' : service_name })
+    return result.finish()
+
+def selected(cc, service_name, more_names):
+    '''The service names a command was given, expanding all, or None
+    (after saying why) if one of them doesn't exist.'''
+    services = cc.state.get('services', {})
+    names = sorted(services.keys()) if service_name == 'all' else [service_name] + list(more_names)
+    for name in names:
+        if name not in services:
+            print "Couldn't find record of service '%s'" % (name)
+            return None
+    return names
+
+def status(backend, service_name, more_names):
+    '''Check that services are alive and pass their probes. Returns a
+    Result, or 1 if one of them doesn't exist.'''
+    cc = backend.cc
+    names = selected(cc, service_name, more_names)
+    if names is None: return 1
+
+    services = cc.state['services']
+    for name in names:
+        # Records from before pidfiles were saved with the service
+        if 'pidfile' not in services[name]: services[name]['pidfile'] = pidfile_path(backend, services[name]['node'], name)
+
+    result = results.Result(backend.op('service status'))
+    start = time.time()
+    passed = probe(backend, [ (name, probes.liveness(services[name])) for name in names ])
+    for name in names:
+        if len(names) > 1: print "%s: %s" % (name, passed[name] and 'ok' or 'failed')
+        result.add_node(services[name]['node'], 0 if passed[name] else 1, duration=time.time()-start, data={ 'service' : name })
+    return result.finish()
+
+def restart(backend, service_name, version=None, **kwargs):
+    '''Stop a service and start it again with the command and options
+    it was added with, on the same ports and cores. With version, the
+    command is pointed at the Sirikata installed in that directory, or
+    the installed version with that ID, instead of the node's usual one
+    (see cluster.util.rolling). Returns True on success.'''
+    cc = backend.cc
+    with cc.lock:
+        service = dict(cc.state['services'][service_name])
+    if 'command' not in service:
+        raise Exception("No command was recorded for %s, add it again to be able to restart it" % (service_name))
+    if version is None: version = service.get('version')
+    command = service['command']
+    if version is not None:
+        store = backend.version_store(service['node'])
+        if store is None and not os.path.isabs(version):
+            print "%s can't use version %s, only a path to a Sirikata install, since versions can't be installed on its nodes" % (service_name, version)
+            return False
+        version = versions.resolve(version, store)
+        command = rolling.rewrite(command, backend.sirikata_path(service['node']), version)
+
+    nkwargs = dict(kwargs)
+    nkwargs.update(service.get('options', {}))
+    if 'user' in service: nkwargs['user'] = service['user']
+    nkwargs['cwd'] = service['cwd']
+    if 'ports' in service: nkwargs['ports'] = ports.format_fixed(service['ports'])
+    if 'cpuset' in service:
+        nkwargs.pop('cpus', None)
+        nkwargs['cpuset'] = service['cpuset']
+
+    if not results.wrap(backend.op('remove service'), remove(backend, service_name)).ok: return False
+    if not results.wrap(backend.op('add service'), add(backend, service_name, service['node'], command, **nkwargs)).ok:
+        # Keep the record, and its ports and cores, so it can be retried
+        with cc.lock:
+            cc.state['services'][service_name] = service
+            cc.save()
+        return False
+    # Versions are always applied to the original command
+    with cc.lock:
+        cc.state['services'][service_name]['command'] = service['command']
+        if version is not None: cc.state['services'][service_name]['version'] = version
+        cc.save()
+    return True
+
+def rolling_restart(backend, service_name, more_names, **kwargs):
+    '''Restart services a batch at a time, see cluster.util.rolling.
+    Returns a Result, or 1 if one of the services doesn't exist.'''
+    cc = backend.cc
+    batch_size, max_failure_rate, timeout, node_versions = rolling.options(kwargs)
+    nkwargs = dict([(k, v) for k, v in kwargs.items() if k not in rolling.OptionKeys])
+
+    # Versions can be given for any name of a node
+    node_versions = dict([(node if node is None else backend.node_id(node), path) for node, path in node_versions.items()])
+    names = selected(cc, service_name, more_names)
+    if names is None: return 1
+    node_of = dict([(name, cc.state['services'][name]['node']) for name in names])
+    for name in names:
+        version = rolling.version_for(node_versions, node_of[name])
+        if version is not None and not os.path.isabs(version) and backend.version_store(node_of[name]) is None:
+            print "Versions can't be installed on %s, give --version as a path to a Sirikata install" % (node_of[name])
+            return 1
+
+    return rolling.run(backend.op('services rolling-restart'), names,
+                       lambda name: restart(backend, name, version=rolling.version_for(node_versions, node_of[name]), **nkwargs),
+                       lambda names: probe(backend, [ (name, None) for name in names ]),
+                       lambda name: node_of[name],
+                       batch_size=batch_size, max_failure_rate=max_failure_rate, timeout=timeout)
+
+def start(backend, specs, parallelism=None, timeout=300, **kwargs):
+    '''Start services described by specs (see cluster.util.dag) in
+    dependency order.'''
+    cc = backend.cc
+    def start_one(spec):
+        nkwargs = dict(kwargs)
+        nkwargs.update(dag.spec_kwargs(spec))
+        if spec['probe']: nkwargs['probe'] = spec['probe']
+        return results.wrap(backend.op('add service'), add(backend, spec['name'], spec['target'], spec['command'], **nkwargs)).ok
+    return dag.bring_up(backend.op('services up'), specs, start_one, lambda checks: probe(backend, checks),
+                        node_of=lambda name: cc.state.get('services', {}).get(name, {}).get('node'),
+                        parallelism=parallelism, timeout=timeout)
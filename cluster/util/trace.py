@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+# Lightweight tracing of cluster operations. Spans are nested
+# (per-thread) and record the node they apply to, the command being
+# run and their duration. Once enabled, subprocess calls, EC2 API
+# requests and config I/O are recorded automatically; handlers add
+# spans around per-node steps so the exported timeline shows
+# cross-node concurrency and the critical path.
+#
+# Tracing is off by default and span() is a no-op until enable() is
+# called, e.g. by passing --trace=out.json to sirikata-cluster.py.
+
+import contextlib, json, os, subprocess, threading, time
+
+_enabled = False
+_lock = threading.Lock()
+_spans = []
+_local = threading.local()
+_epoch = None
+
+class Span(object):
+    def __init__(self, sid, parent, name, node, cmd):
+        self.id = sid
+        self.parent = parent
+        self.name = name
+        self.node = node
+        self.cmd = cmd
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+
+def enabled():
+    return _enabled
+
+def enable():
+    '''Start recording spans and install the wrappers around
+    subprocess and boto calls.'''
+    global _enabled, _epoch
+    if _enabled: return
+    _enabled = True
+    _epoch = time.time()
+    _wrap_subprocess()
+    _wrap_boto()
+
+def _stack():
+    if not hasattr(_local, 'stack'): _local.stack = []
+    return _local.stack
+
+def current():
+    '''The innermost active span on this thread, or None.'''
+    stack = _stack()
+    if stack: return stack[-1]
+    return None
+
+@contextlib.contextmanager
+def span(name, node=None, cmd=None, parent=None):
+    '''Record a span around a block of code. node defaults to the
+    node of the enclosing span. parent can be given explicitly to
+    attach spans started on worker threads to the span that spawned
+    them.'''
+    if not _enabled:
+        yield None
+        return
+
+    if parent is None: parent = current()
+    if node is None and parent is not None: node = parent.node
+    with _lock:
+        s = Span(len(_spans), parent.id if parent is not None else None, name, node, cmd)
+        _spans.append(s)
+    _stack().append(s)
+    try:
+        yield s
+    finally:
+        s.end = time.time()
+        _stack().pop()
+
+@contextlib.contextmanager
+def attach(parent):
+    '''Make parent the enclosing span for this thread without creating
+    a new span. Used by worker threads so their spans nest under the
+    span that started them.'''
+    if not _enabled or parent is None:
+        yield
+        return
+    _stack().append(parent)
+    try:
+        yield
+    finally:
+        _stack().pop()
+
+def spans():
+    with _lock:
+        return list(_spans)
+
+
+
+def _command_name(argv):
+    if isinstance(argv, basestring): return argv.split()[0] if argv.strip() else argv
+    argv = list(argv)
+    while len(argv) > 1 and os.path.basename(argv[0]) in ['sudo', 'nice', 'ionice']:
+        argv.pop(0)
+    return os.path.basename(argv[0])
+
+def _command_str(argv, limit=200):
+    if isinstance(argv, basestring): cmd = argv
+    else: cmd = ' '.join([str(x) for x in argv])
+    if len(cmd) > limit: cmd = cmd[:limit] + '...'
+    return cmd
+
+def _traced(fn):
+    def wrapper(*args, **kwargs):
+        argv = args[0] if args else kwargs.get('args', [])
+        with span(_command_name(argv), cmd=_command_str(argv)):
+            return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    wrapper.traced = True
+    return wrapper
+
+def _wrap_subprocess():
+    # check_call goes through call, so wrapping it would record each
+    # command twice
+    for fname in ['call', 'check_output']:
+        fn = getattr(subprocess, fname, None)
+        if fn is None or getattr(fn, 'traced', False): continue
+        setattr(subprocess, fname, _traced(fn))
+
+def _wrap_boto():
+    # All boto EC2 API requests go through make_request, which gets
+    # the API action name as its first argument
+    try:
+        from boto.connection import AWSQueryConnection
+    except ImportError:
+        return
+    orig = AWSQueryConnection.make_request
+    if getattr(orig, 'traced', False): return
+    def make_request(self, action, *args, **kwargs):
+        with span('ec2 ' + str(action), cmd=str(action)):
+            return orig(self, action, *args, **kwargs)
+    make_request.traced = True
+    AWSQueryConnection.make_request = make_request
+
+
+
+def critical_path(all_spans=None):
+    '''Follow the spans that determined the end time: start from the
+    root finishing last and repeatedly descend into the child that
+    finished last.'''
+    if all_spans is None: all_spans = spans()
+    children = {}
+    for s in all_spans:
+        children.setdefault(s.parent, []).append(s)
+    path = []
+    level = children.get(None, [])
+    while level:
+        last = max(level, key=lambda s: (s.end or time.time()))
+        path.append(last)
+        level = children.get(last.id, [])
+    return path
+
+def _lanes(all_spans):
+    '''Assign each span a lane: its node if it has one, otherwise the
+    thread it ran on. Returns the lane names in order of first use and
+    a map from span id to lane index.'''
+    names = []
+    span_lanes = {}
+    for s in all_spans:
+        lane = ('node ' + str(s.node)) if s.node is not None else s.thread
+        if lane not in names: names.append(lane)
+        span_lanes[s.id] = names.index(lane)
+    return names, span_lanes
+
+def export_chrome(path):
+    '''Write spans in Chrome's trace event format (load with
+    chrome://tracing or Perfetto). Each node gets its own row.'''
+    all_spans = spans()
+    names, span_lanes = _lanes(all_spans)
+    events = []
+    for idx, name in enumerate(names):
+        events.append({ 'name' : 'thread_name', 'ph' : 'M', 'pid' : 1, 'tid' : idx, 'args' : { 'name' : name } })
+    for s in all_spans:
+        args = {}
+        if s.node is not None: args['node'] = s.node
+        if s.cmd is not None: args['cmd'] = s.cmd
+        events.append({
+                'name' : s.name,
+                'cat' : s.name.split()[0],
+                'ph' : 'X',
+                'pid' : 1,
+                'tid' : span_lanes[s.id],
+                'ts' : int((s.start - _epoch) * 1e6),
+                'dur' : int(s.duration() * 1e6),
+                'args' : args,
+                })
+    with open(path, 'w') as fp:
+        json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, fp)
+
+def export_text(path, width=40):
+    '''Write a human readable timeline: one line per span with its
+    start offset, duration and a bar showing where it falls in the
+    whole operation, followed by the critical path.'''
+    all_spans = sorted(spans(), key=lambda s: s.start)
+    if not all_spans:
+        with open(path, 'w') as fp: fp.write('No spans recorded\n')
+        return
+    total = max([(s.end or time.time()) for s in all_spans]) - _epoch
+    total = max(total, 1e-6)
+    depth = {}
+    lines = []
+    for s in all_spans:
+        depth[s.id] = (depth[s.parent] + 1) if s.parent is not None else 0
+        begin = int((s.start - _epoch) / total * width)
+        length = max(1, int(s.duration() / total * width))
+        bar = ' ' * begin + '#' * length
+        label = '  ' * depth[s.id] + s.name
+        if s.cmd is not None and s.cmd != s.name: label += ': ' + s.cmd
+        lines.append('%9.3fs %9.3fs  |%-*s|  %-12s %s' % (s.start - _epoch, s.duration(), width, bar[:width], s.node or '', label))
+
+    lines.append('')
+    lines.append('Critical path (total %.3fs):' % total)
+    for s in critical_path():
+        lines.append('  %9.3fs %5.1f%%  %-12s %s' % (s.duration(), 100.0 * s.duration() / total, s.node or '', s.name))
+
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+
+def export(path):
+    '''Export to path, choosing the format based on the extension:
+    .json gives a Chrome trace, anything else a text timeline.'''
+    if path.endswith('.json'):
+        export_chrome(path)
+    else:
+        export_text(path)
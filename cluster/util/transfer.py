@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Parallel rsync transfers between the local host and many nodes, with
+# bandwidth shaping and throughput reporting. Backends turn a target
+# ('all', a node or a comma separated list of nodes) into a list of
+# (node id, source, destination, rsync options) transfers and hand them
+# to run().
+
+import results
+import parallel
+import trace
+import config
+import os, re, subprocess, threading, time
+
+def split_targets(target):
+    '''Split a sync target into a list of node names, or None for 'all'.'''
+    if target == 'all': return None
+    if isinstance(target, (str, unicode)) and target.find(',') != -1:
+        return [t for t in target.split(',') if t]
+    return [target]
+
+class Options(object):
+    '''Transfer options shared by the commands that move files around:
+
+      --parallel=N        number of concurrent transfers (default: all)
+      --bwlimit=KBPS      total bandwidth cap across all transfers
+      --node-bwlimit=KBPS bandwidth cap for each transfer
+      --compress[=false]  compress data on the wire
+    '''
+
+    def __init__(self, kwargs, compress=False):
+        self.parallelism = int(config.kwarg_or_default('parallel', kwargs, default=0))
+        self.bwlimit = int(config.kwarg_or_default('bwlimit', kwargs, default=0))
+        self.node_bwlimit = int(config.kwarg_or_default('node-bwlimit', kwargs, default=0))
+        self.compress = config.kwarg_or_default('compress', kwargs, default=compress)
+        if isinstance(self.compress, (str, unicode)): self.compress = self.compress.lower() not in ['false', 'no', '0']
+
+    def concurrency(self, count):
+        if self.parallelism <= 0: return count
+        return min(self.parallelism, count)
+
+    def per_transfer_bwlimit(self, count):
+        '''The --bwlimit value (KB/s) to give each rsync so that the
+        concurrent transfers stay under both the global and per-node
+        caps. 0 means unlimited.'''
+        limits = []
+        if self.node_bwlimit > 0: limits.append(self.node_bwlimit)
+        if self.bwlimit > 0 and count > 0: limits.append(max(1, self.bwlimit / self.concurrency(count)))
+        if not limits: return 0
+        return min(limits)
+
+    def rsync_args(self, count):
+        args = ['--stats']
+        bwlimit = self.per_transfer_bwlimit(count)
+        if bwlimit: args.append('--bwlimit=%d' % (bwlimit))
+        if self.compress: args.append('-z')
+        return args
+
+
+_stats_re = re.compile(r'^Total bytes (sent|received):\s*([\d,]+)', re.M)
+
+def parse_stats(output):
+    '''Get the number of bytes moved over the wire from rsync --stats
+    output, or None if it can't be found.'''
+    matches = _stats_re.findall(output)
+    if not matches: return None
+    return sum([int(count.replace(',', '')) for direction, count in matches])
+
+def format_rate(nbytes, duration):
+    if not duration: return 'n/a'
+    rate = nbytes / duration
+    for unit in ['B/s', 'KB/s', 'MB/s']:
+        if rate < 1024: return '%.1f %s' % (rate, unit)
+        rate /= 1024.0
+    return '%.1f GB/s' % (rate)
+
+def run(op, transfers, options, ssh=None, quiet=False):
+    '''Run transfers, a list of (node id, source, destination) or
+    (node id, source, destination, extra rsync args), concurrently and
+    return a Result with per-node bytes and timing. ssh, if given, is
+    passed as rsync's -e remote shell.'''
+
+    result = results.Result(op)
+    base_args = options.rsync_args(len(transfers))
+    print_lock = threading.Lock()
+
+    def transfer(item):
+        node_id, src, dest = item[:3]
+        extra = list(item[3]) if len(item) > 3 else []
+        cmd = ['rsync'] + base_args + extra
+        if ssh is not None: cmd += ['-e', ssh]
+        cmd += [src, dest]
+
+        start = time.time()
+        with trace.span('rsync', node=node_id):
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            out, err = proc.communicate()
+        duration = time.time() - start
+        nbytes = parse_stats(out)
+        if not quiet:
+            with print_lock:
+                if proc.returncode != 0:
+                    print "Transfer for %s failed (rsync exited with %d)" % (node_id, proc.returncode)
+                elif nbytes is not None:
+                    print "%s: %d bytes in %.1fs (%s)" % (node_id, nbytes, duration, format_rate(nbytes, duration))
+        result.add_node(node_id, proc.returncode, duration=duration, bytes=nbytes)
+
+    parallel.run(transfer, transfers, parallelism=options.concurrency(len(transfers)))
+    result.finish()
+
+    if not quiet and len(transfers) > 1:
+        print "Transferred %d bytes for %d nodes in %.1fs (%s aggregate), %d failed" % (
+            result.bytes, len(transfers), result.duration, format_rate(result.bytes, result.duration), len(result.failed_nodes()))
+    return result
+
+def gather(op, sources, local_dir, options, incremental=False, ssh=None):
+    '''Pull files from many nodes at once. sources is a list of (node
+    id, rsync source path) and each node's files end up under
+    local_dir/<node id>/. Interrupted transfers are resumed from what
+    was already received. With incremental, files that already exist
+    locally only have the data appended since the last gather fetched,
+    which suits logs and stats files that only grow.'''
+
+    extra = ['-a', '--partial']
+    if incremental: extra.append('--append')
+    transfers = []
+    for node_id, src in sources:
+        dest = os.path.join(local_dir, node_id)
+        if not os.path.exists(dest): os.makedirs(dest)
+        transfers.append( (node_id, src, dest + '/', extra) )
+    return run(op, transfers, options, ssh=ssh)
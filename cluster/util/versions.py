@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# Several Sirikata builds side by side on each node. versions install
+# extracts an archive into sirikata-versions/ID under the node's
+# workspace, where ID is a hash of the archive (so installing the same
+# build twice is a no-op), and versions activate points the node's
+# Sirikata path, which becomes a symlink, at one of them. Switching
+# builds, e.g. to compare two of them or to roll back, is just
+# flipping the links and restarting services; nothing is copied.
+#
+# Each version's .last-used file is touched when it's installed or
+# activated, and versions gc removes the least recently used versions
+# until the store fits in a disk budget. The active version and any
+# version a service was started with are never removed.
+#
+# What each node has installed is kept in state['versions'] and
+# service records note the version they run as 'sirikata_version'.
+
+import results
+import parallel
+import trace
+import journal
+import facts
+import os, pipes, time
+
+StoreName = 'sirikata-versions'
+
+def version_id(archive):
+    '''The version ID of an archive, a hash of its contents.'''
+    return journal.file_key(archive)[:12]
+
+def store_path(workspace):
+    return os.path.join(workspace, StoreName)
+
+def version_path(store, version):
+    return os.path.join(store, version)
+
+def resolve(version, store):
+    '''Map a version given to a rolling restart to a directory: store IDs
+    are looked up in store, paths are used as they are.'''
+    if version is None or os.path.isabs(version): return version
+    return version_path(store, version)
+
+def _vars(**values):
+    return ''.join(['%s=%s\n' % (name, pipes.quote(value)) for name, value in sorted(values.items())])
+
+# Prints a version=ID size=BYTES used=TIME active=0|1 line per
+# complete version. Expects $store and $link.
+ListScript = '''active=$(readlink "$link" 2>/dev/null || true)
+for dir in "$store"/*/; do
+  dir=${dir%/}
+  [ -f "$dir/.complete" ] || continue
+  used=$(stat -c %Y "$dir/.last-used" 2>/dev/null || stat -c %Y "$dir")
+  size=$(du -sk "$dir" | cut -f1)
+  echo "version=$(basename "$dir") size=$((size * 1024)) used=$used active=$([ "$active" = "$dir" ] && echo 1 || echo 0)"
+done
+'''
+
+# Extracts $archive into $store/$version unless it's already there,
+# removing the archive afterwards if $remove is 1. Nodes sharing a
+# store may install the same version at once, so each extracts into
+# its own directory and the first to finish wins.
+InstallScript = '''set -e
+if [ ! -f "$store/$version/.complete" ]; then
+  partial="$store/.$version.$$"
+  mkdir -p "$partial"
+  tar -xf "$archive" -C "$partial"
+  touch "$partial/.complete"
+  [ -f "$store/$version/.complete" ] || rm -rf "$store/$version"
+  mv -T "$partial" "$store/$version" 2>/dev/null || rm -rf "$partial"
+fi
+touch "$store/$version/.last-used"
+if [ "$remove" = 1 ]; then rm -f "$archive"; fi
+'''
+
+# Atomically points $link at $store/$version. An empty directory in
+# place of the link is replaced.
+ActivateScript = '''set -e
+if [ ! -f "$store/$version/.complete" ]; then
+  echo "Version $version isn't installed" >&2
+  exit 3
+fi
+if [ -d "$link" ] && [ ! -L "$link" ] && ! rmdir "$link" 2>/dev/null; then
+  echo "$link holds a Sirikata install rather than a link to a version, move it aside to use versions" >&2
+  exit 4
+fi
+mkdir -p "$(dirname "$link")"
+ln -sfn "$store/$version" "$link.new"
+mv -T "$link.new" "$link"
+touch "$store/$version/.last-used"
+'''
+
+# Removes the versions in $versions, except the active one
+RemoveScript = '''set -e
+active=$(readlink "$link" 2>/dev/null || true)
+for version in $versions; do
+  [ "$active" = "$store/$version" ] && continue
+  rm -rf "$store/$version"
+  echo "removed=$version"
+done
+'''
+
+def list_script(store, link):
+    return _vars(store=store, link=link) + ListScript
+
+def installed_script(store, version):
+    '''Exits with 0 if version is completely installed.'''
+    return _vars(store=store, version=version) + 'test -f "$store/$version/.complete"\n'
+
+def install_script(store, version, archive, remove=False):
+    return _vars(store=store, version=version, archive=archive, remove='1' if remove else '0') + InstallScript
+
+def activate_script(store, version, link):
+    return _vars(store=store, version=version, link=link) + ActivateScript
+
+def remove_script(store, link, versions):
+    return _vars(store=store, link=link, versions=' '.join(versions)) + RemoveScript
+
+def parse_list(output):
+    '''Parse ListScript output into (active version or None, { version
+    : { 'size', 'used' } }).'''
+    active, installed = None, {}
+    for line in output.splitlines():
+        fields = dict([field.split('=', 1) for field in line.split() if field.find('=') != -1])
+        if 'version' not in fields: continue
+        installed[fields['version']] = { 'size' : int(fields.get('size', 0)), 'used' : float(fields.get('used', 0)) }
+        if fields.get('active') == '1': active = fields['version']
+    return (active, installed)
+
+
+def running(state, node_id, command=None):
+    '''The version a service on node_id runs: the one its command points
+    into, or else the node's active version. None if the node doesn't
+    use versions.'''
+    for arg in command or []:
+        marker = '/' + StoreName + '/'
+        if arg.find(marker) != -1:
+            return arg[arg.index(marker) + len(marker):].split('/')[0]
+    return state.get('versions', {}).get(node_id, {}).get('active')
+
+def pinned(state, node_id):
+    '''Versions that services on node_id were started with.'''
+    return set([s['sirikata_version'] for s in state.get('services', {}).values()
+                if s['node'] == node_id and s.get('sirikata_version')])
+
+def plan_gc(installed, budget, keep):
+    '''Choose versions to remove, least recently used first, until the
+    total size fits in budget bytes. Versions in keep are never
+    chosen.'''
+    total = sum([info['size'] for info in installed.values()])
+    remove = []
+    for version in sorted([v for v in installed if v not in keep], key=lambda v: installed[v]['used']):
+        if total <= budget: break
+        remove.append(version)
+        total -= installed[version]['size']
+    return remove
+
+
+class Store(object):
+    '''Runs version store operations on a cluster's nodes. run(node_id,
+    script) runs a script on a node, returning (retcode, output),
+    store(node_id) and link(node_id) give the node's store directory
+    and Sirikata path. Nodes in groups (representative node id : [node
+    ids]) share a store and Sirikata path, so operations only run on
+    the representative.'''
+
+    def __init__(self, cc, run, store, link, groups=None, parallelism=None):
+        self.cc = cc
+        self.run = run
+        self.store = store
+        self.link = link
+        self.groups = groups or {}
+        self.parallelism = parallelism
+
+    def members(self, node_id):
+        return self.groups.get(node_id, [node_id])
+
+    def _record(self, node_id, **fields):
+        with self.cc.lock:
+            for member in self.members(node_id):
+                entry = self.cc.state.setdefault('versions', {}).setdefault(member, { 'active' : None, 'installed' : {} })
+                entry.update(fields)
+
+    def _forget_facts(self, node_id):
+        '''Drop a node's cached facts once its Sirikata version or free
+        space changed, before _each saves the state.'''
+        with self.cc.lock:
+            facts.forget(self.cc, self.members(node_id))
+
+    def _each(self, op, node_ids, fn):
+        '''Run fn(node_id), returning (retcode, error, data), on the nodes
+        in parallel, adding the outcome for each group member to a
+        Result.'''
+        result = results.Result(op)
+        def run_one(node_id):
+            start = time.time()
+            with trace.span(op, node=node_id):
+                retcode, error, data = fn(node_id)
+            for member in self.members(node_id):
+                result.add_node(member, retcode, duration=time.time()-start, error=error if retcode != 0 else None, data=data)
+        parallel.run(run_one, node_ids, parallelism=self.parallelism)
+        self.cc.save()
+        return result.finish()
+
+    def refresh(self, op, node_ids):
+        '''List the versions installed on the nodes, saving them in the
+        cluster state.'''
+        def list_node(node_id):
+            retcode, out = self.run(node_id, list_script(self.store(node_id), self.link(node_id)))
+            if retcode != 0: return (retcode, "couldn't list versions", None)
+            active, installed = parse_list(out or '')
+            self._record(node_id, active=active, installed=installed)
+            return (0, None, { 'active' : active, 'installed' : installed })
+        return self._each(op, node_ids, list_node)
+
+    def install(self, op, node_ids, archive, copy=None):
+        '''Install archive on the nodes. copy(node_id, archive, dest)
+        copies it to a node and returns an exit code; without it the
+        nodes read archive directly.'''
+        version = version_id(archive)
+        def install_node(node_id):
+            store = self.store(node_id)
+            if self.run(node_id, installed_script(store, version))[0] == 0:
+                # Already there, so just mark it used
+                self.run(node_id, install_script(store, version, archive))
+                return (0, None, { 'version' : version, 'installed' : False })
+            node_archive = archive
+            if copy is not None:
+                node_archive = os.path.join(store, '.%s-%s.tar.bz2' % (version, node_id))
+                retcode = copy(node_id, archive, node_archive)
+                if retcode != 0: return (retcode, 'copying archive failed', None)
+            retcode, out = self.run(node_id, install_script(store, version, node_archive, remove=(copy is not None)))
+            if retcode != 0: return (retcode, 'extracting archive failed', None)
+            self._forget_facts(node_id)
+            return (0,None, { 'version' : version, 'installed' : True })
+        result = self._each(op, node_ids, install_node)
+        result.data = { 'version' : version }
+        return result
+
+    def activate(self, op, node_ids, version):
+        '''Point the nodes' Sirikata paths at version.'''
+        def activate_node(node_id):
+            retcode, out = self.run(node_id, activate_script(self.store(node_id), version, self.link(node_id)))
+            if retcode != 0: return (retcode, "couldn't activate %s" % (version), None)
+            self._record(node_id, active=version)
+            self._forget_facts(node_id)
+            return (0, None, { 'version' : version })
+        return self._each(op, node_ids, activate_node)
+
+    def gc(self, op, node_ids, budget):
+        '''Remove least recently used versions from the nodes until each
+        store fits in budget bytes.'''
+        def gc_node(node_id):
+            retcode, out = self.run(node_id, list_script(self.store(node_id), self.link(node_id)))
+            if retcode != 0: return (retcode, "couldn't list versions", None)
+            active, installed = parse_list(out or '')
+            keep = set([active])
+            with self.cc.lock:
+                for member in self.members(node_id):
+                    keep.add(self.cc.state.get('versions', {}).get(member, {}).get('active'))
+                    keep |= pinned(self.cc.state, member)
+            remove = plan_gc(installed, budget, keep)
+            if remove:
+                retcode, out = self.run(node_id, remove_script(self.store(node_id), self.link(node_id), remove))
+                if retcode != 0: return (retcode, "couldn't remove versions", None)
+                for version in remove: installed.pop(version, None)
+                self._forget_facts(node_id)
+            self._record(node_id, active=active, installed=installed)
+            data = { 'removed' : remove, 'size' : sum([info['size'] for info in installed.values()]) }
+            if data['size'] > budget:
+                print "Versions in use on %s need %d MB, more than the budget" % (node_id, data['size'] / 1024**2)
+                return (1, 'versions in use need more than the budget', data)
+            return (0, None, data)
+        return self._each(op, node_ids, gc_node)
+
+
+def format_table(state, node_ids):
+    '''Format the versions installed on nodes as a table for text
+    output, marking the active one with a *.'''
+    lines = ['%-24s %-14s %8s %s' % ('node', 'version', 'size', 'last used')]
+    for node_id in node_ids:
+        entry = state.get('versions', {}).get(node_id, { 'installed' : {} })
+        for version, info in sorted(entry['installed'].items(), key=lambda item: -item[1]['used']):
+            lines.append('%-24s %-14s %7.1fM %s' % (
+                    node_id, version + (' *' if version == entry.get('active') else ''), info['size'] / 1024.0**2,
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(info['used']))))
+    return '\n'.join(lines)
@@ -6,4 +6,5 @@ Usage: sirikata-cluster.py command [args]
 This is the driver script for sirikata-cluster.
 """
 
-import sirikatacluster
+import sirikatacluster, sys
+sirikatacluster.main(sys.argv)
@@ -9,8 +9,12 @@ This version is the importable version.
 """
 
 import cluster.util.config as config
+import cluster.util.trace as trace
+import cluster.util.results as results
 import cluster.ec2 as ec2
 import cluster.adhoc as adhoc
+import cluster.local as local
+import cluster.aggregate as aggregate
 import sys
 
 # Parse config options, currently only from the environment variables
@@ -19,7 +23,7 @@ config.env()
 config.check_config()
 
 # Setup all our command handlers
-handlers = ec2.NodeGroup.handlers + adhoc.NodeGroup.handlers
+handlers = ec2.NodeGroup.handlers + adhoc.NodeGroup.handlers + local.NodeGroup.handlers + aggregate.NodeGroup.handlers
 
 def usage(code=1):
     print """
@@ -36,45 +40,75 @@ Available commands:
 # Create map of handlers by name for easy lookup
 handlers_map = dict(handlers)
 
-# Parse the command
-args = list(sys.argv)
-# Get rid of everything up to this script name
-while args and args[0].endswith('.py'):
-    args.pop(0)
-if not args:
-    usage()
-
-# Match n next parts to a command
-command = None
-for nparts in range(1, len(args)+1):
-    command = ' '.join(args[0:nparts])
-    if command in handlers_map:
-        args = args[nparts:]
-        break
-if command not in handlers_map:
-    usage()
-
-# Split remaining args as positional and keyword
-pargs = []
-kwargs = {}
-more_kwargs = True
-for arg in args:
-    # Allows you to stop us from parsing kwargs, leaving them as
-    # positional arguments so that when a command is passed along to a
-    # subprocess (e.g. ssh) it can just be specified as additional
-    # arguments even if the subcommand has --key=value type
-    # arguments. We only accept this once so you can 'escape' it if
-    # your subcommand *also* needs '--' in it.
-    if arg == '--' and more_kwargs:
-        more_kwargs = False
-        continue
-    if more_kwargs and ('=' in arg or arg.startswith('--')):
-        if '=' in arg:
-            k,v = arg.split('=', 1)
+def main(argv):
+    '''Parse argv and run the requested command. This runs as a
+    function rather than at import time so handlers can safely use
+    worker threads (threads blocking on the import lock held while
+    this module is imported would deadlock).'''
+
+    # Parse the command
+    args = list(argv)
+    # Get rid of everything up to this script name
+    while args and args[0].endswith('.py'):
+        args.pop(0)
+    if not args:
+        usage()
+
+    # Match n next parts to a command
+    command = None
+    for nparts in range(1, len(args)+1):
+        command = ' '.join(args[0:nparts])
+        if command in handlers_map:
+            args = args[nparts:]
+            break
+    if command not in handlers_map:
+        usage()
+
+    # Split remaining args as positional and keyword
+    pargs = []
+    kwargs = {}
+    more_kwargs = True
+    for arg in args:
+        # Allows you to stop us from parsing kwargs, leaving them as
+        # positional arguments so that when a command is passed along to a
+        # subprocess (e.g. ssh) it can just be specified as additional
+        # arguments even if the subcommand has --key=value type
+        # arguments. We only accept this once so you can 'escape' it if
+        # your subcommand *also* needs '--' in it.
+        if arg == '--' and more_kwargs:
+            more_kwargs = False
+            continue
+        if more_kwargs and ('=' in arg or arg.startswith('--')):
+            if '=' in arg:
+                k,v = arg.split('=', 1)
+            else:
+                k,v = (arg,True)
+            if k.startswith('--'): k = k[2:]
+            kwargs[k] = v
         else:
-            k,v = (arg,True)
-        if k.startswith('--'): k = k[2:]
-        kwargs[k] = v
-    else:
-        pargs.append(arg)
-exit(handlers_map[command](*pargs, **kwargs))
+            pargs.append(arg)
+
+    # --format=json prints a single JSON document describing the result
+    # when the command finishes; --format=ndjson streams one JSON line per
+    # node as each finishes, followed by the overall result. Either way,
+    # regular output moves to stderr.
+    results.set_format(kwargs.pop('format', 'text'))
+
+    # --trace=out.json records spans for the command and writes them out as
+    # a Chrome trace (.json) or a text timeline (any other extension)
+    # when it finishes, even if the command bails out with exit()
+    trace_path = kwargs.pop('trace', None)
+    if trace_path is True: trace_path = 'trace.json'
+    if trace_path is not None: trace.enable()
+    try:
+        with trace.span(command):
+            result = results.wrap(command, handlers_map[command](*pargs, **kwargs))
+    finally:
+        if trace_path is not None:
+            trace.export(trace_path)
+            print "Trace written to %s" % (trace_path)
+    results.report(result)
+    exit(int(result))
+
+if __name__ == '__main__':
+    main(sys.argv)